@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks decoding large threads with each datetime codec, against the
+strptime-based decoder previously used by Datetime.from_json.
+
+Run from the src directory with:
+    python -m benchmarks.codec [num_tasks]
+"""
+
+import json
+import sys
+import time
+
+from threads.thread import Thread
+from threads.task import Task, Event, Assignment
+from timemap.util import Datetime, Timedelta, CODECS, use_codec
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+def make_thread(num_tasks: int):
+    """
+    Create a thread with num_tasks tasks, events and assignments.
+
+    :param num_tasks: the number of tasks in the thread
+    """
+    start = Datetime(2015, 1, 12)
+    thread = Thread('benchmark', 5)
+    for i in range(num_tasks):
+        start_time = start + i * Timedelta.HOUR
+        if i % 3 == 0:
+            task = Task("task {0}".format(i), start_time,
+                        start_time + Timedelta.HOUR)
+        elif i % 3 == 1:
+            task = Event("event {0}".format(i), start_time,
+                         start_time + Timedelta.HOUR)
+        else:
+            task = Assignment("assignment {0}".format(i), Timedelta.HOUR)
+            task.change_time(start_time, start_time + Timedelta.DAY)
+            task.add_deadline(start_time + Timedelta.DAY)
+        thread.add_task(task)
+    return thread
+
+
+def strptime_from_json(cls, s):
+    """
+    The strptime-based decoder previously used by Datetime.from_json.
+    """
+    if s is None:
+        return None
+    return cls.strptime(s, cls.JSON_FORMAT)
+
+
+def time_from_json(encoded: str, repeat: int):
+    """
+    Get the best time taken by Thread.from_json over repeat runs.
+    """
+    best = None
+    for _ in range(repeat):
+        d = json.loads(encoded)
+        start = time.perf_counter()
+        Thread.from_json(d)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(num_tasks: int=10000, repeat: int=3):
+    """
+    Time Thread.from_json on a thread of num_tasks tasks encoded with
+    each codec, and print the results.
+
+    :param num_tasks: the number of tasks in the thread
+    :param repeat: the number of runs of each benchmark
+    """
+    thread = make_thread(num_tasks)
+
+    results = []
+    with use_codec('legacy'):
+        encoded = json.dumps(thread.to_json())
+    from_json = Datetime.__dict__['from_json']
+    Datetime.from_json = classmethod(strptime_from_json)
+    try:
+        results.append(('strptime', len(encoded),
+                        time_from_json(encoded, repeat)))
+    finally:
+        Datetime.from_json = from_json
+
+    for name in CODECS:
+        with use_codec(name):
+            encoded = json.dumps(thread.to_json())
+        results.append((name, len(encoded), time_from_json(encoded, repeat)))
+
+    baseline = results[0][2]
+    print("Thread.from_json, {0} tasks".format(num_tasks))
+    for name, size, elapsed in results:
+        print("{0:>10}: {1:8.1f} ms {2:10d} bytes {3:6.2f}x".format(
+            name, elapsed * 1000, size, baseline / elapsed))
+    return results
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:]))
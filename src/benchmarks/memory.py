@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the memory taken by each task, both for tasks created
+directly and for tasks loaded from their JSON representation.
+
+Run from the src directory with:
+    python -m benchmarks.memory [num_tasks]
+"""
+
+import json
+import sys
+import tracemalloc
+
+from threads.thread import Thread
+from benchmarks.codec import make_thread
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+def measure(create):
+    """
+    Get the number of bytes still allocated after calling create, along
+    with its result.
+
+    :param create: function creating the objects to be measured
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = create()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return after - before, result
+
+
+def run(num_tasks: int=100000):
+    """
+    Measure the memory taken by a thread of num_tasks tasks, events and
+    assignments when created and when loaded, and print the results.
+
+    :param num_tasks: the number of tasks in the thread
+    """
+    created, thread = measure(lambda: make_thread(num_tasks))
+    encoded = json.dumps(thread.to_json())
+    del thread
+    # Decoded within the measurement, as load_threads does, since
+    # from_json decodes the times into the dictionary it is given
+    loaded, thread = measure(lambda: Thread.from_json(json.loads(encoded)))
+
+    print("Memory per task, {0} tasks".format(num_tasks))
+    print("{0:>10}: {1:8.1f} bytes".format('created', created / num_tasks))
+    print("{0:>10}: {1:8.1f} bytes".format('loaded', loaded / num_tasks))
+    return created / num_tasks, loaded / num_tasks
+
+
+if __name__ == '__main__':
+    run(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the core operations on threads, task managers and time maps
+at several scales, reporting throughput and peak memory, and compares
+the results against a baseline saved by an earlier run.
+
+Run from the src directory with:
+    python -m benchmarks.suite [--scales 1000 10000] [--repeat 3]
+                               [--output results.json]
+                               [--baseline baseline.json]
+
+Module structure:
+- Result
+- measure
+- BENCHMARKS
+- run
+- compare
+"""
+
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from managers import TaskManager, TimeManager
+from scheduler import Scheduler
+from storage.backend import JSONBackend
+from threads.thread import Thread
+from threads.task import Event, Assignment
+from timemap.index import IntervalIndex
+from timemap.time import TimeChunk
+from timemap.util import Timedelta
+from benchmarks.workload import START, make_thread, make_threads, \
+    make_assignments, make_timemap
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+# The number of threads the tasks are spread over by the task manager
+# benchmarks
+NUM_THREADS = 20
+
+# The horizon over which the scheduler benchmark places assignments
+SCHEDULE_HORIZON = 90 * Timedelta.DAY
+
+
+class Result(object):
+    """
+    The result of a benchmark at one scale.
+    """
+    def __init__(self,
+                 name: str,
+                 scale: int,
+                 seconds: float,
+                 peak_bytes: int):
+        """
+        :param name: the name of the benchmark
+        :param scale: the number of items processed
+        :param seconds: the best time taken
+        :param peak_bytes: the peak memory allocated
+        """
+        self.name = name
+        self.scale = scale
+        self.seconds = seconds
+        self.peak_bytes = peak_bytes
+
+    @property
+    def throughput(self):
+        """
+        Get the number of items processed per second.
+        """
+        return self.scale / self.seconds if self.seconds else float('inf')
+
+    def to_json(self):
+        """
+        Convert to JSON representation.
+        """
+        return {
+            'name': self.name,
+            'scale': self.scale,
+            'seconds': self.seconds,
+            'throughput': self.throughput,
+            'peak_bytes': self.peak_bytes
+        }
+
+
+def measure(setup,
+            benchmark,
+            repeat: int=3):
+    """
+    Get the best time taken by benchmark over repeat runs, and the peak
+    memory it allocates in one more run traced by tracemalloc.  Each
+    run is given a fresh result of setup, which is not timed, and the
+    garbage it leaves is collected first so that it is not charged to
+    the benchmark.
+
+    :param setup: function creating the argument of benchmark
+    :param benchmark: function to be measured
+    :param repeat: the number of timed runs
+    :return : seconds, peak_bytes
+    :rtype: tuple
+    """
+    best = None
+    for _ in range(repeat):
+        argument = setup()
+        gc.collect()
+        start = time.perf_counter()
+        benchmark(argument)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    argument = setup()
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        benchmark(argument)
+        peak = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def _task_manager(scale: int):
+    """
+    Create a task manager storing NUM_THREADS threads with scale tasks
+    in total in a new temporary directory.
+    """
+    root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, 'threads', 'past'))
+    os.makedirs(os.path.join(root, 'threads', 'future'))
+
+    task_manager = TaskManager(backend=JSONBackend(root))
+    task_manager.threads = make_threads(NUM_THREADS,
+                                        max(scale // NUM_THREADS, 1))
+    return task_manager
+
+
+def _saved_task_manager(scale: int):
+    """
+    Create a task manager as _task_manager does, and save its tasks.
+    """
+    task_manager = _task_manager(scale)
+    task_manager.save_state(now=START)
+    for thread in task_manager.threads:
+        thread.tasks[0].importance = 5
+    return task_manager
+
+
+def _cleanup(task_manager: TaskManager):
+    """
+    Remove the temporary directory of a task manager.
+    """
+    shutil.rmtree(task_manager.backend.root, ignore_errors=True)
+
+
+def _save_state(task_manager: TaskManager):
+    """
+    Save all tasks of a new task manager.
+    """
+    task_manager.save_state(now=START)
+    _cleanup(task_manager)
+
+
+def _load_state(task_manager: TaskManager):
+    """
+    Load all tasks saved by a task manager into a new one.
+    """
+    TaskManager(backend=task_manager.backend).load_state()
+    _cleanup(task_manager)
+
+
+def _refresh_state(task_manager: TaskManager):
+    """
+    Refresh the tasks of a task manager half a year into its workload.
+    """
+    task_manager.refresh_state(now=START + 180 * Timedelta.DAY)
+    _cleanup(task_manager)
+
+
+def _repeating(scale: int):
+    """
+    Create repeating events and assignments, about scale / 10 of them,
+    each with one appointment or deadline every day.
+    """
+    thread = make_thread('repeating', 0)
+    for i in range(max(scale // 10, 1)):
+        start_time = START + i * Timedelta.HOUR
+        event = Event("event {0}".format(i), start_time,
+                      start_time + 10 * 365 * Timedelta.DAY,
+                      repeat=Event.EventRepeat(True, Timedelta.DAY))
+        event.add_appointment(TimeChunk(start_time, Timedelta.HOUR))
+        thread.add_task(event)
+
+        assignment = Assignment("assignment {0}".format(i), Timedelta.HOUR,
+                                repeat=Assignment.AssignmentRepeat(
+                                    True, Timedelta.DAY))
+        assignment.change_time(start_time,
+                               start_time + 10 * 365 * Timedelta.DAY)
+        assignment.add_deadline(start_time + Timedelta.HOUR)
+        thread.add_task(assignment)
+    return thread
+
+
+def _expand_recurrences(thread: Thread):
+    """
+    Expand the occurrences of repeating tasks within a week five years
+    after they start.
+    """
+    window_start = START + 5 * 365 * Timedelta.DAY
+    window_end = window_start + 7 * Timedelta.DAY
+    for task in thread.tasks:
+        for _ in task.occurrences(window_start, window_end):
+            pass
+
+
+def _scheduler(scale: int):
+    """
+    Create a scheduler for scale assignments spread over NUM_THREADS
+    threads, with SCHEDULE_HORIZON of free time to place them in.
+    """
+    task_manager = TaskManager()
+    task_manager.threads = make_assignments(
+        NUM_THREADS, max(scale // NUM_THREADS, 1), span=SCHEDULE_HORIZON)
+    time_manager = TimeManager()
+    time_manager.add_free_chunks(START, START + SCHEDULE_HORIZON)
+    return Scheduler(task_manager, time_manager)
+
+
+def _schedule(scheduler: Scheduler):
+    """
+    Schedule all assignments of a scheduler over the horizon.
+    """
+    scheduler.schedule(START, START + SCHEDULE_HORIZON, now=START)
+
+
+def _halves(scale: int):
+    """
+    Create two threads with the same name, sharing half of their tasks.
+    """
+    thread = make_thread('ior', scale)
+    first = Thread(thread.name, thread.default_importance)
+    second = Thread(thread.name, thread.default_importance)
+    first.tasks = thread.tasks[:scale * 3 // 4]
+    second.tasks = thread.tasks[scale // 4:]
+    return first, second
+
+
+def _ior(threads: tuple):
+    """
+    Find the union of two threads in place.
+    """
+    first, second = threads
+    first |= second
+
+
+# name: (setup, benchmark) taking the scale and the result of setup
+BENCHMARKS = {
+    'thread.to_json': (
+        lambda scale: make_thread('bench', scale),
+        lambda thread: json.dumps(thread.to_json())),
+    'thread.from_json': (
+        lambda scale: json.loads(json.dumps(
+            make_thread('bench', scale).to_json())),
+        Thread.from_json),
+    'thread.__ior__': (_halves, _ior),
+    'task_manager.save_state': (_task_manager, _save_state),
+    'task_manager.load_state': (_saved_task_manager, _load_state),
+    'task_manager.refresh_state': (_saved_task_manager, _refresh_state),
+    'recurrence.occurrences': (_repeating, _expand_recurrences),
+    'scheduler.schedule': (_scheduler, _schedule),
+    'timemap.to_json': (
+        lambda scale: make_timemap(scale * Timedelta(minutes=15) /
+                                   Timedelta(days=365)),
+        lambda timemap: json.dumps(timemap.to_json())),
+    'timemap.from_json': (
+        lambda scale: json.loads(json.dumps(make_timemap(
+            scale * Timedelta(minutes=15) / Timedelta(days=365)).to_json())),
+        IntervalIndex.from_json),
+}
+
+
+def run(scales: list=(1000, 10000),
+        repeat: int=3,
+        names: list=None):
+    """
+    Run the benchmarks at each scale and print the results.
+
+    :param scales: the numbers of tasks or time chunks processed
+    :param repeat: the number of timed runs of each benchmark
+    :param names: the names of the benchmarks to run (defaults to all)
+    :return : the results
+    :rtype: list
+    """
+    results = []
+    for name, (setup, benchmark) in BENCHMARKS.items():
+        if names is not None and name not in names:
+            continue
+        for scale in scales:
+            seconds, peak_bytes = measure(lambda: setup(scale), benchmark,
+                                          repeat)
+            result = Result(name, scale, seconds, peak_bytes)
+            results.append(result)
+            print("{0:>28} {1:>8d}: {2:10.1f} ms {3:12.0f} /s "
+                  "{4:10.1f} MB peak".format(
+                      name, scale, seconds * 1000, result.throughput,
+                      peak_bytes / 1e6))
+    return results
+
+
+def compare(results: list, baseline: list):
+    """
+    Print the time taken and peak memory of each result relative to the
+    baseline result with the same name and scale.
+
+    :param results: the results
+    :param baseline: the JSON representations of the baseline results
+    """
+    baseline = {(result['name'], result['scale']): result
+                for result in baseline}
+    print("Relative to baseline (time, peak memory)")
+    for result in results:
+        base = baseline.get((result.name, result.scale))
+        if base is None:
+            continue
+        print("{0:>28} {1:>8d}: {2:6.2f}x {3:6.2f}x".format(
+            result.name, result.scale, result.seconds / base['seconds'],
+            result.peak_bytes / base['peak_bytes']
+            if base['peak_bytes'] else float('inf')))
+
+
+def main(argv: list):
+    """
+    Run the benchmarks with command line arguments.
+
+    :param argv: the command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS))
+    parser.add_argument('--output', help="file to save the results to")
+    parser.add_argument('--baseline', help="file of results to compare to")
+    args = parser.parse_args(argv)
+
+    results = run(args.scales, args.repeat, args.only)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            compare(results, json.load(f)['results'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'results': [result.to_json() for result in results]
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+Generates synthetic workloads for the benchmarks: threads of mixed
+tasks, events and assignments, some of them repeating, and time maps
+covering years of allocated time chunks.
+
+Module structure:
+- make_task
+- make_thread
+- make_threads
+- make_assignments
+- make_timemap
+"""
+
+import random
+
+from threads.thread import Thread
+from threads.task import Task, Event, Assignment
+from timemap.index import IntervalIndex
+from timemap.time import TimeChunk, AllocatedTimeChunk
+from timemap.util import Datetime, Timedelta
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+# The start of all generated workloads
+START = Datetime(2015, 1, 12)
+
+# The fraction of events and assignments which are repeating
+REPEAT_FRACTION = 0.1
+
+
+def make_task(rng: random.Random,
+              i: int,
+              start: Datetime=START,
+              span: Timedelta=Timedelta(days=365)):
+    """
+    Create a task, event or assignment starting at a random time within
+    span of start.  Some events and assignments are repeating daily or
+    weekly.
+
+    :param rng: the random number generator
+    :param i: the number of the task
+    :param start: the start of the workload
+    :param span: the length of the workload
+    """
+    start_time = start + Timedelta(minutes=15 * rng.randrange(
+        int(span.total_seconds() // 900)))
+    duration = Timedelta(minutes=15 * rng.randint(1, 8))
+    importance = rng.randint(0, 10)
+    kind = rng.random()
+
+    if kind < 0.4:
+        return Task("task {0}".format(i), start_time, start_time + duration,
+                    importance=importance)
+
+    repeating = rng.random() < REPEAT_FRACTION
+    period = rng.choice((Timedelta.DAY, Timedelta.WEEK))
+    if kind < 0.7:
+        if repeating:
+            event = Event("event {0}".format(i), start_time,
+                          start_time + rng.randint(4, 52) * Timedelta.WEEK,
+                          importance=importance,
+                          repeat=Event.EventRepeat(True, period))
+        else:
+            event = Event("event {0}".format(i), start_time,
+                          start_time + duration, importance=importance)
+        event.add_appointment(TimeChunk(start_time, duration))
+        return event
+
+    if repeating:
+        assignment = Assignment("assignment {0}".format(i), duration,
+                                importance=importance,
+                                repeat=Assignment.AssignmentRepeat(True,
+                                                                   period))
+        assignment.change_time(start_time,
+                               start_time + rng.randint(4, 52) *
+                               Timedelta.WEEK)
+        assignment.add_deadline(start_time + period)
+    else:
+        assignment = Assignment("assignment {0}".format(i), duration,
+                                importance=importance)
+        assignment.change_time(start_time,
+                               start_time + rng.randint(1, 14) *
+                               Timedelta.DAY)
+        assignment.add_deadline(assignment.end_time)
+    return assignment
+
+
+def make_thread(name: str,
+                num_tasks: int,
+                seed: int=0,
+                start: Datetime=START):
+    """
+    Create a thread with num_tasks mixed tasks.
+
+    :param name: the name of the thread
+    :param num_tasks: the number of tasks in the thread
+    :param seed: the seed of the random number generator
+    :param start: the start of the workload
+    """
+    rng = random.Random("{0}:{1}".format(seed, name))
+    thread = Thread(name, rng.randint(0, 10))
+    for i in range(num_tasks):
+        thread.add_task(make_task(rng, i, start))
+    return thread
+
+
+def make_threads(num_threads: int,
+                 num_tasks: int,
+                 seed: int=0,
+                 start: Datetime=START):
+    """
+    Create num_threads threads with num_tasks mixed tasks each.
+
+    :param num_threads: the number of threads
+    :param num_tasks: the number of tasks in each thread
+    :param seed: the seed of the random number generator
+    :param start: the start of the workload
+    """
+    return [make_thread("thread {0}".format(i), num_tasks, seed, start)
+            for i in range(num_threads)]
+
+
+def make_assignments(num_threads: int,
+                     num_tasks: int,
+                     seed: int=0,
+                     start: Datetime=START,
+                     span: Timedelta=Timedelta(days=90)):
+    """
+    Create num_threads threads with num_tasks assignments each, to be
+    scheduled: each expects up to two hours of work and is due at a
+    random time within span of start.
+
+    :param num_threads: the number of threads
+    :param num_tasks: the number of assignments in each thread
+    :param seed: the seed of the random number generator
+    :param start: the start of the workload
+    :param span: the length of the workload
+    """
+    rng = random.Random(seed)
+    threads = []
+    for i in range(num_threads):
+        thread = Thread("thread {0}".format(i), rng.randint(0, 10))
+        for j in range(num_tasks):
+            assignment = Assignment(
+                "assignment {0}".format(j),
+                Timedelta(minutes=15 * rng.choice((1, 2, 4, 8))),
+                importance=rng.randint(0, 10))
+            assignment.change_time(start, start + span)
+            assignment.add_deadline(start + rng.random() * span)
+            thread.add_task(assignment)
+        threads.append(thread)
+    return threads
+
+
+def make_timemap(years: float,
+                 seed: int=0,
+                 start: Datetime=START,
+                 duration: Timedelta=Timedelta(minutes=15),
+                 allocated_fraction: float=0.5):
+    """
+    Create a time map of consecutive time chunks covering a number of
+    years, some of them allocated to tasks in runs.
+
+    :param years: the number of years covered
+    :param seed: the seed of the random number generator
+    :param start: the start of the time map
+    :param duration: the duration of each time chunk
+    :param allocated_fraction: the fraction of time chunks allocated
+    """
+    rng = random.Random(seed)
+    num_chunks = int(years * Timedelta(days=365) / duration)
+
+    chunks = []
+    task_allocated = None
+    for i in range(num_chunks):
+        chunk = AllocatedTimeChunk(start + i * duration, duration)
+        if rng.random() < 0.25:
+            task_allocated = "task {0}".format(i) \
+                if rng.random() < allocated_fraction else None
+        if task_allocated is not None:
+            chunk.set_task_allocated(task_allocated, 0)
+        chunks.append(chunk)
+    return IntervalIndex.from_chunks(chunks)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the instrumentation of the managers and storage
+backends: counters of the bytes, files and tasks they read and write,
+and histograms of the time they spend in serialization, I/O and
+filtering.  It is disabled by default, in which case every counter and
+timer does nothing but check a flag.
+
+>>> enable()
+>>> METRICS.count('files_read', 2)
+>>> with METRICS.timer('io'):
+...     pass
+>>> snapshot = stats()
+>>> snapshot['counters']
+{'files_read': 2}
+>>> snapshot['timings']['io']['count']
+1
+>>> disable()
+>>> reset()
+
+Work done in worker processes is collected there by call_collecting and
+merged into the counters and timings of the parent:
+
+>>> enable()
+>>> METRICS.count('files_read')
+>>> METRICS.merge({'counters': {'files_read': 2}, 'timings': {}})
+>>> stats()['counters']
+{'files_read': 3}
+>>> disable()
+>>> reset()
+
+Module structure:
+- Histogram
+- Timer
+- NullTimer
+- Instrumentation
+- METRICS
+- enable
+- disable
+- reset
+- stats
+- call_collecting
+"""
+
+import functools
+import threading
+import time
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'Histogram',
+    'Instrumentation',
+    'METRICS',
+    'enable',
+    'disable',
+    'reset',
+    'stats',
+    'call_collecting'
+]
+
+
+class Histogram(object):
+    """
+    A histogram of durations with buckets whose bounds are powers of two
+    microseconds.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, seconds: float):
+        """
+        Add a duration to the histogram.
+
+        :param seconds: the duration in seconds
+        """
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+        bound = 1 << int(seconds * 1e6).bit_length()
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+
+    def merge(self, d: dict):
+        """
+        Add the durations of a histogram in JSON representation.
+
+        :param d: the histogram, as given by to_json
+        """
+        self.count += d['count']
+        self.total += d['total']
+        if d['max'] > self.max:
+            self.max = d['max']
+        for bound, n in d['buckets'].items():
+            self.buckets[bound] = self.buckets.get(bound, 0) + n
+
+    def to_json(self):
+        """
+        Convert to JSON representation, with the buckets keyed by their
+        upper bounds in microseconds.
+        """
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'buckets': dict(sorted(self.buckets.items()))
+        }
+
+
+class Timer(object):
+    """
+    Context manager adding the time spent within it to a histogram.
+    """
+    def __init__(self,
+                 instrumentation: "Instrumentation",
+                 name: str):
+        """
+        :param instrumentation: the instrumentation recording the time
+        :param name: the name of the histogram
+        """
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.name,
+                                    time.perf_counter() - self.start)
+        return False
+
+
+class NullTimer(object):
+    """
+    Context manager doing nothing, used while instrumentation is
+    disabled.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Instrumentation(object):
+    """
+    Collects counters and timing histograms while enabled.  An optional
+    hook is called as hook(kind, name, value) for every count, with kind
+    'count', and every timing, with kind 'timing' and the value in
+    seconds.
+
+    Counters and timings can be added to from several threads at once,
+    such as those of an executor, and are guarded by a lock.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.hook = None
+        self.counters = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def enable(self, hook=None):
+        """
+        Start collecting counters and timings.
+
+        :param hook: function called for every count and timing
+        """
+        self.enabled = True
+        self.hook = hook
+
+    def disable(self):
+        """
+        Stop collecting counters and timings.
+        """
+        self.enabled = False
+        self.hook = None
+
+    def reset(self):
+        """
+        Clear all counters and timings.
+        """
+        with self._lock:
+            self.counters = {}
+            self.timings = {}
+
+    def count(self,
+              name: str,
+              n: int=1):
+        """
+        Add to a counter.
+
+        :param name: the name of the counter
+        :param n: the amount added
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        if self.hook is not None:
+            self.hook('count', name, n)
+
+    def record(self,
+               name: str,
+               seconds: float):
+        """
+        Add a duration to a timing histogram.
+
+        :param name: the name of the histogram
+        :param seconds: the duration in seconds
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram()
+            histogram.add(seconds)
+        if self.hook is not None:
+            self.hook('timing', name, seconds)
+
+    def timer(self, name: str):
+        """
+        Get a context manager adding the time spent within it to a
+        timing histogram.
+
+        :param name: the name of the histogram
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, name)
+
+    def timed(self, name: str):
+        """
+        Get a decorator adding the time spent in calls to a function to
+        a timing histogram.
+
+        :param name: the name of the histogram
+        """
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with Timer(self, name):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        """
+        Get a snapshot of all counters and timings.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timings': {name: histogram.to_json()
+                            for name, histogram in self.timings.items()}
+            }
+
+    def merge(self, snapshot: dict):
+        """
+        Add the counters and timings of a snapshot, such as one taken
+        in a worker process, to those collected.  The hook is called
+        for the counters, but not for the timings, whose durations are
+        only known as histograms.
+
+        :param snapshot: the snapshot, as given by stats
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            for name, n in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, d in snapshot['timings'].items():
+                histogram = self.timings.get(name)
+                if histogram is None:
+                    histogram = self.timings[name] = Histogram()
+                histogram.merge(d)
+        if self.hook is not None:
+            for name, n in snapshot['counters'].items():
+                self.hook('count', name, n)
+
+
+# The instrumentation shared by the managers and storage backends
+METRICS = Instrumentation()
+
+enable = METRICS.enable
+disable = METRICS.disable
+reset = METRICS.reset
+stats = METRICS.stats
+
+
+def call_collecting(f, *args):
+    """
+    Call a function in a worker process with the counters and timings
+    of the process cleared and enabled, and get them with its result,
+    to be merged into those of the parent process with METRICS.merge.
+    It should not be called in a thread of the parent process, whose
+    counters and timings it would clear.
+
+    :param f: the function
+    :param args: the arguments of the function
+    :return : the result and the snapshot of the counters and timings
+    :rtype: tuple
+    """
+    enabled, hook = METRICS.enabled, METRICS.hook
+    METRICS.reset()
+    METRICS.enable()
+    try:
+        result = f(*args)
+        return result, METRICS.stats()
+    finally:
+        METRICS.enabled, METRICS.hook = enabled, hook
+        METRICS.reset()
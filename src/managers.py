@@ -1,10 +1,29 @@
 #!/usr/bin/env python3
 
 
-import os
+import asyncio
+import datetime
+import functools
+import heapq
 import json
+import os
 
-from threads.thread import Thread
+from instrumentation import METRICS
+from threads.thread import Thread, LazyThread
+from threads.task import Task
+from threads.conflicts import find_conflicts
+from threads.index import TaskIndex
+from threads.ranking import Ranking
+from storage.backend import StorageBackend, JSONBackend
+from storage.locking import locked, atomic_write
+from timemap.adherence import Adherence
+from timemap.capacity import CapacityTree
+from timemap.gaps import GapIndex
+from timemap.runs import RunIndex
+from timemap.slots import SlotCalendar
+from timemap.time import AllocatedTimeChunk
+from timemap.util import Datetime, Timedelta, DatetimeCodec, read_codec, \
+    use_codec
 
 __author__ = "Dibyo Majumdar"
 __email__ = "dibyo.majumdar@gmail.com"
@@ -12,7 +31,8 @@ __email__ = "dibyo.majumdar@gmail.com"
 
 __all__ = [
     'TimeManager',
-    'TaskManager'
+    'TaskManager',
+    'AsyncTaskManager'
 ]
 
 # ROOT_DIRECTORY
@@ -25,7 +45,7 @@ class TimeManager():
     different tasks and loading and storing time mappings when the
     program is started or stopped respectively.
 
-    Currently, time mappings are stored as JSON in files with the
+    By default, time mappings are stored as JSON in files with the
     following directory and file structure:
     - ROOT_DIRECTORY/timemap/future/planned.json: stores time maps for
       times chunks in the future/present.
@@ -33,15 +53,450 @@ class TimeManager():
       of time chunks to tasks in the past.
     - ROOT_DIRECTORY/timemap/past/actual.json: stores actual mappings
       of time chunks to tasks in the past.
+    Any other storage.backend.StorageBackend can be given instead.
+
+    Datetimes are written with the codec selected for the data
+    directory of the backend (see timemap.util.read_codec) unless one
+    is given.
+
+    >>> import tempfile
+    >>> from timemap.util import CODECS, write_codec
+    >>> root = tempfile.mkdtemp()
+    >>> write_codec(root, CODECS['epoch'])
+    >>> TimeManager(backend=JSONBackend(root)).codec.name
+    'epoch'
+
+    The time spent in each operation is collected by
+    instrumentation.METRICS while it is enabled.
+
+    >>> import instrumentation
+    >>> instrumentation.enable()
+    >>> time_manager = TimeManager(backend=JSONBackend(root))
+    >>> time_manager.load()
+    >>> _ = time_manager.save()
+    >>> sorted(name for name in instrumentation.stats()['timings']
+    ...        if name.startswith('time_manager.'))
+    ['time_manager.load', 'time_manager.save']
+    >>> instrumentation.disable()
+    >>> instrumentation.reset()
+
+    Several processes can share the time maps.  A time map which has
+    been saved by another process since it was loaded is not
+    overwritten, and is reported as a conflict by save.  Only the time
+    maps which have changed since they were loaded or last saved are
+    written (see timemap.index.IntervalIndex.dirty): the planned time
+    map is marked dirty as its chunks are added, removed, allocated or
+    released, and the past time maps as chunks are added to or removed
+    from them.
+
+    >>> time_manager = TimeManager(backend=JSONBackend(tempfile.mkdtemp()))
+    >>> start = Datetime(2015, 1, 12, 9)
+    >>> time_manager.add_free_chunks(start, start + Timedelta.HOUR)
+    >>> time_manager.save()
+    {'saved': ['future/planned'], 'conflicts': []}
+    >>> time_manager.past_actual.add(AllocatedTimeChunk(start))
+    >>> time_manager.save()
+    {'saved': ['past/actual'], 'conflicts': []}
+    >>> time_manager.chunk_at(start).set_task_allocated('task', 0)
+    >>> time_manager.save()
+    {'saved': ['future/planned'], 'conflicts': []}
+    >>> time_manager.save()
+    {'saved': [], 'conflicts': []}
+
+    The free time in the planned time map is kept in a gap index (see
+    timemap.gaps.GapIndex), which is updated as chunks are added,
+    removed, allocated or released, so that find_free and gaps do not
+    scan every chunk.
+
+    Time maps are kept as runs (see timemap.runs.RunIndex): consecutive
+    time chunks with the same allocation and key are merged into one,
+    and are split and merged again by allocate and release.  Code which
+    allocates time one chunk at a time, such as the scheduler, splits
+    the runs in the time range it works on with split_chunks first.
+
+    The free, allocated and per-thread time in the planned time map can
+    also be kept in a capacity tree (see timemap.capacity.CapacityTree),
+    started by track_capacity, for the rollups of planning views.  The
+    allocations can likewise be kept in a slot calendar (see
+    timemap.slots.SlotCalendar), started by track_slots, whose bitmap
+    answers free time queries over long ranges.  The time manager
+    observes the planned time chunks and passes on their changes to the
+    gap index, the capacity tree and the slot calendar.
+
+    >>> time_manager = TimeManager(backend=JSONBackend(tempfile.mkdtemp()))
+    >>> time_manager.add_free_chunks(start, start + 2 * Timedelta.HOUR)
+    >>> slots = time_manager.track_slots(start, Timedelta.DAY)
+    >>> time_manager.allocate(start, start + Timedelta.HOUR, 'task', 0)
+    >>> slots.count_free(start, start + 2 * Timedelta.HOUR)
+    4
+    >>> slots.find_free(4) == start + Timedelta.HOUR
+    True
+    >>> time_manager.release(start, start + Timedelta.HOUR, 0)
+    >>> slots.count_free(start, start + 2 * Timedelta.HOUR)
+    8
+
+    How closely the plan was followed is found by update_adherence,
+    which compares the past planned and actual time maps (see
+    timemap.adherence.Adherence).
     """
-    def __init__(self):
-        pass
+    def __init__(self,
+                 codec: DatetimeCodec=None,
+                 backend: StorageBackend=None):
+        """
+        :param codec: the codec used to write datetimes
+        :param backend: the backend storing the time maps, in place of
+            the default JSON files
+        """
+        self.backend = backend or JSONBackend(ROOT_DIRECTORY)
+        self.codec = codec or read_codec(self.backend.root)
+
+        self.planned = RunIndex()
+        self.past_planned = RunIndex()
+        self.past_actual = RunIndex()
+        self.free = GapIndex()
+        self.capacity = None
+        self.slots = None
 
+    @METRICS.timed('time_manager.load')
     def load(self):
-        pass
+        """
+        Load all time maps from storage.
+        """
+        self.planned = self.backend.load_timemap('future/planned')
+        self.free = GapIndex.from_chunks(self.planned, self)
+        if self.capacity is not None:
+            self.track_capacity(self.capacity.start_time,
+                                self.capacity.end_time -
+                                self.capacity.start_time,
+                                self.capacity.slot_duration,
+                                self.capacity.thread_of)
+        if self.slots is not None:
+            self.track_slots(self.slots.start_time,
+                             self.slots.end_time - self.slots.start_time,
+                             self.slots.slot_duration)
+        self.past_planned = self.backend.load_timemap('past/planned')
+        self.past_actual = self.backend.load_timemap('past/actual')
+        for timemap in (self.planned, self.past_planned, self.past_actual):
+            timemap.mark_clean()
 
+    @METRICS.timed('time_manager.save')
     def save(self):
-        pass
+        """
+        Save the time maps which have changed to storage.  Time maps in
+        conflict are left dirty.
+
+        :return : the names of the time maps saved and of those in
+            conflict
+        :rtype: dict
+        """
+        saved = []
+        conflicts = []
+        with use_codec(self.codec):
+            for name, timemap in (('future/planned', self.planned),
+                                  ('past/planned', self.past_planned),
+                                  ('past/actual', self.past_actual)):
+                if not timemap.dirty:
+                    continue
+                if self.backend.save_timemap(name, timemap):
+                    timemap.mark_clean()
+                    saved.append(name)
+                else:
+                    conflicts.append(name)
+        METRICS.count('conflicts', len(conflicts))
+        return {'saved': saved, 'conflicts': conflicts}
+
+    @METRICS.timed('time_manager.update_adherence')
+    def update_adherence(self,
+                         file_path: str=None,
+                         until: Datetime=None,
+                         thread_of=None):
+        """
+        Update the adherence rollups stored in file_path with the past
+        time up to until, streaming the past planned and actual time
+        maps from storage from where the last update stopped.
+
+        :param file_path: the path to the file storing the rollups
+            (defaults to timemap/past/adherence.json in the data
+            directory of the backend, or in ROOT_DIRECTORY if it has
+            none)
+        :param until: the end of the time added (defaults to the start
+            of the current day)
+        :param thread_of: function getting the name of the thread of a
+            task from its uid, such as TaskManager.thread_of
+        :return : the adherence rollups
+        :rtype: Adherence
+        """
+        if file_path is None:
+            file_path = os.path.join(self.backend.root or ROOT_DIRECTORY,
+                                     'timemap', 'past', 'adherence.json')
+        if until is None:
+            until = Datetime.now(datetime.timezone.utc).replace(
+                hour=0, minute=0, second=0, microsecond=0)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with locked(file_path):
+            if os.path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    adherence = Adherence.from_json(json.load(f), thread_of)
+            else:
+                adherence = Adherence(thread_of)
+
+            with use_codec(self.codec):
+                adherence.update(
+                    self.backend.iter_timemap('past/planned',
+                                              adherence.through, until),
+                    self.backend.iter_timemap('past/actual',
+                                              adherence.through, until),
+                    until)
+                atomic_write(file_path, json.dumps(adherence.to_json()))
+        return adherence
+
+    def add_chunk(self, chunk: AllocatedTimeChunk):
+        """
+        Add a time chunk to the planned time map.
+
+        :param chunk: the time chunk to be added
+        """
+        self.planned.add(chunk)
+        self.free.track(chunk, self)
+        if self.capacity is not None:
+            self.capacity.track(chunk, self)
+        if self.slots is not None:
+            self._mark_slots(chunk)
+
+    def remove_chunk(self, chunk: AllocatedTimeChunk):
+        """
+        Remove a time chunk from the planned time map.
+
+        :param chunk: the time chunk to be removed
+        """
+        if self.planned.at(chunk.start_time) is chunk:
+            self.planned.remove(chunk)
+            self.free.untrack(chunk)
+            if self.capacity is not None:
+                self.capacity.untrack(chunk)
+            if self.slots is not None and chunk.get_task_allocated():
+                self.slots.clear(chunk.start_time, chunk.end_time)
+
+    def chunk_changed(self,
+                      chunk: AllocatedTimeChunk,
+                      previous: str or None):
+        """
+        Pass on the allocation or release of a planned time chunk to
+        the gap index, the capacity tree and the slot calendar.
+
+        :param chunk: the time chunk
+        :param previous: the task it was allocated to before
+        """
+        self.planned.dirty = True
+        self.free.chunk_changed(chunk, previous)
+        if self.capacity is not None:
+            self.capacity.chunk_changed(chunk, previous)
+        if self.slots is not None:
+            self._mark_slots(chunk)
+
+    def track_capacity(self,
+                       start_time: Datetime,
+                       span: Timedelta,
+                       slot_duration: Timedelta=Timedelta(minutes=15),
+                       thread_of=None):
+        """
+        Start keeping the free, allocated and per-thread time in the
+        planned time map in a capacity tree, rebuilt whenever the time
+        maps are loaded.
+
+        :param start_time: the start of the time covered
+        :param span: the length of the time covered
+        :param slot_duration: the duration of each slot of the tree
+        :param thread_of: function getting the name of the thread of a
+            task from its uid, such as TaskManager.thread_of
+        :return : the capacity tree
+        :rtype: CapacityTree
+        """
+        self.capacity = CapacityTree.from_chunks(self.planned, start_time,
+                                                 span, slot_duration,
+                                                 thread_of, self)
+        return self.capacity
+
+    def _mark_slots(self, chunk: AllocatedTimeChunk):
+        """
+        Mark the slots of a planned time chunk as allocated to its task
+        in the slot calendar, or free them if it is not allocated.
+        """
+        task_allocated = chunk.get_task_allocated()
+        if task_allocated:
+            self.slots.mark(chunk.start_time, chunk.end_time,
+                            task_allocated, chunk.get_key())
+        else:
+            self.slots.clear(chunk.start_time, chunk.end_time)
+
+    def track_slots(self,
+                    start_time: Datetime,
+                    span: Timedelta,
+                    slot_duration: Timedelta=Timedelta(minutes=15)):
+        """
+        Start keeping the allocations of the planned time map in a slot
+        calendar, rebuilt whenever the time maps are loaded.  The
+        planned time chunks should be aligned to the slots, as those
+        added by add_free_chunks with the same duration are, since a
+        slot touched by a chunk is allocated or freed as a whole.
+
+        :param start_time: the start time of the first slot
+        :param span: the length of the time covered
+        :param slot_duration: the duration of each slot
+        :return : the slot calendar
+        :rtype: SlotCalendar
+        """
+        self.slots = SlotCalendar(start_time, span, slot_duration)
+        for chunk in self.planned.overlapping(self.slots.start_time,
+                                              self.slots.end_time):
+            if chunk.get_task_allocated():
+                self._mark_slots(chunk)
+        return self.slots
+
+    def allocate(self,
+                 start_time: Datetime,
+                 end_time: Datetime,
+                 task_allocated: str,
+                 key: int or None):
+        """
+        Allocate the planned time between start_time and end_time to a
+        task, splitting and merging runs as needed.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param task_allocated: the uid of the task to allocate to
+        :param key: the key to the time
+        """
+        self.planned.allocate(start_time, end_time, task_allocated, key)
+
+    def allocate_many(self,
+                      ranges: list,
+                      key: int or None):
+        """
+        Allocate many ranges of planned time at once, splitting and
+        merging runs in a single pass (see RunIndex.allocate_many).
+
+        :param ranges: (start_time, end_time, task_allocated) triples,
+            in order and not overlapping, task_allocated being None to
+            release the time
+        :param key: the key to the time
+        """
+        self.planned.allocate_many(ranges, key)
+
+    def release(self,
+                start_time: Datetime,
+                end_time: Datetime,
+                key: int or None):
+        """
+        Release the planned time between start_time and end_time,
+        splitting and merging runs as needed.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param key: the key to the time
+        """
+        self.planned.release(start_time, end_time, key)
+
+    def split_chunks(self,
+                     start_time: Datetime,
+                     end_time: Datetime,
+                     duration: Timedelta=Timedelta(minutes=15)):
+        """
+        Split the planned runs overlapping a time range into time
+        chunks of a duration.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param duration: the duration of each time chunk
+        """
+        self.planned.split_chunks(start_time, end_time, duration)
+
+    def chunk_at(self, time: Datetime):
+        """
+        Get the planned time chunk containing a point in time, or None
+        if there is none.
+
+        :param time: the point in time
+        """
+        return self.planned.at(time)
+
+    def chunks_overlapping(self,
+                           start_time: Datetime,
+                           end_time: Datetime):
+        """
+        Get the planned time chunks overlapping a time range.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        return self.planned.overlapping(start_time, end_time)
+
+    def chunks_within(self,
+                      start_time: Datetime,
+                      end_time: Datetime):
+        """
+        Get the planned time chunks lying completely within a time
+        range.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        return self.planned.within(start_time, end_time)
+
+    def gaps(self,
+             after: Datetime=None,
+             before: Datetime=None):
+        """
+        Lazily get the ranges of consecutive unallocated planned time
+        chunks, in order, clipped to a time range, as (start_time,
+        end_time) pairs.
+
+        :param after: the start of the time range
+        :param before: the end of the time range
+        """
+        return self.free.gaps(after, before)
+
+    def find_free(self,
+                  duration: Timedelta,
+                  after: Datetime=None,
+                  before: Datetime=None,
+                  count: int=1):
+        """
+        Find the start times of the first count non-overlapping ranges
+        of unallocated planned time of a duration within a time range.
+
+        :param duration: the duration of free time required
+        :param after: the start of the time range
+        :param before: the end of the time range
+        :param count: the number of free time ranges to find
+        :return : the start times, earliest first
+        :rtype: list
+        """
+        return self.free.find_free(duration, after, before, count)
+
+    def add_free_chunks(self,
+                        start_time: Datetime,
+                        end_time: Datetime,
+                        duration: Timedelta=Timedelta(minutes=15)):
+        """
+        Fill the gaps in the planned time map between start_time and
+        end_time with unallocated time chunks of the given duration,
+        merged into runs with each other and the free time around them.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param duration: the duration of each new time chunk
+        """
+        time = start_time
+        for chunk in self.planned.overlapping(start_time, end_time) + [None]:
+            gap_end = end_time if chunk is None else chunk.start_time
+            while time + duration <= gap_end:
+                self.add_chunk(AllocatedTimeChunk(time, duration))
+                time += duration
+            if chunk is not None:
+                time = max(time, chunk.end_time)
+        self.planned.coalesce(start_time, end_time)
 
 
 class TaskManager():
@@ -52,7 +507,7 @@ class TaskManager():
     as which tasks have been completed, which tasks have deadlines or
     start times that have passed and which are still left to do.
 
-    Currently, task states are stored as JSON in files with the
+    By default, task states are stored as JSON in files with the
     following directory and file structure:
     - ROOT_DIRECTORY/threads/future/{thread_name}.json: stores tasks
       belonging to thread with name {thread_name} which can be
@@ -60,115 +515,968 @@ class TaskManager():
     - ROOT_DIRECTORY/threads/past/{thread_name}.json: stores tasks
       belonging to thread with name {thread_name} which should have
       been completed at a past time or has already been completed.
+    In journal mode, past tasks are instead appended to
+    ROOT_DIRECTORY/threads/past/{thread_name}.journal, which is folded
+    into {thread_name}.json by compact_state (see
+    storage.journal.ThreadJournal).  Any other
+    storage.backend.StorageBackend, such as
+    storage.sqlite.SQLiteBackend, can be given instead.
+
+    Datetimes are written with the codec selected for the data
+    directory of the backend (see timemap.util.read_codec) unless one
+    is given.
+
+    The time spent in each operation and the files, bytes and tasks it
+    reads and writes are collected by instrumentation.METRICS while it
+    is enabled.
+
+    >>> import instrumentation
+    >>> import tempfile
+    >>> instrumentation.enable()
+    >>> backend = JSONBackend(tempfile.mkdtemp())
+    >>> for directory in (backend.dir_past, backend.dir_future):
+    ...     os.makedirs(directory)
+    >>> task_manager = TaskManager(backend=backend)
+    >>> task_manager.load_state()
+    >>> thread = Thread('work', 5)
+    >>> thread.add_task(Task('write'))
+    >>> task_manager.threads = [thread]
+    >>> _ = task_manager.refresh_state()
+    >>> snapshot = instrumentation.stats()
+    >>> [snapshot['timings'][name]['count']
+    ...  for name in ('task_manager.load_state', 'task_manager.refresh_state')]
+    [1, 1]
+    >>> snapshot['counters']['tasks_encoded']
+    1
+    >>> instrumentation.disable()
+    >>> instrumentation.reset()
+
+    Tasks which are not done are kept in an expiry index, a min-heap
+    keyed on their end times, so that refresh_state only needs to pop
+    the tasks which have expired since the last refresh rather than
+    check every task.  Threads which have changed are checked again
+    for completed tasks and new or moved end times.
+
+    Several processes can share storage.  A thread which has been
+    saved by another process since it was loaded is not overwritten:
+    its name is reported as a conflict and it is left changed, to be
+    saved once load_state has been called again and the changes made
+    once more.
+
+    The tasks of all threads are indexed by uid in tasks, and by
+    thread, type, completion, end time and deadline in index, which is
+    kept up to date as tasks are added and changed (see
+    threads.index.TaskIndex).  query starts a query over them, and
+    rank gets the most urgent pending tasks from a ranking kept up to
+    date with the index (see threads.ranking.Ranking).  A ranking by
+    another scoring function can be set as ranking.
+    find_conflicts finds the events which take place at once.
     """
 
-    def __init__(self):
+    def __init__(self,
+                 journal: bool=False,
+                 codec: DatetimeCodec=None,
+                 backend: StorageBackend=None):
+        """
+        :param journal: whether past tasks are appended to journals
+            rather than merged into the past thread files
+        :param codec: the codec used to write datetimes
+        :param backend: the backend storing the tasks, in place of the
+            default JSON files
+        """
         self.threads = []
-        self.tasks = {}
+        self.index = TaskIndex()
+        # uid: task
+        self.tasks = self.index.tasks
+        self.ranking = None
+        self.backend = backend or JSONBackend(ROOT_DIRECTORY, journal)
+        self.codec = codec or read_codec(self.backend.root)
+        self._archived = set()
 
-        self.dir_past = os.path.join(ROOT_DIRECTORY, 'threads', 'past')
-        self.dir_future = os.path.join(ROOT_DIRECTORY, 'threads', 'future')
+        self._expiry = []
+        self._expiry_times = {}
+        self._indexed = set()
+        self._lazy = set()
+        self._counter = 0
 
-    def _filter_tasks(self):
+    @METRICS.timed('filter')
+    def _filter_tasks(self,
+                      now: Datetime,
+                      threads: list):
         """
         Filter tasks in threads into past and future threads in
-        preparation for a save and/or refresh of task states.
+        preparation for a save of task states.
 
+        :param now: the current time
+        :param threads: the threads to be filtered
         :return : threads_past, threads_future
         :rtype: tuple
         """
         threads_past = []
         threads_future = []
 
-        for thread in self.threads:
+        for thread in threads:
             thread_past = Thread(thread.name,
                                  thread.default_importance)
             thread_future = Thread(thread.name,
                                    thread.default_importance)
 
             for task in thread.tasks:
-                if task.is_done():
+                if task.is_done(now):
                     thread_past.add_task(task)
                 else:
                     thread_future.add_task(task)
 
-            threads_past.append(threads_past)
-            threads_future.append(threads_future)
+            threads_past.append(thread_past)
+            threads_future.append(thread_future)
 
         return threads_past, threads_future
 
-    @staticmethod
-    def _append_to_thread_file(file_path: str,
-                               thread: Thread):
+    @METRICS.timed('filter')
+    def _index_thread(self,
+                      thread: Thread,
+                      now: Datetime):
         """
-        Append tasks in a thread to an existing thread on file
+        Add the tasks of a thread which are not done to the expiry
+        index and get those which are.  Tasks already in the index with
+        the same end time are not added again.
 
-        :param file_path: the path to the thread file
-        :param thread: the thread to be stored
+        :param thread: the thread
+        :param now: the current time
+        :return : the tasks of the thread which are done
+        :rtype: list
         """
-        with open(file_path, 'r+') as f:
-            old_thread = Thread.from_json(json.load(f))
-            old_thread |= thread
+        done = []
+        for task in thread.tasks:
+            if task.is_done(now):
+                self._expiry_times.pop(task, None)
+                done.append(task)
+                continue
 
-            f.seek(0)
-            f.truncate()
-            json.dump(old_thread.to_json(), f)
+            expiry_time = task.end_timestamp
+            if expiry_time is None:
+                continue
+            if self._expiry_times.get(task) != expiry_time:
+                self._expiry_times[task] = expiry_time
+                heapq.heappush(self._expiry,
+                               (expiry_time, self._counter, task, thread))
+                self._counter += 1
 
-    @staticmethod
-    def _overwrite_thread_file(file_path: str,
-                               thread: Thread):
+        self._indexed.add(thread)
+        return done
+
+    def _index_lazy_thread(self,
+                           thread: LazyThread,
+                           now: Datetime):
         """
-        Write out thread on file overwriting if necessary
+        Add a lazy thread whose tasks have not been decoded to the
+        expiry index under the earliest end time of its tasks, read
+        without decoding them.  Its tasks are decoded, and indexed one
+        by one, once that time has passed.  A thread with tasks which
+        are already done is not added.
 
-        :param file_path: the path to the thread file
-        :param thread: the thread to be stored
+        :param thread: the thread
+        :param now: the current time
         """
-        with open(file_path, 'w') as f:
-            json.dump(thread.to_json(), f)
+        earliest = None
+        for end_time, completed in thread.iter_end_times():
+            if completed or end_time is not None and end_time < now:
+                return
+            if end_time is not None and \
+                    (earliest is None or end_time < earliest):
+                earliest = end_time
 
-    @staticmethod
-    def _read_thread_file(file_path: str):
+        if earliest is not None:
+            heapq.heappush(self._expiry, (earliest.timestamp(),
+                                          self._counter, None, thread))
+            self._counter += 1
+        self._indexed.add(thread)
+        self._lazy.add(thread)
+
+    @METRICS.timed('filter')
+    def _pop_expired(self, now: Datetime):
+        """
+        Pop the tasks whose end times have passed from the expiry
+        index.  Entries left behind by tasks which have since been
+        moved, or whose end times have changed, are discarded.  Lazy
+        threads added by their earliest end time are popped with None
+        in place of a task.
+
+        :param now: the current time
+        :return : (thread, task) pairs of the expired tasks
+        :rtype: list
+        """
+        expired = []
+        now = now.timestamp()
+        while self._expiry and self._expiry[0][0] < now:
+            expiry_time, _, task, thread = heapq.heappop(self._expiry)
+            if task is None:
+                if thread in self._lazy:
+                    expired.append((thread, None))
+            elif self._expiry_times.get(task) == expiry_time and \
+                    thread in self._indexed:
+                del self._expiry_times[task]
+                expired.append((thread, task))
+        return expired
+
+    def _save_threads(self, threads: list):
         """
-        Read in thread from file
+        Save the past and future parts of threads.  Past tasks which
+        have already been saved and have not changed since are left out.
 
-        :param file_path: the path to the thread file
+        :param threads: (thread_past, thread_future) pairs
+        :return : the number of files and bytes written and the names
+            of the threads in conflict
+        :rtype: dict
         """
-        with open(file_path, 'r') as f:
-            return Thread.from_json(json.load(f))
+        for thread_past, _ in threads:
+            thread_past.tasks = [task for task in thread_past.tasks
+                                 if task.dirty or
+                                 task.uid not in self._archived]
+
+        with use_codec(self.codec):
+            report = self.backend.save_threads(threads)
+        METRICS.count('files_written', report['files'])
+        METRICS.count('bytes_written', report['bytes'])
+        METRICS.count('conflicts', len(report['conflicts']))
 
-    def save_state(self):
+        # The past tasks of threads in conflict were not written
+        conflicts = set(report['conflicts'])
+        for thread_past, thread_future in threads:
+            if thread_future.name not in conflicts:
+                self._archived.update(task.uid for task in thread_past.tasks)
+        return report
+
+    @METRICS.timed('task_manager.save_state')
+    def save_state(self, now: Datetime=None):
         """
-        Save all tasks to file,  Tasks are encoded in JSON and stored
-        in file according to scheme presented in the class description.
+        Save all tasks to storage.  Only threads which have changed, or
+        which have tasks which are now done, are written.  Lazy threads
+        whose tasks have not been decoded cannot have changed, and are
+        skipped without decoding them; their tasks which are done are
+        moved once they have been decoded.
+
+        >>> import tempfile
+        >>> from threads.task import Task
+        >>> backend = JSONBackend(tempfile.mkdtemp(), lazy=True)
+        >>> for directory in (backend.dir_past, backend.dir_future):
+        ...     os.makedirs(directory)
+        >>> task_manager = TaskManager(backend=backend)
+        >>> thread = Thread('work', 5)
+        >>> thread.add_task(Task('write'))
+        >>> task_manager.threads = [thread]
+        >>> task_manager.save_state()['files']
+        1
+        >>> task_manager.threads = backend.load_threads()
+        >>> task_manager.save_state()['files']
+        0
+        >>> task_manager.threads[0].is_loaded()
+        False
+
+        :param now: the current time (defaults to now)
+        :return : the number of files and bytes written and the names
+            of the threads in conflict
+        :rtype: dict
         """
-        threads_past, threads_future = self._filter_tasks()
+        if now is None:
+            now = Datetime.now(datetime.timezone.utc)
+        # Lazy threads whose tasks have not been decoded have not changed
+        threads = [thread for thread in self.threads
+                   if not isinstance(thread, LazyThread) or
+                   thread.is_loaded() or thread.is_dirty()]
+        threads_past, threads_future = self._filter_tasks(now, threads)
+
+        changed = []
+        to_save = []
+        for thread, thread_past, thread_future in zip(threads,
+                                                      threads_past,
+                                                      threads_future):
+            if not thread.is_dirty() and \
+                    all(task.uid in self._archived
+                        for task in thread_past.tasks):
+                continue
+            changed.append(thread)
+            to_save.append((thread_past, thread_future))
 
-        for thread in threads_past:
-            file_path = os.path.join(self.dir_past,
-                                     "{0}.json".format(thread.name))
-            self._append_to_thread_file(file_path, thread)
+        report = self._save_threads(to_save)
+        conflicts = set(report['conflicts'])
+        for thread in changed:
+            if thread.name not in conflicts:
+                thread.mark_clean()
 
-        for thread in threads_future:
-            file_path = os.path.join(self.dir_future,
-                                     "{0}.json".format(thread.name))
-            self._overwrite_thread_file(file_path, thread)
+        return report
 
+    @METRICS.timed('task_manager.load_state')
     def load_state(self):
         """
-        Load all tasks from file.  Tasks are encoded in JSON and stored
-        in file according to scheme presented in the class description.
+        Load all tasks which are not done from storage.  The tasks of
+        lazily loaded threads are not decoded: they are indexed once
+        they are, such as by the first query.
+
+        >>> import tempfile
+        >>> from threads.task import Task
+        >>> backend = JSONBackend(tempfile.mkdtemp(), lazy=True)
+        >>> for directory in (backend.dir_past, backend.dir_future):
+        ...     os.makedirs(directory)
+        >>> thread = Thread('work', 5)
+        >>> thread.add_task(Task('write'))
+        >>> _ = backend.save_threads([(Thread('work', 5), thread)])
+        >>> task_manager = TaskManager(backend=backend)
+        >>> task_manager.load_state()
+        >>> task_manager.threads[0].is_loaded()
+        False
+        >>> [task.name for task in task_manager.query().thread('work')]
+        ['write']
         """
-        self.threads = []
-        for thread_file in os.listdir(self.dir_future):
-            thread = self._read_thread_file(os.path.join(self.dir_future,
-                                                         thread_file))
-            self.threads.append(thread)
+        self.threads = self.backend.load_threads()
+        METRICS.count('threads_loaded', len(self.threads))
+
+        self._expiry = []
+        self._expiry_times = {}
+        self._indexed = set()
+        self._lazy = set()
+
+        self.index.clear()
+        self._sync_index()
+
+    def _sync_index(self):
+        """
+        Add the threads which have been added to threads since the last
+        sync to the task index, and remove those which have been removed
+        from it.
+        """
+        threads = {id(thread): thread for thread in self.threads}
+        for key, thread in list(self.index.threads.items()):
+            if key not in threads:
+                self.index.remove_thread(thread)
+        for key, thread in threads.items():
+            if key not in self.index.threads:
+                self.index.add_thread(thread)
 
-    def refresh_state(self):
+    def query(self):
         """
-        Refresh all tasks.  This involves saving them to file and
-        loading them back in, in the process, getting rid of tasks that
-        have been completed.
+        Start a query over the tasks of all threads, such as:
+
+            task_manager.query().thread('work').completed(False) \\
+                .ends_between(start, end).all()
+
+        :rtype: threads.index.TaskQuery
+        """
+        self._sync_index()
+        return self.index.query()
+
+    def rank(self,
+             k: int=10,
+             now: Datetime=None):
+        """
+        Get the k most urgent pending tasks.  The ranking is created on
+        the first call, and later calls only score again the tasks which
+        have changed, or whose scores have changed with time, since.
+
+        :param k: the number of tasks
+        :param now: the current time (defaults to now)
+        :return : (task, score) pairs, in order of score
+        :rtype: list
+        """
+        self._sync_index()
+        if self.ranking is None:
+            self.ranking = Ranking(self.index, now=now)
+        else:
+            self.ranking.advance(now)
+        return self.ranking.top(k)
+
+    def find_conflicts(self,
+                       start_time: Datetime,
+                       end_time: Datetime,
+                       across_threads: bool=False):
+        """
+        Find the occurrences of events in all threads which overlap
+        within a window (see threads.conflicts.find_conflicts).  For
+        checking events as they are added or moved, a
+        threads.conflicts.ConflictIndex can listen to index instead.
+
+        :param start_time: the start of the window
+        :param end_time: the end of the window
+        :param across_threads: whether only conflicts between events in
+            different threads are found
+        :return : the conflicts, in order of start time
+        :rtype: list
+        """
+        return find_conflicts(self.threads, start_time, end_time,
+                              across_threads)
+
+    def thread_of(self, uid: str):
+        """
+        Get the name of the thread of a task, or None if there is no
+        task with the uid.
+
+        :param uid: the uid of the task
+        """
+        self._sync_index()
+        return self.index.thread_of(uid)
+
+    @METRICS.timed('task_manager.load_past_thread')
+    def load_past_thread(self, thread_name: str):
+        """
+        Load the past tasks of a thread from storage.
+
+        :param thread_name: the name of the thread
+        """
+        return self.backend.load_past_thread(thread_name)
+
+    def iter_past_tasks(self,
+                        thread_names: list=None,
+                        start_time: Datetime=None,
+                        end_time: Datetime=None):
+        """
+        Lazily load past tasks from storage one at a time, so that the
+        whole history need not be held in memory.  Tasks are filtered
+        on their thread and times before they are created.
+
+        :param thread_names: the names of the threads of the tasks
+            (defaults to all threads)
+        :param start_time: the time after which the tasks end
+        :param end_time: the time before which the tasks start
+        """
+        return self.backend.iter_past_tasks(thread_names, start_time,
+                                            end_time)
+
+    @METRICS.timed('task_manager.compact_state')
+    def compact_state(self):
+        """
+        Compact storage, such as by folding the journals of past
+        threads into their thread files.
+
+        :return : the number of threads compacted
+        :rtype: int
+        """
+        with use_codec(self.codec):
+            return self.backend.compact()
+
+    @METRICS.timed('task_manager.refresh_state')
+    def refresh_state(self, now: Datetime=None):
+        """
+        Refresh all tasks.  This involves moving the tasks which are
+        done out of their threads and into storage for past tasks.  The
+        tasks which are done are found with the expiry index, and only
+        the threads which have changed, or which had tasks moved out,
+        are written.  Lazy threads are only decoded once one of their
+        tasks is done.
+
+        >>> import tempfile
+        >>> from threads.task import Assignment
+        >>> backend = JSONBackend(tempfile.mkdtemp())
+        >>> for directory in (backend.dir_past, backend.dir_future):
+        ...     os.makedirs(directory)
+        >>> task_manager = TaskManager(backend=backend)
+        >>> thread = Thread('work', 5)
+        >>> thread.add_task(Assignment('essay', Timedelta.HOUR))
+        >>> task_manager.threads = [thread]
+        >>> task_manager.refresh_state()['files']
+        1
+        >>> thread.tasks[0].complete()
+        >>> thread.is_dirty()
+        True
+        >>> task_manager.refresh_state()['files']
+        2
+        >>> thread.tasks
+        []
+        >>> [task.name for task in task_manager.load_past_thread('work').tasks]
+        ['essay']
+
+        Tasks are moved once their end times pass, but not by the
+        entries left from before they were rescheduled or completed:
+
+        >>> start = Datetime(2015, 1, 12)
+        >>> thread = Thread('study', 5)
+        >>> for hours, name in enumerate(['read', 'write', 'edit'], 1):
+        ...     thread.add_task(Task(name, start, start + hours * Timedelta.HOUR))
+        >>> task_manager.threads = [thread]
+        >>> _ = task_manager.refresh_state(start)
+        >>> thread.tasks[1].change_time(start, start + 5 * Timedelta.HOUR)
+        >>> thread.tasks[2].complete()
+        >>> _ = task_manager.refresh_state(start + Timedelta(minutes=30))
+        >>> [task.name for task in thread.tasks]
+        ['read', 'write']
+        >>> _ = task_manager.refresh_state(start + 4 * Timedelta.HOUR)
+        >>> [task.name for task in thread.tasks]
+        ['write']
+        >>> _ = task_manager.refresh_state(start + 6 * Timedelta.HOUR)
+        >>> thread.tasks
+        []
+        >>> sorted(task.name
+        ...        for task in task_manager.load_past_thread('study').tasks)
+        ['edit', 'read', 'write']
+
+        The tasks which are done of a thread in conflict are kept, and
+        stay indexed, until it is saved:
+
+        >>> root = tempfile.mkdtemp()
+        >>> backend = JSONBackend(root)
+        >>> for directory in (backend.dir_past, backend.dir_future):
+        ...     os.makedirs(directory)
+        >>> thread = Thread('work', 5)
+        >>> thread.add_task(Task('read', start, start + Timedelta.HOUR))
+        >>> thread.add_task(Task('write', start, start + Timedelta.DAY))
+        >>> _ = backend.save_threads([(Thread('work', 5), thread)])
+        >>> task_manager = TaskManager(backend=backend)
+        >>> other = TaskManager(backend=JSONBackend(root))
+        >>> task_manager.load_state()
+        >>> other.load_state()
+        >>> other.threads[0].add_task(Task('edit'))
+        >>> other.refresh_state(start)['conflicts']
+        []
+        >>> task_manager.refresh_state(start + 2 * Timedelta.HOUR)['conflicts']
+        ['work']
+        >>> sorted(task.name for task in task_manager.query().all())
+        ['read', 'write']
+        >>> [task_manager.thread_of(task.uid)
+        ...  for task in task_manager.threads[0].tasks]
+        ['work', 'work']
+
+        Lazily loaded threads stay undecoded until one of their tasks
+        ends:
+
+        >>> backend = JSONBackend(tempfile.mkdtemp(), lazy=True)
+        >>> for directory in (backend.dir_past, backend.dir_future):
+        ...     os.makedirs(directory)
+        >>> start = Datetime(2015, 1, 12)
+        >>> for days, name in enumerate(['home', 'study', 'travel'], 1):
+        ...     thread = Thread(name, 5)
+        ...     thread.add_task(Task(name, start, start + days * Timedelta.DAY))
+        ...     _ = backend.save_threads([(Thread(name, 5), thread)])
+        >>> task_manager = TaskManager(backend=backend)
+        >>> task_manager.load_state()
+        >>> _ = task_manager.refresh_state(start)
+        >>> [thread.is_loaded() for thread in task_manager.threads]
+        [False, False, False]
+        >>> _ = task_manager.refresh_state(start + 36 * Timedelta.HOUR)
+        >>> [thread.is_loaded() for thread in task_manager.threads]
+        [True, False, False]
+        >>> [len(thread) for thread in task_manager.threads]
+        [0, 1, 1]
+
+        :param now: the current time (defaults to now)
+        :return : the number of files and bytes written and the names
+            of the threads in conflict
+        :rtype: dict
+        """
+        if now is None:
+            now = Datetime.now(datetime.timezone.utc)
+
+        done = {}
+        for thread in self.threads:
+            if thread in self._lazy and thread.is_loaded():
+                # Decoded since it was added: index its tasks instead
+                self._lazy.discard(thread)
+                self._indexed.discard(thread)
+            if thread not in self._indexed and \
+                    isinstance(thread, LazyThread) and \
+                    not thread.is_loaded():
+                self._index_lazy_thread(thread, now)
+
+            if thread in self._lazy:
+                if thread.is_dirty():
+                    done[thread] = []
+            elif thread not in self._indexed or thread.is_dirty():
+                tasks = self._index_thread(thread, now)
+                if tasks or thread.is_dirty():
+                    done[thread] = tasks
+        for thread, task in self._pop_expired(now):
+            if task is None:
+                self._lazy.discard(thread)
+                done.setdefault(thread, []).extend(
+                    self._index_thread(thread, now))
+            else:
+                done.setdefault(thread, []).append(task)
+
+        to_save = []
+        for thread, tasks in done.items():
+            thread_past = Thread(thread.name, thread.default_importance)
+            thread_past.tasks = tasks
+            if tasks:
+                tasks = set(tasks)
+                thread.tasks = [task for task in thread.tasks
+                                if task not in tasks]
+            to_save.append((thread_past, thread))
+
+        report = self._save_threads(to_save)
+        conflicts = set(report['conflicts'])
+        for thread, tasks in done.items():
+            if thread.name not in conflicts:
+                for task in tasks:
+                    self.index.remove(task)
+                thread.mark_clean()
+            elif tasks:
+                # Nothing was written for the thread, so its tasks which
+                # are done are kept, to be moved once it is saved
+                thread.tasks = thread.tasks + tasks
+                thread.dirty = True
+
+        return report
+
+
+class AsyncTaskManager():
+    """
+    Asyncio facade over a TaskManager.  Loading, refreshing and saving
+    run in an executor so that file I/O and JSON encoding do not block
+    the event loop.
+
+    Changes to tasks are buffered in memory, rather than made on the
+    tasks directly, and are written behind by a background flusher
+    every flush_interval seconds, or as soon as flush_threshold tasks
+    have changes buffered.  Repeated changes to the same task are
+    coalesced into one.  Buffered changes are only applied to the tasks
+    of the task manager, on the event loop, when they are flushed, so
+    that the tasks never change while they are being saved in the
+    executor.  flush is the barrier to await before shutting down.
+
+    Changes are checked when they are buffered, so that invalid ones
+    are raised to the caller rather than by a later flush.  A change
+    which still fails when it is applied does not stop the others from
+    being applied and saved: the first error is raised by the flush, or
+    kept and raised by the next call to flush or close if the flush ran
+    in the background.
+
+    >>> import tempfile
+    >>> backend = JSONBackend(tempfile.mkdtemp())
+    >>> for directory in (backend.dir_past, backend.dir_future):
+    ...     os.makedirs(directory)
+    >>> async def run():
+    ...     manager = AsyncTaskManager(TaskManager(backend=backend),
+    ...                                flush_threshold=2)
+    ...     task = Task('write')
+    ...     manager.add_task('work', task, 5)
+    ...     manager.update_task(task, importance=8)
+    ...     manager.update_task(task, name='draft')
+    ...     print(manager.pending())
+    ...     try:
+    ...         manager.update_task(task, importance=11)
+    ...     except Exception as e:
+    ...         print(e)
+    ...     manager.start()
+    ...     manager.add_task('work', Task('review'))
+    ...     await asyncio.sleep(0.1)
+    ...     print(manager.pending(), len(backend.load_threads()[0]))
+    ...     manager.update_task(task, start_time=Datetime(2030, 1, 2))
+    ...     manager.add_task('work', Task('plan'))
+    ...     task.end_time = Datetime(2030, 1, 1)
+    ...     try:
+    ...         await manager.close()
+    ...     except Exception as e:
+    ...         print(e)
+    ...     return sorted((task.name, task.importance) for task in
+    ...                   backend.load_threads()[0].tasks)
+    >>> asyncio.run(run())
+    1
+    Invalid importance for task. 
+    0 2
+    Invalid time range for task. 
+    [('draft', 8), ('plan', 5), ('review', 5)]
+    """
+
+    def __init__(self,
+                 task_manager: TaskManager=None,
+                 flush_interval: float=5.0,
+                 flush_threshold: int=100,
+                 executor=None):
+        """
+        :param task_manager: the task manager whose tasks are managed
+        :param flush_interval: the seconds between background flushes
+        :param flush_threshold: the number of tasks with buffered
+            changes which triggers a flush
+        :param executor: the executor loading and saving tasks
+            (defaults to the default executor of the event loop)
+        """
+        self.task_manager = task_manager or TaskManager()
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.executor = executor
+
+        # task: (thread_name or None, changes) of buffered changes
+        self._pending = {}
+        self._lock = None
+        self._wakeup = None
+        self._flusher = None
+        self._stopping = False
+        self.error = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+        return False
+
+    @property
+    def threads(self):
+        """
+        Get the threads of the task manager, as of the last flush.
+        """
+        return self.task_manager.threads
+
+    def _run(self, f, *args, **kwargs):
+        """
+        Run a function in the executor.
+        """
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(f, *args, **kwargs))
+
+    def _get_lock(self):
+        """
+        Get the lock serializing loads, refreshes and flushes, created
+        on first use so that it belongs to the running event loop.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def start(self):
+        """
+        Start the background flusher on the running event loop.
+        """
+        if self._flusher is None:
+            self._stopping = False
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(
+                self._flush_periodically())
+
+    async def close(self):
+        """
+        Stop the background flusher and flush all buffered changes.  A
+        background flush in progress is waited for rather than
+        cancelled.  Errors raised by background flushes are raised once
+        the buffered changes have been saved.
+
+        :return : the report of the final flush
+        :rtype: dict
+        """
+        if self._flusher is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._flusher
+            self._flusher = None
+        return await self.flush()
+
+    async def _flush_periodically(self):
+        """
+        Flush buffered changes every flush_interval seconds, or sooner
+        once flush_threshold tasks have changes buffered.  Errors are
+        kept in error and raised by the next call to flush or close.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self._stopping:
+                return
+            if not self._pending:
+                continue
+            try:
+                await self._flush()
+            except Exception as e:
+                self.error = e
+
+    def pending(self):
+        """
+        Return the number of tasks with buffered changes.
+        """
+        return len(self._pending)
+
+    def _buffer(self,
+                task: Task,
+                thread_name: str or None,
+                changes: dict):
+        """
+        Buffer changes to a task, coalescing them with those already
+        buffered, and wake up the flusher once enough tasks have
+        changes buffered.  The changes are checked against the task and
+        the changes already buffered for it first.
+        """
+        if task in self._pending:
+            old_thread_name, old_changes = self._pending[task]
+            changes = dict(old_changes, **changes)
+            self._check(task, changes)
+            METRICS.count('changes_coalesced')
+            self._pending[task] = (thread_name or old_thread_name, changes)
+        else:
+            self._check(task, changes)
+            self._pending[task] = (thread_name, dict(changes))
+
+        if len(self._pending) >= self.flush_threshold and \
+                self._wakeup is not None:
+            self._wakeup.set()
+
+    @staticmethod
+    def _check(task: Task, changes: dict):
+        """
+        Check that changes to a task can be applied, raising the error
+        which applying them would raise otherwise.
+
+        :param task: the task to be changed
+        :param changes: the new values of the attributes
+        """
+        for name in changes:
+            if name != 'default_importance' and \
+                    (name.startswith('_') or not hasattr(task, name)):
+                raise AttributeError(
+                    "'{0}' object has no attribute '{1}'".format(
+                        type(task).__name__, name))
+
+        if 'importance' in changes and \
+                not 0 <= changes['importance'] <= 10:
+            raise Exception("Invalid importance for task. ")
+
+        if 'start_time' in changes or 'end_time' in changes:
+            start_time = changes.get('start_time', task.start_time)
+            end_time = changes.get('end_time')
+            if start_time is not None and end_time is not None and \
+                    start_time > end_time:
+                raise Exception("Invalid time range for task. ")
+
+    def add_task(self,
+                 thread_name: str,
+                 task: Task,
+                 default_importance: int=0):
+        """
+        Buffer the addition of a task to a thread, creating the thread
+        if there is none with the name.
+
+        :param thread_name: the name of the thread
+        :param task: the task to be added
+        :param default_importance: the default importance of the thread
+            if it is created
+        """
+        self._buffer(task, thread_name,
+                     {'default_importance': default_importance})
+
+    def update_task(self,
+                    task: Task,
+                    **changes):
+        """
+        Buffer changes to the attributes of a task, such as importance,
+        start_time, end_time or completed.  Invalid changes are raised
+        here and are not buffered.
+
+        :param task: the task to be changed
+        :param changes: the new values of the attributes
+        """
+        self._buffer(task, None, changes)
+
+    def _apply(self, pending: dict):
+        """
+        Apply buffered changes to the tasks of the task manager, one
+        task at a time, so that changes which fail do not stop those to
+        other tasks from being applied.
+
+        :param pending: the buffered changes
+        :return : the first error raised, if any
+        """
+        error = None
+        threads = {thread.name: thread for thread in self.threads}
+        for task, (thread_name, changes) in pending.items():
+            try:
+                self._apply_task(threads, task, thread_name, changes)
+            except Exception as e:
+                METRICS.count('changes_failed')
+                if error is None:
+                    error = e
+        return error
+
+    def _apply_task(self,
+                    threads: dict,
+                    task: Task,
+                    thread_name: str or None,
+                    changes: dict):
+        """
+        Apply the buffered changes to one task.
+
+        :param threads: the threads of the task manager, by name
+        :param task: the task to be changed
+        :param thread_name: the name of the thread to add it to, if any
+        :param changes: the new values of the attributes
+        """
+        changes = dict(changes)
+        default_importance = changes.pop('default_importance', 0)
+        if thread_name is not None:
+            thread = threads.get(thread_name)
+            if thread is None:
+                thread = threads[thread_name] = \
+                    Thread(thread_name, default_importance)
+                self.threads.append(thread)
+            if task not in thread.tasks:
+                thread.add_task(task)
+
+        if 'start_time' in changes or 'end_time' in changes:
+            task.change_time(changes.pop('start_time', task.start_time),
+                             changes.pop('end_time', task.end_time))
+        if changes.pop('completed', False):
+            task.complete()
+        for name, value in changes.items():
+            setattr(task, name, value)
+        task.dirty = True
+
+    async def _flush(self, now: Datetime=None):
+        """
+        Apply buffered changes and save the tasks in the executor.  The
+        first error raised by applying the changes is raised once the
+        others have been saved.
+        """
+        async with self._get_lock():
+            pending, self._pending = self._pending, {}
+            error = self._apply(pending)
+            METRICS.count('flushes')
+            report = await self._run(self.task_manager.save_state, now)
+        if error is not None:
+            raise error
+        return report
+
+    async def flush(self, now: Datetime=None):
+        """
+        Apply all buffered changes and save the tasks, waiting until
+        they have been written.  Errors raised by background flushes
+        since the last call are raised once the changes buffered since
+        have been saved.
+
+        :param now: the current time (defaults to now)
+        :return : the number of files and bytes written and the names
+            of the threads in conflict
+        :rtype: dict
+        """
+        report = await self._flush(now)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return report
+
+    async def load_state(self):
+        """
+        Load all tasks which are not done from storage, discarding
+        buffered changes.
+        """
+        async with self._get_lock():
+            self._pending = {}
+            await self._run(self.task_manager.load_state)
+
+    async def refresh_state(self, now: Datetime=None):
+        """
+        Apply all buffered changes and refresh the tasks (see
+        TaskManager.refresh_state).
+
+        :param now: the current time (defaults to now)
+        :return : the number of files and bytes written and the names
+            of the threads in conflict
+        :rtype: dict
         """
-        self.save_state()
-        self.load_state()
\ No newline at end of file
+        async with self._get_lock():
+            pending, self._pending = self._pending, {}
+            error = self._apply(pending)
+            report = await self._run(self.task_manager.refresh_state, now)
+        if error is not None:
+            raise error
+        return report
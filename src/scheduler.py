@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the scheduler which allocates time chunks in the
+time map to tasks.
+
+Module structure:
+- Scheduler
+"""
+
+import bisect
+import datetime
+
+from managers import TaskManager, TimeManager
+from threads.task import Task, Event, Assignment
+from timemap.util import Datetime, Timedelta
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'Scheduler'
+]
+
+
+class Scheduler(object):
+    """
+    Allocate the free time chunks of the planned time map in a
+    TimeManager to the tasks in a TaskManager.
+
+    Events are fixed: every chunk overlapping an event is allocated to
+    it.  Assignments are then placed earliest deadline first, ties being
+    broken by higher importance, into the earliest free chunks before
+    their deadlines.  An assignment is never split into more than
+    max_divisions runs of consecutive chunks, and unless partial
+    completion is useful, it is only allocated time if all of its
+    expected duration fits.
+
+    Time is allocated in chunks of duration, counted from the start of
+    each free run of the planned time map.  Placements are worked out
+    on the free runs themselves rather than on split time chunks, and
+    are then allocated in a single pass (see TimeManager.allocate_many),
+    so the planned time map stays coalesced into runs.
+
+    All time is allocated with the key of the scheduler, so a schedule
+    only ever releases and reallocates time it allocated itself.  The
+    runs allocated to each task are tracked so that when tasks change,
+    only the window of time they affect is re-planned.  Tasks which
+    lose their time to the re-plan are placed again with the changed
+    tasks.
+
+    >>> from threads.thread import Thread
+    >>> start = Datetime(2100, 1, 4, 9)
+    >>> time_manager = TimeManager()
+    >>> time_manager.add_free_chunks(start, start + 4 * Timedelta.HOUR)
+    >>> task_manager = TaskManager()
+    >>> thread = Thread('work', 5)
+    >>> task_manager.threads = [thread]
+    >>> for name, hours in (('a', 1), ('b', 2)):
+    ...     assignment = Assignment(name, Timedelta.HOUR)
+    ...     assignment.change_time(start, start + Timedelta.WEEK)
+    ...     assignment.add_deadline(start + hours * Timedelta.HOUR)
+    ...     thread.add_task(assignment)
+    >>> a, b = thread.tasks
+    >>> scheduler = Scheduler(task_manager, time_manager)
+    >>> allocations = scheduler.schedule(start, start + 4 * Timedelta.HOUR)
+    >>> [[(run.start_time.hour, str(run.duration))
+    ...   for run in allocations[str(task.uid)]] for task in (a, b)]
+    [[(9, '1:00:00')], [(10, '1:00:00')]]
+    >>> len(time_manager.planned)
+    3
+    >>> a.remove_deadline(start + Timedelta.HOUR)
+    >>> a.add_deadline(start + 3 * Timedelta.HOUR)
+    >>> allocations = scheduler.reschedule([a])
+    >>> [allocations[str(task.uid)][0].start_time.hour for task in (b, a)]
+    [9, 10]
+    """
+    def __init__(self,
+                 task_manager: TaskManager,
+                 time_manager: TimeManager,
+                 key: int=0,
+                 duration: Timedelta=Timedelta(minutes=15)):
+        """
+        :param task_manager: the manager of the tasks to be scheduled
+        :param time_manager: the manager of the time to be allocated
+        :param key: the key used to allocate time
+        :param duration: the duration of each time chunk allocated
+        """
+        self.task_manager = task_manager
+        self.time_manager = time_manager
+        self.key = key
+        self.duration = duration
+
+        self.start_time = self.end_time = None
+
+        self.allocations = {}
+        self.tasks = {}
+
+        # The assignments left unscheduled, in the order they are
+        # placed, with the timestamps of their deadlines
+        self._unscheduled = []
+        self._unscheduled_deadlines = []
+
+    @staticmethod
+    def _event_intervals(event: Event,
+                         start_time: Datetime,
+                         end_time: Datetime):
+        """
+        Generate the (start_time, end_time) intervals during which an
+        event takes place that overlap a time range.
+        """
+        for occurrence in event.occurrences(start_time, end_time):
+            yield occurrence.start_time, occurrence.end_time
+
+    @staticmethod
+    def _next_deadline(assignment: Assignment,
+                       now: Datetime):
+        """
+        Get the earliest deadline of an assignment that has not passed,
+        falling back on its end time.
+        """
+        if not assignment.deadline_timestamps:
+            return assignment.end_time
+        return assignment.next_occurrence_after(now) or assignment.end_time
+
+    def _pending_tasks(self, now: Datetime):
+        """
+        Get the events and assignments which are neither completed nor
+        over.
+        """
+        events = []
+        assignments = []
+
+        now = now.timestamp()
+        for thread in self.task_manager.threads:
+            for task in thread.tasks:
+                if task.completed:
+                    continue
+                end_time = task.end_timestamp
+                if end_time is not None and end_time < now:
+                    continue
+
+                if isinstance(task, Event):
+                    events.append(task)
+                elif isinstance(task, Assignment):
+                    if task.expected_duration:
+                        assignments.append(task)
+
+        return events, assignments
+
+    def _release(self,
+                 start_time: Datetime,
+                 end_time: Datetime):
+        """
+        Release all time between start_time and end_time allocated by
+        this scheduler.
+
+        :return : the tasks whose time was released, by uid, including
+            those left with no time
+        :rtype: dict
+        """
+        released = {}
+        ranges = []
+        for chunk in self.time_manager.chunks_overlapping(start_time,
+                                                          end_time):
+            uid = chunk.get_task_allocated()
+            if uid is not None and chunk.get_key() == self.key:
+                ranges.append((max(chunk.start_time, start_time),
+                               min(chunk.end_time, end_time), None))
+                released[uid] = self.tasks.get(uid)
+        self.time_manager.allocate_many(ranges, self.key)
+        self._collect()
+
+        return released
+
+    def _allocate(self, ranges: list):
+        """
+        Allocate time ranges to tasks.
+
+        :param ranges: (start_time, end_time, task) triples, in order
+            and not overlapping
+        """
+        self.time_manager.allocate_many(
+            [(start_time, end_time, str(task.uid))
+             for start_time, end_time, task in ranges], self.key)
+        for _, _, task in ranges:
+            self.tasks[str(task.uid)] = task
+
+    def _collect(self):
+        """
+        Get the runs allocated to each task from the planned time map,
+        as the runs of earlier allocations may since have been split or
+        merged.  Tasks left with no time are dropped.
+        """
+        allocations = {}
+        if self.start_time is not None:
+            for chunk in self.time_manager.chunks_overlapping(
+                    self.start_time, self.end_time):
+                uid = chunk.get_task_allocated()
+                if uid in self.tasks and chunk.get_key() == self.key:
+                    allocations.setdefault(uid, []).append(chunk)
+        self.allocations = allocations
+        self.tasks = {uid: self.tasks[uid] for uid in allocations}
+
+    def _allocated(self, uid: str):
+        """
+        Get the number of seconds and the number of runs of consecutive
+        time already allocated to a task.
+        """
+        chunks = self.allocations.get(uid)
+        if not chunks:
+            return 0, 0
+
+        seconds = 0
+        runs = 0
+        previous_end = None
+        for chunk in chunks:
+            if chunk.start_time != previous_end:
+                runs += 1
+            previous_end = chunk.end_time
+            seconds += chunk.duration.total_seconds()
+        return seconds, runs
+
+    def _align(self,
+               time: Datetime,
+               up: bool=False):
+        """
+        Round a time down, or up, to the nearest start or end of a time
+        chunk counted from the start of the run containing it.
+        """
+        chunk = self.time_manager.chunk_at(
+            time - Timedelta.resolution if up else time)
+        if chunk is None:
+            return time
+        if up:
+            steps = -((chunk.start_time - time) // self.duration)
+            return min(chunk.start_time + steps * self.duration,
+                       chunk.end_time)
+        return chunk.start_time + \
+            (time - chunk.start_time) // self.duration * self.duration
+
+    def _free_ranges(self,
+                     start_time: Datetime,
+                     end_time: Datetime):
+        """
+        Get the free runs of the planned time map between start_time
+        and end_time, trimmed to the time chunks lying within the range.
+
+        :return : the start and end timestamps of the free runs
+        :rtype: tuple
+        """
+        starts = []
+        ends = []
+        for chunk in self.time_manager.chunks_overlapping(start_time,
+                                                          end_time):
+            if chunk.get_task_allocated() is not None:
+                continue
+            lo = max(self._align(start_time, True), chunk.start_time) \
+                if chunk.start_time < start_time else chunk.start_time
+            hi = self._align(end_time) if chunk.end_time > end_time \
+                else chunk.end_time
+            if lo < hi:
+                starts.append(lo.timestamp())
+                ends.append(hi.timestamp())
+        return starts, ends
+
+    def _place_events(self,
+                      events: list,
+                      start_time: Datetime,
+                      end_time: Datetime):
+        """
+        Allocate all free time chunks overlapping events to them.
+        """
+        for event in events:
+            for interval_start, interval_end in self._event_intervals(
+                    event, start_time, end_time):
+                ranges = []
+                for chunk in self.time_manager.chunks_overlapping(
+                        interval_start, interval_end):
+                    if chunk.get_task_allocated() is None:
+                        ranges.append((
+                            self._align(max(chunk.start_time,
+                                            interval_start)),
+                            self._align(min(chunk.end_time, interval_end),
+                                        True),
+                            event))
+                self._allocate(ranges)
+
+    def _deadline(self,
+                  assignment: Assignment,
+                  now: Datetime):
+        """
+        Get the timestamp of the deadline by which an assignment is
+        placed.  The deadlines of non-repeating assignments are compared
+        as the timestamps they are stored as, without creating
+        Datetimes.
+        """
+        if not assignment.repeat:
+            now = now.timestamp()
+            deadlines = [deadline
+                         for deadline in assignment.deadline_timestamps
+                         if deadline > now]
+            if deadlines:
+                return min(deadlines)
+            end_time = assignment.end_timestamp
+            if end_time is not None:
+                return end_time
+            return self.end_time.timestamp()
+
+        deadline = self._next_deadline(assignment, now) or self.end_time
+        return deadline.timestamp()
+
+    @staticmethod
+    def _order(deadlines: list,
+               assignments: list):
+        """
+        Sort assignments and the timestamps of their deadlines earliest
+        deadline first, ties being broken by higher importance and then
+        by the order they were given in.
+
+        The keys are sorted one at a time by stable sorts rather than as
+        tuples, so that no object tracked by the garbage collector is
+        created for each assignment.  With 100k assignments, such tuples
+        are enough to set off a full collection over every task.
+
+        :return : deadlines, assignments
+        :rtype: tuple
+        """
+        order = list(range(len(assignments)))
+        order.sort(key=lambda i: assignments[i].importance, reverse=True)
+        order.sort(key=deadlines.__getitem__)
+        return [deadlines[i] for i in order], \
+            [assignments[i] for i in order]
+
+    def _place_assignments(self,
+                           deadlines: list,
+                           assignments: list,
+                           start_time: Datetime,
+                           end_time: Datetime):
+        """
+        Allocate the free time between start_time and end_time to
+        assignments, earliest deadline first.
+
+        Since assignments are taken in order of deadline and always
+        given the earliest free time, time is consumed from the front
+        of the free runs, and each assignment only looks at the time it
+        might take.  The placements are worked out on timestamps and
+        allocated together at the end.
+
+        :param deadlines: the timestamps of the deadlines of the
+            assignments
+        :param assignments: the assignments
+        :return : the deadlines and the assignments left unscheduled, in
+            order
+        :rtype: tuple
+        """
+        deadlines, assignments = self._order(deadlines, assignments)
+        starts, ends = self._free_ranges(start_time, end_time)
+        if not starts:
+            return deadlines, assignments
+
+        duration = self.duration.total_seconds()
+        placed = []
+        unscheduled = []
+
+        # The free time left starts at time, in the free run first
+        first = 0
+        time = starts[0]
+        n = 0
+        while n < len(deadlines) and first < len(starts):
+            # Assignments due before the first free time chunk ends
+            # cannot be placed
+            skip = bisect.bisect_left(deadlines,
+                                      min(time + duration, ends[first]), n)
+            unscheduled.extend(range(n, skip))
+            n = skip
+            if n == len(deadlines):
+                break
+            n += 1
+            deadline = deadlines[skip]
+            assignment = assignments[skip]
+            allocated, divisions = \
+                self._allocated(str(assignment.uid)) if self.allocations \
+                else (0, 0)
+            remaining = assignment.expected_duration.total_seconds() - \
+                allocated
+            max_divisions = assignment.max_divisions
+            taken = []
+            previous_end = None
+            i = first
+            start = time
+            while i < len(starts) and remaining > 0:
+                end = ends[i]
+                if end > deadline:
+                    # Only whole time chunks ending by the deadline
+                    end = start + (deadline - start) // duration * duration
+                    if end <= start:
+                        break
+                if start != previous_end:
+                    divisions += 1
+                    if 0 < max_divisions < divisions:
+                        break
+                end = min(end, start - remaining // -duration * duration)
+                taken.append((start, end, i))
+                remaining -= end - start
+                previous_end = end
+                if end < ends[i]:
+                    break
+                i += 1
+                if i < len(starts):
+                    start = starts[i]
+
+            if not taken or \
+                    (remaining > 0 and not assignment.partial_completion):
+                unscheduled.append(skip)
+                continue
+
+            placed.extend((start, end, assignment)
+                          for start, end, _ in taken)
+            _, time, first = taken[-1]
+            if time == ends[first]:
+                first += 1
+                if first < len(starts):
+                    time = starts[first]
+        unscheduled.extend(range(n, len(deadlines)))
+
+        self._allocate([(Datetime.fromtimestamp(start, datetime.timezone.utc),
+                         Datetime.fromtimestamp(end, datetime.timezone.utc),
+                         assignment)
+                        for start, end, assignment in placed])
+        return [deadlines[n] for n in unscheduled], \
+            [assignments[n] for n in unscheduled]
+
+    def _is_pending(self,
+                    task: Task,
+                    now: Datetime):
+        """
+        Return if a task is neither completed nor over.
+        """
+        if task.completed:
+            return False
+        return task.end_time is None or task.end_time >= now
+
+    def schedule(self,
+                 start_time: Datetime=None,
+                 end_time: Datetime=None,
+                 now: Datetime=None):
+        """
+        Schedule all pending tasks into the planned time map between
+        start_time and end_time, replacing any allocations previously
+        made by this scheduler in that range.
+
+        :param start_time: the start of the range (defaults to now)
+        :param end_time: the end of the range (defaults to 90 days
+            after start_time)
+        :param now: the current time, if already known
+        :return : the chunks allocated to each task by uid
+        :rtype: dict
+        """
+        if now is None:
+            now = Datetime.now(datetime.timezone.utc)
+        if start_time is None:
+            start_time = now
+        if end_time is None:
+            end_time = start_time + 90 * Timedelta.DAY
+        self.start_time = start_time
+        self.end_time = end_time
+
+        self._release(start_time, end_time)
+
+        events, assignments = self._pending_tasks(now)
+        self._place_events(events, start_time, end_time)
+
+        deadlines = [self._deadline(assignment, now)
+                     for assignment in assignments]
+        self._unscheduled_deadlines, self._unscheduled = \
+            self._place_assignments(deadlines, assignments, start_time,
+                                    end_time)
+        self._collect()
+
+        return self.allocations
+
+    def _affected_window(self,
+                         tasks: list,
+                         now: Datetime):
+        """
+        Get the window of time affected by changes to tasks: the time
+        covered by their current allocations and the time they may need
+        to be allocated after the changes.
+        """
+        times = []
+        for task in tasks:
+            for chunk in self.allocations.get(str(task.uid), []):
+                times.extend((chunk.start_time, chunk.end_time))
+
+            if not self._is_pending(task, now):
+                continue
+            if isinstance(task, Event):
+                for interval in self._event_intervals(task, self.start_time,
+                                                      self.end_time):
+                    times.extend(interval)
+            elif isinstance(task, Assignment) and task.expected_duration:
+                deadline = self._next_deadline(task, now) or self.end_time
+                times.extend((deadline - task.expected_duration, deadline))
+
+        if not times:
+            return None, None
+
+        start_time = max(min(times), self.start_time)
+        end_time = min(max(times), self.end_time)
+
+        # Widen the window to whole chunks
+        start_time = max(self._align(start_time), self.start_time)
+        end_time = min(self._align(end_time, True), self.end_time)
+
+        return start_time, end_time
+
+    def reschedule(self,
+                   tasks: list,
+                   now: Datetime=None):
+        """
+        Re-plan the schedule after changes to tasks, such as a new
+        deadline or a moved event.  Only the window between the earliest
+        and latest time affected by the changed tasks is released and
+        re-planned; all other allocations, and their keys, are kept.
+
+        Within the window, the changed tasks are placed together with
+        the tasks whose time was released and the assignments left
+        unscheduled with deadlines within the window.  Assignments left
+        unscheduled with later deadlines are only placed if any free
+        time is left in the window afterwards, which, as they would have
+        come after all the others, is what they would have been given
+        had they been placed together.  Call schedule for a full
+        re-plan.
+
+        :param tasks: the tasks which have changed
+        :param now: the current time, if already known
+        :return : the chunks allocated to each task by uid
+        :rtype: dict
+        """
+        if now is None:
+            now = Datetime.now(datetime.timezone.utc)
+        if self.start_time is None:
+            return self.schedule(now=now)
+
+        start_time, end_time = self._affected_window(tasks, now)
+        if start_time is None or start_time >= end_time:
+            return self.allocations
+
+        changed = {str(task.uid): task for task in tasks}
+        released = self._release(start_time, end_time)
+        for uid, task in released.items():
+            if uid not in changed and task is not None:
+                changed[uid] = task
+
+        events = []
+        queued = [], []
+        for task in changed.values():
+            if not self._is_pending(task, now):
+                continue
+            if isinstance(task, Event):
+                events.append(task)
+            elif isinstance(task, Assignment) and task.expected_duration:
+                queued[0].append(self._deadline(task, now))
+                queued[1].append(task)
+
+        self._place_events(events, start_time, end_time)
+
+        # The assignments left unscheduled are kept in order of deadline,
+        # so those with deadlines before, within and after the window
+        # are found by bisection.  Tasks are equal by uid, so the
+        # changed ones are replaced whichever instances were queued.
+        changed_tasks = set(changed.values())
+        deadlines = self._unscheduled_deadlines
+        assignments = self._unscheduled
+        if not changed_tasks.isdisjoint(assignments):
+            kept = [i for i, assignment in enumerate(assignments)
+                    if assignment not in changed_tasks]
+            deadlines = [deadlines[i] for i in kept]
+            assignments = [assignments[i] for i in kept]
+        window_start = start_time.timestamp()
+        window_end = end_time.timestamp()
+        lo = bisect.bisect_right(deadlines, window_start)
+        hi = bisect.bisect_right(deadlines, window_end)
+
+        before = deadlines[:lo], assignments[:lo]
+        within = deadlines[lo:hi], assignments[lo:hi]
+        after = deadlines[hi:], assignments[hi:]
+        for deadline, task in zip(*queued):
+            part = before if deadline <= window_start else \
+                within if deadline <= window_end else after
+            part[0].append(deadline)
+            part[1].append(task)
+
+        if len(before[1]) > lo:
+            before = self._order(*before)
+        within = self._place_assignments(*within, start_time, end_time)
+        if after[1] and self._free_ranges(start_time, end_time)[0]:
+            after = self._place_assignments(*after, start_time, end_time)
+        elif len(after[1]) > len(assignments) - hi:
+            after = self._order(*after)
+
+        self._unscheduled_deadlines = before[0] + within[0] + after[0]
+        self._unscheduled = before[1] + within[1] + after[1]
+        self._collect()
+
+        return self.allocations
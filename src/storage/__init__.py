@@ -0,0 +1,2 @@
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
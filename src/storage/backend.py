@@ -0,0 +1,573 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the interface of the storage backends used by
+TaskManager and TimeManager, and its implementation over JSON files.
+
+Module structure:
+- StorageBackend
+  - JSONBackend
+"""
+
+import functools
+import os
+import json
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from instrumentation import METRICS, call_collecting
+from threads.thread import Thread, LazyThread
+from storage.journal import ThreadJournal
+from storage.locking import locked, atomic_write, read_version
+from storage.segments import SegmentedArchive
+from storage.stream import iter_thread_file, iter_json_array, \
+    in_time_range
+from timemap.index import IntervalIndex
+from timemap.runs import RunIndex, chunk_from_json, range_from_json
+from timemap.util import Datetime
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'TIMEMAPS',
+    'StorageBackend',
+    'JSONBackend'
+]
+
+# The time maps stored by TimeManager
+TIMEMAPS = ('future/planned', 'past/planned', 'past/actual')
+
+
+class StorageBackend(object):
+    """
+    Loads and saves the threads of a TaskManager and the time maps of a
+    TimeManager.  Past threads hold the tasks which are done, and future
+    threads hold all other tasks.
+
+    root is the data directory of the storage, holding its settings
+    such as the selected datetime codec (see timemap.util.read_codec),
+    or None if there is none.
+    """
+    root = None
+
+    def load_threads(self):
+        """
+        Load all future threads.
+
+        :return : the future threads
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def save_threads(self, threads: list):
+        """
+        Save the past and future parts of threads.  The tasks of each
+        past thread are added to those already stored for the thread,
+        and each future thread replaces the one stored.
+
+        Future threads which have been changed in storage since they
+        were loaded or saved by this backend, such as by another
+        process, are not saved, and neither are their past tasks; their
+        names are reported as conflicts.
+
+        :param threads: (thread_past, thread_future) pairs
+        :return : the number of files and bytes written and the names
+            of the threads in conflict
+        :rtype: dict
+        """
+        raise NotImplementedError
+
+    def load_past_thread(self, thread_name: str):
+        """
+        Load the past thread with a name, or None if there is none.
+
+        :param thread_name: the name of the thread
+        """
+        raise NotImplementedError
+
+    def iter_past_tasks(self,
+                        thread_names: list=None,
+                        start_time: Datetime=None,
+                        end_time: Datetime=None):
+        """
+        Lazily load the tasks of past threads one at a time.  Tasks are
+        filtered on their thread and times before they are created.
+
+        :param thread_names: the names of the threads of the tasks
+            (defaults to all threads)
+        :param start_time: the time after which the tasks end
+        :param end_time: the time before which the tasks start
+        """
+        raise NotImplementedError
+
+    def compact(self):
+        """
+        Compact the stored threads.
+
+        :return : the number of threads compacted
+        :rtype: int
+        """
+        return 0
+
+    def load_timemap(self, name: str):
+        """
+        Load a time map.  A missing time map is loaded as an empty one.
+
+        :param name: the name of the time map, one of TIMEMAPS
+        """
+        raise NotImplementedError
+
+    def iter_timemap(self,
+                     name: str,
+                     start_time: Datetime=None,
+                     end_time: Datetime=None):
+        """
+        Lazily load the time chunks of a time map one at a time, in
+        order, so that the whole time map need not be held in memory.
+        Loading stops at the first time chunk starting at or after
+        end_time.
+
+        :param name: the name of the time map, one of TIMEMAPS
+        :param start_time: the time after which the time chunks end
+        :param end_time: the time before which the time chunks start
+        """
+        for chunk in self.load_timemap(name):
+            if end_time is not None and chunk.start_time >= end_time:
+                return
+            if start_time is None or chunk.end_time > start_time:
+                yield chunk
+
+    def save_timemap(self,
+                     name: str,
+                     timemap: IntervalIndex):
+        """
+        Save a time map, replacing the one stored, unless it has been
+        changed in storage since it was loaded or saved by this backend.
+
+        :param name: the name of the time map, one of TIMEMAPS
+        :param timemap: the time map to be stored
+        :return : whether the time map was saved
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+
+class JSONBackend(StorageBackend):
+    """
+    Stores threads and time maps as JSON in files with the following
+    directory and file structure:
+    - {root}/threads/future/{thread_name}.json: the future thread with
+      name {thread_name}.
+    - {root}/threads/past/{thread_name}.json: the past thread with name
+      {thread_name}.
+    - {root}/timemap/{name}.json: the time map with name {name}.
+
+    In journal mode, past tasks are instead appended to
+    {root}/threads/past/{thread_name}.journal, which is folded into
+    {thread_name}.json by compact (see storage.journal.ThreadJournal).
+    In segmented mode, past tasks are instead stored in segments
+    partitioned by month in {root}/threads/past/{thread_name}/, so that
+    queries over a time range only read some of them, and compact
+    merges the segments of each month (see
+    storage.segments.SegmentedArchive).
+
+    Several processes can share the data directory.  Every file which
+    is changed in place is locked (see storage.locking.locked) and
+    written through a temporary file which atomically replaces it.
+    Future threads and time maps carry version numbers, and a save is
+    reported as a conflict, rather than overwriting the other changes,
+    if the file has been written by another process since it was loaded.
+
+    Future threads can be read in parallel by an executor.  Since
+    decoding is CPU-bound, a concurrent.futures.ProcessPoolExecutor
+    gives the largest speedup, while a ThreadPoolExecutor only overlaps
+    the reads of the files.  The counters and timings of the reads in
+    worker processes are merged into instrumentation.METRICS.  In lazy
+    mode, future threads are loaded as threads.thread.LazyThread
+    instances whose tasks are only decoded when they are first
+    accessed.
+
+    >>> import tempfile
+    >>> from threads.task import Task
+    >>> root = tempfile.mkdtemp()
+    >>> backend, other = JSONBackend(root), JSONBackend(root)
+    >>> for directory in (backend.dir_past, backend.dir_future):
+    ...     os.makedirs(directory)
+    >>> thread = Thread('work', 5)
+    >>> thread.add_task(Task('write'))
+    >>> backend.save_threads([(Thread('work', 5), thread)])['conflicts']
+    []
+    >>> [task.name for task in other.load_threads()[0].tasks]
+    ['write']
+    >>> thread.add_task(Task('review'))
+    >>> backend.save_threads([(Thread('work', 5), thread)])['conflicts']
+    []
+    >>> past = Thread('work', 5)
+    >>> past.add_task(Task('plan'))
+    >>> other.save_threads([(past, thread)])['conflicts']
+    ['work']
+    >>> print(other.load_past_thread('work'))
+    None
+
+    >>> import instrumentation
+    >>> instrumentation.enable()
+    >>> with ProcessPoolExecutor(1) as executor:
+    ...     loaded = JSONBackend(root, executor=executor).load_threads()
+    >>> instrumentation.stats()['counters']['tasks_decoded']
+    2
+    >>> instrumentation.disable()
+    >>> instrumentation.reset()
+    """
+    def __init__(self,
+                 root: str,
+                 journal: bool=False,
+                 executor: Executor=None,
+                 lazy: bool=False,
+                 segmented: bool=False):
+        """
+        :param root: the data directory
+        :param journal: whether past tasks are appended to journals
+            rather than merged into the past thread files
+        :param executor: the executor reading future threads in
+            parallel, if any
+        :param lazy: whether the tasks of future threads are decoded
+            when first accessed rather than when loaded
+        :param segmented: whether past tasks are stored in time
+            partitioned segments rather than in the past thread files
+        """
+        self.root = root
+        self.journal = journal
+        self.segmented = segmented
+        self.executor = executor
+        self.lazy = lazy
+
+        self.dir_past = os.path.join(root, 'threads', 'past')
+        self.dir_future = os.path.join(root, 'threads', 'future')
+        self.dir_timemap = os.path.join(root, 'timemap')
+
+        # The versions of the files last loaded or saved, by path
+        self.versions = {}
+
+    @staticmethod
+    def _append_to_thread_file(file_path: str,
+                               thread: Thread):
+        """
+        Append tasks in a thread to an existing thread on file
+
+        :param file_path: the path to the thread file
+        :param thread: the thread to be stored
+        :return : the number of bytes written
+        :rtype: int
+        """
+        with locked(file_path):
+            if os.path.exists(file_path):
+                with open(file_path, 'r') as f:
+                    old_thread, _ = JSONBackend._decode_thread(
+                        JSONBackend._read_file(f))
+                old_thread |= thread
+                thread = old_thread
+
+            data = JSONBackend._encode_thread(thread)
+            with METRICS.timer('io'):
+                return atomic_write(file_path, data)
+
+    @staticmethod
+    def _overwrite_thread_file(file_path: str,
+                               thread: Thread,
+                               version: int=None):
+        """
+        Write out thread on file overwriting if necessary.  The caller
+        should hold the lock on the file.
+
+        :param file_path: the path to the thread file
+        :param thread: the thread to be stored
+        :param version: the version of the file, if it is versioned
+        :return : the number of bytes written
+        :rtype: int
+        """
+        data = JSONBackend._encode_thread(thread, version)
+        with METRICS.timer('io'):
+            return atomic_write(file_path, data)
+
+    @staticmethod
+    def _read_file(f):
+        """
+        Read the contents of an open file
+
+        :param f: the file, opened for reading
+        """
+        with METRICS.timer('io'):
+            data = f.read()
+        METRICS.count('files_read')
+        METRICS.count('bytes_read', len(data))
+        return data
+
+    @staticmethod
+    def _encode_thread(thread: Thread,
+                       version: int=None):
+        """
+        Encode a thread as a JSON string
+
+        :param thread: the thread to be encoded
+        :param version: the version stored first in the string, if any
+        """
+        with METRICS.timer('serialize'):
+            encoded = thread.to_json()
+            if version is not None:
+                encoded = dict(version=version, **encoded)
+            data = json.dumps(encoded)
+        METRICS.count('tasks_encoded', len(thread.tasks))
+        return data
+
+    @staticmethod
+    def _decode_thread(data: str,
+                       cls: type=Thread):
+        """
+        Decode a thread from a JSON string
+
+        :param data: the JSON string
+        :param cls: the class of the thread
+        :return : the thread and the version of the string
+        :rtype: tuple
+        """
+        with METRICS.timer('deserialize'):
+            d = json.loads(data)
+            thread = cls.from_json(d)
+        if cls is Thread:
+            METRICS.count('tasks_decoded', len(thread.tasks))
+        return thread, d.get('version', 0)
+
+    @staticmethod
+    def _read_thread_file(file_path: str):
+        """
+        Read in thread from file
+
+        :param file_path: the path to the thread file
+        :return : the thread and the version of the file
+        :rtype: tuple
+        """
+        with open(file_path, 'r') as f:
+            return JSONBackend._decode_thread(JSONBackend._read_file(f))
+
+    @staticmethod
+    def _read_lazy_thread_file(file_path: str):
+        """
+        Read in thread from file without decoding its tasks
+
+        :param file_path: the path to the thread file
+        :return : the thread and the version of the file
+        :rtype: tuple
+        """
+        with open(file_path, 'r') as f:
+            return JSONBackend._decode_thread(JSONBackend._read_file(f),
+                                              LazyThread)
+
+    def load_threads(self):
+        read = self._read_lazy_thread_file if self.lazy \
+            else self._read_thread_file
+        file_paths = [os.path.join(self.dir_future, thread_file)
+                      for thread_file in sorted(os.listdir(self.dir_future))
+                      if thread_file.endswith('.json')]
+
+        chunksize = max(len(file_paths) // 64, 1)
+        if self.executor is None:
+            loaded = [read(file_path) for file_path in file_paths]
+        elif isinstance(self.executor, ProcessPoolExecutor) and \
+                METRICS.enabled:
+            loaded = []
+            for result, snapshot in self.executor.map(
+                    functools.partial(call_collecting, read), file_paths,
+                    chunksize=chunksize):
+                METRICS.merge(snapshot)
+                loaded.append(result)
+        else:
+            loaded = self.executor.map(read, file_paths, chunksize=chunksize)
+
+        threads = []
+        for file_path, (thread, version) in zip(file_paths, loaded):
+            self.versions[file_path] = version
+            threads.append(thread)
+        return threads
+
+    def save_threads(self, threads: list):
+        report = {'files': 0, 'bytes': 0, 'conflicts': []}
+
+        for thread_past, thread_future in threads:
+            file_path = os.path.join(self.dir_future,
+                                     "{0}.json".format(thread_future.name))
+            with locked(file_path):
+                version = read_version(file_path)
+                if version != self.versions.get(file_path):
+                    report['conflicts'].append(thread_future.name)
+                    continue
+
+                # Nothing is written for a thread in conflict, so its
+                # past tasks are only written once the version matches
+                if thread_past.tasks:
+                    report['bytes'] += self._append_past_thread(thread_past)
+                    report['files'] += 1
+
+                version = (version or 0) + 1
+                report['bytes'] += self._overwrite_thread_file(
+                    file_path, thread_future, version)
+                self.versions[file_path] = version
+            report['files'] += 1
+
+        return report
+
+    def _append_past_thread(self, thread_past: Thread):
+        """
+        Add the tasks of a past thread to those stored for it.
+
+        :return : the number of bytes written
+        :rtype: int
+        """
+        if self.segmented:
+            return SegmentedArchive(self.dir_past,
+                                    thread_past.name).append(thread_past)
+        if self.journal:
+            return ThreadJournal(self.dir_past,
+                                 thread_past.name).append(thread_past)
+        file_path = os.path.join(self.dir_past,
+                                 "{0}.json".format(thread_past.name))
+        return self._append_to_thread_file(file_path, thread_past)
+
+    def load_past_thread(self, thread_name: str):
+        if self.segmented:
+            return SegmentedArchive(self.dir_past, thread_name).read()
+        return ThreadJournal(self.dir_past, thread_name).read()
+
+    def _past_thread_names(self):
+        """
+        Get the names of all stored past threads.
+        """
+        if self.segmented:
+            return sorted(
+                file_name for file_name in os.listdir(self.dir_past)
+                if SegmentedArchive(self.dir_past, file_name).exists())
+
+        return sorted({
+            os.path.splitext(file_name)[0]
+            for file_name in os.listdir(self.dir_past)
+            if os.path.splitext(file_name)[1] in ('.json', '.journal')
+        })
+
+    def iter_past_tasks(self,
+                        thread_names: list=None,
+                        start_time: Datetime=None,
+                        end_time: Datetime=None):
+        if thread_names is None:
+            thread_names = self._past_thread_names()
+
+        for thread_name in thread_names:
+            if self.segmented:
+                archive = SegmentedArchive(self.dir_past, thread_name)
+                for task_json in archive.iter_tasks(start_time, end_time):
+                    yield Thread.task_from_json(task_json)
+                continue
+
+            journal = ThreadJournal(self.dir_past, thread_name)
+
+            # Tasks in both the snapshot and the journal, left by an
+            # interrupted compaction, are only read from their latest
+            # record in the journal, as by ThreadJournal.read
+            journalled = journal.latest_records()
+
+            if os.path.exists(journal.snapshot_path):
+                for task_json in iter_thread_file(journal.snapshot_path):
+                    if task_json.get('uid') not in journalled and \
+                            in_time_range(task_json, start_time, end_time):
+                        yield Thread.task_from_json(task_json)
+            for task_json in journalled.values():
+                if in_time_range(task_json, start_time, end_time):
+                    yield Thread.task_from_json(task_json)
+
+    def compact(self):
+        compacted = 0
+        if self.segmented:
+            for thread_name in self._past_thread_names():
+                if SegmentedArchive(self.dir_past, thread_name).compact():
+                    compacted += 1
+            return compacted
+
+        for file_name in os.listdir(self.dir_past):
+            thread_name, ext = os.path.splitext(file_name)
+            if ext == '.journal':
+                if ThreadJournal(self.dir_past, thread_name).compact():
+                    compacted += 1
+        return compacted
+
+    def load_timemap(self, name: str):
+        file_path = os.path.join(self.dir_timemap, "{0}.json".format(name))
+        if not os.path.exists(file_path):
+            self.versions[file_path] = None
+            return RunIndex()
+
+        with open(file_path, 'r') as f:
+            d = json.load(f)
+
+        # Time maps written before versions were added are plain lists
+        if isinstance(d, list):
+            d = {'version': 0, 'chunks': d}
+        self.versions[file_path] = d['version']
+        return RunIndex.from_json(d['chunks'])
+
+    def iter_timemap(self,
+                     name: str,
+                     start_time: Datetime=None,
+                     end_time: Datetime=None):
+        """
+        Lazily load the time chunks of a time map one at a time, in
+        order, reading the file only as far as end_time.
+
+        >>> import tempfile
+        >>> from timemap.time import AllocatedTimeChunk
+        >>> from timemap.util import Timedelta
+        >>> start = Datetime(2015, 1, 12, 9)
+        >>> backend = JSONBackend(tempfile.mkdtemp())
+        >>> backend.save_timemap('planned', RunIndex.from_chunks(
+        ...     AllocatedTimeChunk(start + i * Timedelta.HOUR, Timedelta.HOUR)
+        ...     for i in range(4) if i != 1))
+        True
+        >>> [chunk.start_time.hour for chunk in backend.iter_timemap(
+        ...     'planned', start + Timedelta.HOUR, start + 3 * Timedelta.HOUR)]
+        [11]
+
+        :param name: the name of the time map, one of TIMEMAPS
+        :param start_time: the time after which the time chunks end
+        :param end_time: the time before which the time chunks start
+        """
+        file_path = os.path.join(self.dir_timemap, "{0}.json".format(name))
+        if not os.path.exists(file_path):
+            return
+
+        # Runs are stored in order, so only the times of those before
+        # start_time are decoded, and reading stops at end_time
+        for item in iter_json_array(file_path, 'chunks'):
+            if start_time is not None or end_time is not None:
+                item_start, item_end = range_from_json(item)
+                if end_time is not None and item_start >= end_time:
+                    return
+                if start_time is not None and item_end <= start_time:
+                    continue
+            yield chunk_from_json(item)
+
+    def save_timemap(self,
+                     name: str,
+                     timemap: IntervalIndex):
+        file_path = os.path.join(self.dir_timemap, "{0}.json".format(name))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with locked(file_path):
+            version = read_version(file_path)
+            if version != self.versions.get(file_path):
+                return False
+
+            version = (version or 0) + 1
+            atomic_write(file_path, json.dumps({
+                'version': version,
+                'chunks': timemap.to_json()
+            }))
+            self.versions[file_path] = version
+        return True
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the append-only journal used to store the tasks of
+past threads without rewriting the whole thread on every save.
+
+Module structure:
+- ThreadJournal
+"""
+
+import os
+import json
+
+from instrumentation import METRICS
+from threads.thread import Thread
+from storage.locking import locked, atomic_write
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'ThreadJournal'
+]
+
+
+class ThreadJournal(object):
+    """
+    Stores a thread as a snapshot and a journal.  The snapshot,
+    {directory}/{thread_name}.json, holds the JSON representation of the
+    thread as written by the last compaction.  The journal,
+    {directory}/{thread_name}.journal, holds one JSON record per line: a
+    header with the name and default importance of the thread, followed
+    by the JSON representations of tasks appended since.
+
+    Appends are flushed and synced before returning.  A torn last line
+    left by a crash is cut off by the next append, so that the records
+    appended after it are kept, and any line which cannot be parsed is
+    skipped on reading and counted as journal_records_skipped.
+    Compaction writes the new snapshot to a temporary file which
+    atomically replaces the old snapshot before the journal is
+    removed, so that a crash at any point loses no tasks.  A task
+    present in both is read from the journal, the latest record of it
+    winning.  Appends and compactions hold the lock on the snapshot, so
+    that tasks appended by another process while the journal is
+    compacted are not lost.
+
+    >>> import tempfile
+    >>> from threads.task import Task
+    >>> directory = tempfile.mkdtemp()
+    >>> journal = ThreadJournal(directory, 'work')
+    >>> def append(*names):
+    ...     thread = Thread('work', 5)
+    ...     for name in names:
+    ...         thread.add_task(Task(name))
+    ...     return journal.append(thread) > 0
+    >>> append('a', 'b')
+    True
+    >>> with open(journal.journal_path, 'a') as f:
+    ...     _ = f.write('{"uid": "torn')
+    >>> append('c'), append('d'), append('e')
+    (True, True, True)
+    >>> sorted(task.name for task in journal.read().tasks)
+    ['a', 'b', 'c', 'd', 'e']
+    >>> journal.compact()
+    True
+    >>> thread = journal.read()
+    >>> len(thread.tasks)
+    5
+    >>> task = thread.tasks[0]
+    >>> task.name = 'renamed'
+    >>> changed = Thread('work', 5)
+    >>> changed.add_task(task)
+    >>> journal.append(changed) > 0
+    True
+    >>> 'renamed' in [task.name for task in journal.read().tasks]
+    True
+    """
+    def __init__(self,
+                 directory: str,
+                 thread_name: str):
+        """
+        :param directory: the directory storing the thread
+        :param thread_name: the name of the thread
+        """
+        self.thread_name = thread_name
+        self.snapshot_path = os.path.join(directory,
+                                          "{0}.json".format(thread_name))
+        self.journal_path = os.path.join(directory,
+                                         "{0}.journal".format(thread_name))
+
+    def append(self, thread: Thread):
+        """
+        Append the tasks in a thread to the journal.
+
+        :param thread: the thread whose tasks are appended
+        :return : the number of bytes written
+        :rtype: int
+        """
+        with locked(self.snapshot_path):
+            lines = []
+            if not self._truncate_torn():
+                lines.append(json.dumps({
+                    'name': thread.name,
+                    'default_importance': thread.default_importance
+                }))
+            lines.extend(json.dumps(task.to_json()) for task in thread.tasks)
+            if not lines:
+                return 0
+
+            data = ("\n".join(lines) + "\n").encode('utf-8')
+            with open(self.journal_path, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        return len(data)
+
+    def _truncate_torn(self, block_size: int=4096):
+        """
+        Cut a torn last line, left by a crash during an append, off the
+        end of the journal.  The caller should hold the lock on the
+        snapshot.
+
+        :param block_size: the number of bytes read at a time
+        :return : whether the journal is left with any complete lines
+        :rtype: bool
+        """
+        if not os.path.exists(self.journal_path):
+            return False
+
+        with open(self.journal_path, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(position - block_size, 0)
+                f.seek(start)
+                block = f.read(position - start)
+                i = block.rfind(b'\n')
+                if i >= 0:
+                    position = start + i + 1
+                    break
+                position = start
+            if position < end:
+                f.truncate(position)
+                METRICS.count('journal_records_skipped')
+        return position > 0
+
+    def _iter_journal(self):
+        """
+        Lazily read the records in the journal, skipping lines which
+        cannot be parsed, such as a torn last line.
+        """
+        if not os.path.exists(self.journal_path):
+            return
+
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    METRICS.count('journal_records_skipped')
+
+    def _read_journal(self):
+        """
+        Read the header and task records in the journal.
+
+        :return : header, task_records
+        :rtype: tuple
+        """
+        header = None
+        records = []
+        for record in self._iter_journal():
+            if 'uid' in record:
+                records.append(record)
+            elif header is None:
+                header = record
+
+        return header, records
+
+    def records(self):
+        """
+        Lazily read the task records in the journal.
+        """
+        for record in self._iter_journal():
+            if 'uid' in record:
+                yield record
+
+    def latest_records(self):
+        """
+        Read the latest task record in the journal of each task.
+
+        :return : the records by uid, in order of first appearance
+        :rtype: dict
+        """
+        return {record['uid']: record for record in self.records()}
+
+    def read(self):
+        """
+        Read in the thread from its snapshot and journal, or None if
+        neither exists.
+        """
+        header, records = self._read_journal()
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as f:
+                d = json.load(f)
+        elif header is not None:
+            d = dict(header, tasks=[])
+        else:
+            return None
+
+        # Tasks in both the snapshot and the journal are taken from
+        # their latest record in the journal
+        tasks = {task_json['uid']: task_json for task_json in d['tasks']}
+        for record in records:
+            tasks[record['uid']] = record
+        d['tasks'] = list(tasks.values())
+        return Thread.from_json(d)
+
+    def compact(self):
+        """
+        Fold the journal into the snapshot.
+
+        :return : whether there was anything to compact
+        :rtype: bool
+        """
+        with locked(self.snapshot_path):
+            if not os.path.exists(self.journal_path):
+                return False
+
+            thread = self.read()
+            if thread is not None:
+                atomic_write(self.snapshot_path,
+                             json.dumps(thread.to_json()))
+
+            os.remove(self.journal_path)
+        return True
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the primitives which let several processes share
+one data directory: advisory file locks, atomic writes and the version
+numbers used to detect conflicting writes.
+
+Module structure:
+- locked
+- atomic_write
+- read_version
+"""
+
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from storage.stream import JSONStream
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'LOCK_EXTENSION',
+    'locked',
+    'atomic_write',
+    'read_version'
+]
+
+# The extension of the lock file of each locked file
+LOCK_EXTENSION = '.lock'
+
+
+@contextlib.contextmanager
+def locked(file_path: str,
+           shared: bool=False):
+    """
+    Hold an advisory lock on a file for the duration of the context.
+    The lock is taken on the lock file {file_path}.lock, rather than on
+    the file itself, so that it survives the file being atomically
+    replaced.  Locking is skipped on platforms without fcntl.
+
+    :param file_path: the path to the file
+    :param shared: whether the lock is shared, for reading, rather than
+        exclusive, for writing
+    """
+    if fcntl is None:
+        yield
+        return
+
+    fd = os.open(file_path + LOCK_EXTENSION, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        # Closing the lock file releases the lock
+        os.close(fd)
+
+
+def atomic_write(file_path: str, data: str):
+    """
+    Write out a file through a temporary file which atomically replaces
+    it, so that readers and a crash at any point see either the old or
+    the new contents in full.  The directory is synced after the
+    replacement, so that the new contents are not lost with the rename
+    in a crash.
+
+    :param file_path: the path to the file
+    :param data: the contents of the file
+    :return : the number of bytes written
+    :rtype: int
+    """
+    temp_path = "{0}.{1}.tmp".format(file_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+
+    # Directories cannot be opened, or synced, on every platform
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(os.path.dirname(os.path.abspath(file_path)),
+                     os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    return len(data)
+
+
+def read_version(file_path: str):
+    """
+    Read the version of a versioned JSON file, which is stored first in
+    its top-level object so that the rest of the file need not be read.
+    Files written before versions were added have version 0, and files
+    which do not exist have version None.
+
+    >>> import tempfile
+    >>> file_path = os.path.join(tempfile.mkdtemp(), 'work.json')
+    >>> print(read_version(file_path))
+    None
+    >>> with locked(file_path):
+    ...     atomic_write(file_path, '{"version": 3, "tasks": []}')
+    27
+    >>> read_version(file_path)
+    3
+    >>> _ = atomic_write(file_path, '{"tasks": []}')
+    >>> read_version(file_path)
+    0
+
+    :param file_path: the path to the file
+    """
+    if not os.path.exists(file_path):
+        return None
+
+    with open(file_path, 'r') as f:
+        stream = JSONStream(f, 256)
+        if stream.peek() != '{':
+            return 0
+        stream.expect('{')
+        if stream.peek() == '}' or stream.decode() != 'version':
+            return 0
+        stream.expect(':')
+        return stream.decode()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the time-partitioned archive used to store the
+tasks of past threads in segments, so that queries over a time range
+only read the segments which may hold tasks in it.
+
+Module structure:
+- partition_of
+- SegmentedArchive
+"""
+
+import os
+import json
+
+from threads.thread import Thread
+from storage.locking import locked, atomic_write
+from storage.stream import iter_thread_file, in_time_range
+from timemap.util import Datetime
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'partition_of',
+    'SegmentedArchive'
+]
+
+# The partition of tasks without end times
+UNDATED = 'undated'
+
+
+def partition_of(end_time: Datetime or None):
+    """
+    Get the partition holding tasks with an end time: the month in
+    which it falls.
+
+    >>> partition_of(Datetime(2015, 1, 12, 11, 23, 46))
+    '2015-01'
+
+    :param end_time: the end time of the task
+    """
+    if end_time is None:
+        return UNDATED
+    return "{0:04d}-{1:02d}".format(end_time.year, end_time.month)
+
+
+class SegmentedArchive(object):
+    """
+    Stores a thread as segments partitioned by the months in which its
+    tasks end.  Each segment, {directory}/{thread_name}/{partition}.{n}.json,
+    holds the JSON representation of a thread with some of the tasks in
+    a partition.  The manifest, {directory}/{thread_name}/manifest.json,
+    records the file, partition, number of tasks and the earliest start
+    time and latest end time of the tasks of every segment, and the
+    segment holding the latest copy of every task.
+
+    Every append writes new segments, which are only listed once the
+    manifest has been atomically replaced, so that a crash at any point
+    loses no tasks.  A task appended more than once is only read from
+    its latest segment, even by queries which do not open it because
+    the task has moved out of their time range, and compaction merges
+    the segments of each partition into one and drops the older copies
+    of such tasks.  Appends and compactions hold the lock on the
+    manifest, so that processes sharing the archive do not overwrite
+    each other's segments.
+
+    >>> import tempfile
+    >>> from threads.task import Task
+    >>> from timemap.util import Timedelta
+    >>> start = Datetime(2015, 1, 12)
+    >>> archive = SegmentedArchive(tempfile.mkdtemp(), 'work')
+    >>> thread = Thread('work', 5)
+    >>> for name, days in (('essay', 0), ('review', 31)):
+    ...     thread.add_task(Task(name, start + days * Timedelta.DAY,
+    ...                          start + (days + 1) * Timedelta.DAY))
+    >>> _ = archive.append(thread)
+    >>> essay = thread.tasks[0]
+    >>> essay.change_time(start + 62 * Timedelta.DAY,
+    ...                   start + 63 * Timedelta.DAY)
+    >>> moved = Thread('work', 5)
+    >>> moved.add_task(essay)
+    >>> _ = archive.append(moved)
+    >>> def names(days=None):
+    ...     window = days and (start + days[0] * Timedelta.DAY,
+    ...                        start + days[1] * Timedelta.DAY)
+    ...     return sorted(task_json['name']
+    ...                   for task_json in archive.iter_tasks(*window or ()))
+    >>> names(), names((0, 7)), names((60, 70))
+    (['essay', 'review'], [], ['essay'])
+    >>> archive.compact()
+    True
+    >>> [segment['partition'] for segment in archive.segments()]
+    ['2015-03', '2015-02']
+    >>> names(), names((0, 7)), names((60, 70))
+    (['essay', 'review'], [], ['essay'])
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self,
+                 directory: str,
+                 thread_name: str):
+        """
+        :param directory: the directory storing the thread
+        :param thread_name: the name of the thread
+        """
+        self.thread_name = thread_name
+        self.directory = os.path.join(directory, thread_name)
+        self.manifest_path = os.path.join(self.directory, self.MANIFEST)
+
+    def exists(self):
+        """
+        Return if the archive has been written.
+        """
+        return os.path.exists(self.manifest_path)
+
+    def read_manifest(self):
+        """
+        Read the manifest, or an empty one if the archive does not
+        exist.
+        """
+        if not self.exists():
+            return {
+                'name': self.thread_name,
+                'default_importance': None,
+                'next': 0,
+                'segments': [],
+                'latest': {}
+            }
+
+        with open(self.manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+        # Manifests written before the latest segment of every task was
+        # recorded are indexed from their segments
+        if 'latest' not in manifest:
+            latest = manifest['latest'] = {}
+            for segment in reversed(manifest['segments']):
+                file_path = os.path.join(self.directory, segment['file'])
+                for task_json in iter_thread_file(file_path):
+                    latest.setdefault(task_json.get('uid'), segment['file'])
+        return manifest
+
+    def _write_segment(self,
+                       manifest: dict,
+                       partition: str,
+                       tasks_json: list):
+        """
+        Write out a new segment and add it to the manifest, as the
+        latest segment of its tasks.
+
+        :param manifest: the manifest
+        :param partition: the partition of the tasks
+        :param tasks_json: the JSON representations of the tasks
+        :return : the number of bytes written
+        :rtype: int
+        """
+        start_times = [Datetime.from_json(task_json.get('start_time'))
+                       for task_json in tasks_json]
+        end_times = [Datetime.from_json(task_json.get('end_time'))
+                     for task_json in tasks_json]
+        start_time = None if None in start_times else min(start_times)
+        end_time = None if None in end_times else max(end_times)
+
+        file_name = "{0}.{1}.json".format(partition, manifest['next'])
+        manifest['next'] += 1
+        data = json.dumps({
+            'name': manifest['name'],
+            'default_importance': manifest['default_importance'],
+            'tasks': tasks_json
+        })
+        atomic_write(os.path.join(self.directory, file_name), data)
+
+        manifest['segments'].append({
+            'file': file_name,
+            'partition': partition,
+            'count': len(tasks_json),
+            'start_time': start_time and start_time.to_json(),
+            'end_time': end_time and end_time.to_json()
+        })
+        for task_json in tasks_json:
+            manifest['latest'][task_json.get('uid')] = file_name
+        return len(data)
+
+    def append(self, thread: Thread):
+        """
+        Append the tasks in a thread to the archive, in new segments.
+
+        :param thread: the thread whose tasks are appended
+        :return : the number of bytes written
+        :rtype: int
+        """
+        if not thread.tasks:
+            return 0
+
+        partitions = {}
+        for task in thread.tasks:
+            partitions.setdefault(partition_of(task.end_time),
+                                  []).append(task.to_json())
+
+        os.makedirs(self.directory, exist_ok=True)
+        with locked(self.manifest_path):
+            manifest = self.read_manifest()
+            manifest['default_importance'] = thread.default_importance
+
+            size = 0
+            for partition, tasks_json in sorted(partitions.items()):
+                size += self._write_segment(manifest, partition, tasks_json)
+
+            size += atomic_write(self.manifest_path, json.dumps(manifest))
+        return size
+
+    def segments(self,
+                 start_time: Datetime=None,
+                 end_time: Datetime=None):
+        """
+        Get the manifest entries of the segments, latest first, which
+        may hold tasks overlapping the time range between start_time
+        and end_time.
+
+        :param start_time: the time after which the tasks end
+        :param end_time: the time before which the tasks start
+        """
+        return self._segments(self.read_manifest(), start_time, end_time)
+
+    @staticmethod
+    def _segments(manifest: dict,
+                  start_time: Datetime=None,
+                  end_time: Datetime=None):
+        """
+        Get the entries of a manifest for the segments, latest first,
+        which may hold tasks overlapping a time range (see segments).
+        """
+        segments = []
+        for segment in reversed(manifest['segments']):
+            if start_time is not None and segment['end_time'] is not None:
+                if Datetime.from_json(segment['end_time']) <= start_time:
+                    continue
+            if end_time is not None and segment['start_time'] is not None:
+                if Datetime.from_json(segment['start_time']) >= end_time:
+                    continue
+            segments.append(segment)
+        return segments
+
+    def iter_tasks(self,
+                   start_time: Datetime=None,
+                   end_time: Datetime=None):
+        """
+        Lazily read the JSON representations of the tasks overlapping
+        the time range between start_time and end_time, opening only
+        the segments which may hold them.  Each task is only read from
+        its latest segment, as recorded in the manifest, so the older
+        copies of tasks since moved out of the time range are skipped.
+
+        :param start_time: the time after which the tasks end
+        :param end_time: the time before which the tasks start
+        """
+        manifest = self.read_manifest()
+        latest = manifest['latest']
+        for segment in self._segments(manifest, start_time, end_time):
+            file_path = os.path.join(self.directory, segment['file'])
+            for task_json in iter_thread_file(file_path):
+                if latest.get(task_json.get('uid')) != segment['file']:
+                    continue
+                if in_time_range(task_json, start_time, end_time):
+                    yield task_json
+
+    def read(self):
+        """
+        Read in the thread from its segments, or None if the archive
+        does not exist.
+        """
+        if not self.exists():
+            return None
+
+        manifest = self.read_manifest()
+        return Thread.from_json({
+            'name': manifest['name'],
+            'default_importance': manifest['default_importance'],
+            'tasks': list(self.iter_tasks())
+        })
+
+    def compact(self):
+        """
+        Merge the segments of each partition into one, dropping all but
+        the latest copy of every task.  Partitions which already have a
+        single segment without older copies of tasks are left alone.
+
+        :return : whether anything was compacted
+        :rtype: bool
+        """
+        if not self.exists():
+            return False
+
+        with locked(self.manifest_path):
+            return self._compact()
+
+    def _compact(self):
+        """
+        Compact the archive while holding the lock on its manifest.
+        """
+        manifest = self.read_manifest()
+        segments = manifest['segments']
+
+        # The segment holding the latest copy of every task, before the
+        # merged segments replace them in the manifest
+        latest = dict(manifest['latest'])
+        live = {}
+        for file_name in latest.values():
+            live[file_name] = live.get(file_name, 0) + 1
+
+        partitions = {}
+        for segment in segments:
+            partitions.setdefault(segment['partition'], []).append(segment)
+
+        manifest['segments'] = []
+        removed = []
+        for partition, partition_segments in sorted(partitions.items()):
+            if len(partition_segments) == 1:
+                segment = partition_segments[0]
+                if live.get(segment['file'], 0) == segment['count']:
+                    manifest['segments'].append(segment)
+                    continue
+
+            tasks_json = []
+            for segment in partition_segments:
+                file_path = os.path.join(self.directory, segment['file'])
+                tasks_json.extend(
+                    task_json for task_json in iter_thread_file(file_path)
+                    if latest[task_json.get('uid')] == segment['file'])
+            if tasks_json:
+                self._write_segment(manifest, partition, tasks_json)
+            removed.extend(partition_segments)
+
+        if not removed:
+            return False
+
+        atomic_write(self.manifest_path, json.dumps(manifest))
+        for segment in removed:
+            os.remove(os.path.join(self.directory, segment['file']))
+        return True
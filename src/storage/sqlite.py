@@ -0,0 +1,457 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the storage backend keeping threads and time maps
+in a SQLite database.
+
+Module structure:
+- SQLiteBackend(StorageBackend)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+from instrumentation import METRICS
+from threads.thread import Thread
+from threads.task import Event, Assignment
+from storage.backend import StorageBackend
+from storage.stream import in_time_range
+from timemap.index import IntervalIndex
+from timemap.runs import RunIndex
+from timemap.time import AllocatedTimeChunk
+from timemap.util import Datetime, Timedelta
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'SQLiteBackend'
+]
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Stores threads and time maps in a SQLite database.  Each task is
+    stored as a row holding its JSON representation along with indexed
+    columns for its uid, thread name, type, end time, completion,
+    importance and whether it is past, so that loading and querying
+    tasks are index lookups rather than reads of every thread.  All the
+    writes of a save are made in a single transaction, which SQLite
+    serializes against those of other processes.
+
+    Each thread and time map has a version, incremented by every save,
+    and a save only updates a thread or time map whose version is still
+    the one it was loaded at.  A thread or time map which has been saved
+    by another process since it was loaded is not overwritten, and is
+    reported as a conflict, as by JSONBackend.
+
+    The connection may be used from any thread, such as the executor
+    threads of an AsyncTaskManager, and every use of it holds a lock, so
+    that statements and transactions from different threads are never
+    interleaved.  Rows are streamed in batches of fetch_size, the lock
+    being released between batches.
+
+    >>> import asyncio, os, tempfile
+    >>> from managers import TaskManager, AsyncTaskManager
+    >>> from threads.task import Task
+    >>> path = os.path.join(tempfile.mkdtemp(), 'threads.db')
+    >>> async def add(name):
+    ...     backend = SQLiteBackend(path)
+    ...     async with AsyncTaskManager(TaskManager(backend=backend)) as m:
+    ...         await m.load_state()
+    ...         m.add_task('work', Task(name), 5)
+    ...     backend.close()
+    >>> asyncio.run(add('write'))
+    >>> asyncio.run(add('review'))
+    >>> backend = SQLiteBackend(path)
+    >>> sorted(task.name for thread in backend.load_threads()
+    ...        for task in thread.tasks)
+    ['review', 'write']
+    >>> other = SQLiteBackend(path)
+    >>> thread, = other.load_threads()
+    >>> other.save_threads([(Thread('work', 5), thread)])['conflicts']
+    []
+    >>> backend.save_threads([(Thread('work', 5), thread)])['conflicts']
+    ['work']
+
+    A save replaces the future tasks of a thread, so that the tasks
+    removed from it are not loaded again, while its past tasks, kept in
+    the same table, are left:
+
+    >>> past = Thread('work', 5)
+    >>> past.add_task(thread.tasks.pop())
+    >>> other.save_threads([(past, thread)])['conflicts']
+    []
+    >>> thread.tasks = []
+    >>> other.save_threads([(Thread('work', 5), thread)])['conflicts']
+    []
+    >>> [len(thread) for thread in other.load_threads()]
+    [0]
+    >>> len(other.load_past_thread('work'))
+    1
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS threads (
+            name TEXT PRIMARY KEY,
+            default_importance REAL,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            uid TEXT PRIMARY KEY,
+            thread_name TEXT NOT NULL,
+            type TEXT NOT NULL,
+            end_time REAL,
+            completed INTEGER NOT NULL,
+            importance REAL,
+            past INTEGER NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tasks_thread_name
+            ON tasks (past, thread_name);
+        CREATE INDEX IF NOT EXISTS tasks_end_time ON tasks (past, end_time);
+        CREATE INDEX IF NOT EXISTS tasks_completed ON tasks (completed);
+        CREATE INDEX IF NOT EXISTS tasks_importance ON tasks (importance);
+        CREATE INDEX IF NOT EXISTS tasks_type ON tasks (type);
+        CREATE TABLE IF NOT EXISTS chunks (
+            timemap TEXT NOT NULL,
+            start_time REAL NOT NULL,
+            duration REAL NOT NULL,
+            task_allocated TEXT,
+            key TEXT,
+            PRIMARY KEY (timemap, start_time)
+        );
+        CREATE TABLE IF NOT EXISTS timemaps (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self,
+                 path: str,
+                 fetch_size: int=1000):
+        """
+        :param path: the path to the database file, whose directory is
+            taken as the data directory
+        :param fetch_size: the number of rows streamed at a time
+        """
+        self.path = path
+        if path != ':memory:':
+            self.root = os.path.dirname(os.path.abspath(path))
+        self.fetch_size = fetch_size
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        with self._lock:
+            self.connection.executescript(self.SCHEMA)
+
+            # Databases created before versions were added have none
+            columns = [row[1] for row in self.connection.execute(
+                "PRAGMA table_info(threads)")]
+            if 'version' not in columns:
+                with self.connection:
+                    self.connection.execute(
+                        "ALTER TABLE threads "
+                        "ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+        # The versions of the threads and time maps last loaded or
+        # saved, by name
+        self.versions = {}
+        self.timemap_versions = {}
+
+    def close(self):
+        """
+        Close the connection to the database.
+        """
+        with self._lock:
+            self.connection.close()
+
+    def _fetch(self,
+               query: str,
+               parameters=()):
+        """
+        Run a query and fetch all of its rows.
+
+        :rtype: list
+        """
+        with self._lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def _stream(self,
+                query: str,
+                parameters=()):
+        """
+        Lazily generate the rows of a query, fetching fetch_size rows at
+        a time and holding the lock only while fetching.
+        """
+        with self._lock:
+            cursor = self.connection.execute(query, parameters)
+        try:
+            while True:
+                with self._lock:
+                    rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            with self._lock:
+                cursor.close()
+
+    @staticmethod
+    def _task_row(task, thread_name: str, past: bool):
+        """
+        Get the row storing a task.
+        """
+        if isinstance(task, Event):
+            typ = 'event'
+        elif isinstance(task, Assignment):
+            typ = 'assignment'
+        else:
+            typ = 'task'
+        end_time = task.end_time
+
+        return (str(task.uid), thread_name, typ,
+                end_time.timestamp() if end_time is not None else None,
+                int(task.completed), task.importance, int(past),
+                json.dumps(task.to_json()))
+
+    def _threads_from_rows(self,
+                           query: str,
+                           parameters=()):
+        """
+        Build threads from the (thread_name, data) rows of a query.
+        """
+        with METRICS.timer('io'):
+            importances = dict(self._fetch(
+                "SELECT name, default_importance FROM threads"))
+            rows = self._fetch(query, parameters)
+        METRICS.count('bytes_read', sum(len(data) for _, data in rows))
+
+        with METRICS.timer('deserialize'):
+            tasks = {}
+            for thread_name, data in rows:
+                tasks.setdefault(thread_name, []).append(json.loads(data))
+
+            threads = [Thread.from_json({
+                'name': thread_name,
+                'default_importance': importances.get(thread_name),
+                'tasks': thread_tasks
+            }) for thread_name, thread_tasks in tasks.items()]
+        METRICS.count('tasks_decoded', len(rows))
+        return threads
+
+    def load_threads(self):
+        threads = self._threads_from_rows(
+            "SELECT thread_name, data FROM tasks WHERE past = 0")
+
+        # Threads without future tasks are loaded empty
+        loaded = {thread.name for thread in threads}
+        for name, default_importance, version in self._fetch(
+                "SELECT name, default_importance, version FROM threads"):
+            self.versions[name] = version
+            if name not in loaded:
+                thread = Thread(name, default_importance)
+                thread.mark_clean()
+                threads.append(thread)
+
+        return threads
+
+    def _update_version(self,
+                        table: str,
+                        name: str,
+                        version: int or None,
+                        **columns):
+        """
+        Increment the version of a thread or time map, provided it is
+        still the given version, None meaning that it is not stored
+        yet, and set other columns of its row.  The caller should hold
+        the lock and be in a transaction.
+
+        :return : the new version, or None if it has changed
+        :rtype: int
+        """
+        if version is None:
+            names = ", ".join(['name', 'version'] + list(columns))
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO {0} ({1}) VALUES ({2})".format(
+                    table, names, ", ".join("?" * (len(columns) + 2))),
+                [name, 1] + list(columns.values()))
+        else:
+            assignments = "".join(", {0} = ?".format(column)
+                                  for column in columns)
+            cursor = self.connection.execute(
+                "UPDATE {0} SET version = version + 1{1} "
+                "WHERE name = ? AND version = ?".format(table, assignments),
+                list(columns.values()) + [name, version])
+        if cursor.rowcount != 1:
+            return None
+        return (version or 0) + 1
+
+    def save_threads(self, threads: list):
+        report = {'files': 0, 'bytes': 0, 'conflicts': []}
+        with METRICS.timer('serialize'):
+            rows = [([self._task_row(task, thread_past.name, True)
+                      for task in thread_past.tasks],
+                     [self._task_row(task, thread_future.name, False)
+                      for task in thread_future.tasks],
+                     thread_future)
+                    for thread_past, thread_future in threads]
+        METRICS.count('tasks_encoded',
+                      sum(len(past) + len(future) for past, future, _ in rows))
+
+        task_rows = []
+        versions = {}
+        with METRICS.timer('io'), self._lock, self.connection:
+            for past_rows, future_rows, thread_future in rows:
+                version = self._update_version(
+                    'threads', thread_future.name,
+                    self.versions.get(thread_future.name),
+                    default_importance=thread_future.default_importance)
+                if version is None:
+                    report['conflicts'].append(thread_future.name)
+                    continue
+                versions[thread_future.name] = version
+                # Future tasks removed from the thread are not saved
+                self.connection.execute(
+                    "DELETE FROM tasks WHERE past = 0 AND thread_name = ?",
+                    (thread_future.name,))
+                task_rows.extend(past_rows)
+                task_rows.extend(future_rows)
+
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                task_rows)
+        self.versions.update(versions)
+
+        if task_rows:
+            report['files'] = 1
+        report['bytes'] = sum(len(row[-1]) for row in task_rows)
+        return report
+
+    def load_past_thread(self, thread_name: str):
+        threads = self._threads_from_rows(
+            "SELECT thread_name, data FROM tasks "
+            "WHERE past = 1 AND thread_name = ?", (thread_name,))
+        return threads[0] if threads else None
+
+    def iter_past_tasks(self,
+                        thread_names: list=None,
+                        start_time: Datetime=None,
+                        end_time: Datetime=None):
+        query = "SELECT data FROM tasks WHERE past = 1"
+        parameters = []
+        if thread_names is not None:
+            thread_names = list(thread_names)
+            query += " AND thread_name IN ({0})".format(
+                ", ".join("?" * len(thread_names)))
+            parameters.extend(thread_names)
+        if start_time is not None:
+            query += " AND (end_time IS NULL OR end_time > ?)"
+            parameters.append(start_time.timestamp())
+
+        for data, in self._stream(query, parameters):
+            task_json = json.loads(data)
+            if in_time_range(task_json, end_time=end_time):
+                yield Thread.task_from_json(task_json)
+
+    def query_tasks(self,
+                    thread_name: str=None,
+                    typ: str=None,
+                    completed: bool=None,
+                    min_importance: float=None,
+                    end_after: Datetime=None,
+                    end_before: Datetime=None,
+                    past: bool=None):
+        """
+        Load the tasks matching all of the given conditions, using the
+        indexes on the tasks table.
+
+        :param thread_name: the name of the thread of the tasks
+        :param typ: the type of the tasks: task, event or assignment
+        :param completed: whether the tasks are completed
+        :param min_importance: the minimum importance of the tasks
+        :param end_after: the time after which the tasks end
+        :param end_before: the time before which the tasks end
+        :param past: whether the tasks are past
+        :return : the matching tasks
+        :rtype: list
+        """
+        conditions = []
+        parameters = []
+        for condition, value in (("thread_name = ?", thread_name),
+                                 ("type = ?", typ),
+                                 ("completed = ?", completed),
+                                 ("importance >= ?", min_importance),
+                                 ("end_time >= ?", end_after),
+                                 ("end_time < ?", end_before),
+                                 ("past = ?", past)):
+            if value is None:
+                continue
+            if isinstance(value, Datetime):
+                value = value.timestamp()
+            elif isinstance(value, bool):
+                value = int(value)
+            conditions.append(condition)
+            parameters.append(value)
+
+        query = "SELECT thread_name, data FROM tasks"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        return [task for thread in self._threads_from_rows(query, parameters)
+                for task in thread.tasks]
+
+    def compact(self):
+        with self._lock:
+            self.connection.execute("VACUUM")
+        return 0
+
+    def load_timemap(self, name: str):
+        with self._lock:
+            rows = self._fetch("SELECT version FROM timemaps WHERE name = ?",
+                               (name,))
+            self.timemap_versions[name] = rows[0][0] if rows else None
+            return RunIndex.from_chunks(self.iter_timemap(name))
+
+    def iter_timemap(self,
+                     name: str,
+                     start_time: Datetime=None,
+                     end_time: Datetime=None):
+        start = float('-inf') if start_time is None else \
+            start_time.timestamp()
+        end = float('inf') if end_time is None else end_time.timestamp()
+        for start_time, duration, task_allocated, key in \
+                self._stream(
+                    "SELECT start_time, duration, task_allocated, key "
+                    "FROM chunks WHERE timemap = ? "
+                    "AND start_time + duration > ? AND start_time < ? "
+                    "ORDER BY start_time",
+                    (name, start, end)):
+            chunk = AllocatedTimeChunk(Datetime.from_json(start_time),
+                                       Timedelta(seconds=duration))
+            if task_allocated:
+                chunk.set_task_allocated(task_allocated,
+                                         key and json.loads(key))
+            yield chunk
+
+    def save_timemap(self,
+                     name: str,
+                     timemap: IntervalIndex):
+        rows = [(name, chunk.start_time.timestamp(),
+                 chunk.duration.total_seconds(), chunk.get_task_allocated(),
+                 json.dumps(chunk.get_key()))
+                for chunk in timemap]
+
+        with self._lock, self.connection:
+            version = self._update_version('timemaps', name,
+                                           self.timemap_versions.get(name))
+            if version is None:
+                return False
+            self.connection.execute("DELETE FROM chunks WHERE timemap = ?",
+                                    (name,))
+            self.connection.executemany(
+                "INSERT INTO chunks VALUES (?, ?, ?, ?, ?)", rows)
+        self.timemap_versions[name] = version
+        return True
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+This module contains streaming readers for stored threads and time
+maps, which decode the tasks in a thread file or the chunks in a time
+map file one at a time so that archives of past tasks and time can be
+read in bounded memory.
+
+Module structure:
+- JSONStream
+- iter_json_array
+- iter_thread_file
+- in_time_range
+"""
+
+import json
+import re
+
+from timemap.util import Datetime
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'JSONStream',
+    'iter_json_array',
+    'iter_thread_file',
+    'in_time_range'
+]
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class JSONStream(object):
+    """
+    Decodes JSON values one at a time from a file read in blocks.  Only
+    the current block and the value being decoded are held in memory.
+
+    >>> import io
+    >>> stream = JSONStream(io.StringIO('[12345, {"a": [1, 2]}]'), 4)
+    >>> stream.expect('[')
+    >>> stream.decode()
+    12345
+    >>> stream.next_item(']')
+    True
+    >>> stream.decode()
+    {'a': [1, 2]}
+    >>> stream.next_item(']')
+    False
+    """
+    decoder = json.JSONDecoder()
+
+    def __init__(self,
+                 f,
+                 block_size: int=1 << 16):
+        """
+        :param f: the file, opened for reading text
+        :param block_size: the number of characters read at a time
+        """
+        self.f = f
+        self.block_size = block_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self):
+        """
+        Read the next block of the file into the buffer, dropping what
+        has already been decoded.
+
+        :return : whether anything was read
+        :rtype: bool
+        """
+        data = self.f.read(self.block_size)
+        if not data:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespace and get the next character, or '' at the end of
+        the file.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read():
+                return ''
+
+    def expect(self, char: str):
+        """
+        Skip whitespace and the next character, which must be char.
+
+        :param char: the expected character
+        """
+        if self.peek() != char:
+            raise ValueError("Invalid JSON: expected '{0}' at offset "
+                             "{1}. ".format(char, self.pos))
+        self.pos += 1
+
+    def decode(self):
+        """
+        Decode the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._read():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the
+            # next block
+            if end == len(self.buffer) and self._read():
+                continue
+            self.pos = end
+            return value
+
+    def next_item(self, close: str):
+        """
+        Skip the separator after an item of an array or object.
+
+        :param close: the character closing the array or object
+        :return : whether another item follows
+        :rtype: bool
+        """
+        if self.peek() == ',':
+            self.pos += 1
+            return True
+        self.expect(close)
+        return False
+
+
+def _iter_array(stream: JSONStream):
+    """
+    Lazily decode the items of the array starting at the next
+    character of a stream.
+    """
+    stream.expect('[')
+    if stream.peek() == ']':
+        stream.pos += 1
+        return
+    while True:
+        yield stream.decode()
+        if not stream.next_item(']'):
+            return
+
+
+def iter_json_array(file_path: str,
+                    array_key: str,
+                    block_size: int=1 << 16):
+    """
+    Lazily read the items of the array under a key of the JSON object
+    in a file one at a time.  A file holding an array rather than an
+    object is read as that array.
+
+    >>> import os, tempfile
+    >>> file_path = os.path.join(tempfile.mkdtemp(), 'planned.json')
+    >>> with open(file_path, 'w') as f:
+    ...     _ = f.write('{"version": 2, "chunks": [[1, 2], [3, 4]]}')
+    >>> list(iter_json_array(file_path, 'chunks', block_size=8))
+    [[1, 2], [3, 4]]
+
+    :param file_path: the path to the file
+    :param array_key: the key of the array
+    :param block_size: the number of characters read at a time
+    """
+    with open(file_path, 'r') as f:
+        stream = JSONStream(f, block_size)
+        if stream.peek() == '[':
+            yield from _iter_array(stream)
+            return
+
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.decode()
+            stream.expect(':')
+            if key == array_key:
+                yield from _iter_array(stream)
+            else:
+                stream.decode()
+            if not stream.next_item('}'):
+                return
+
+
+def iter_thread_file(file_path: str,
+                     block_size: int=1 << 16):
+    """
+    Lazily read the JSON representation of a thread from file, yielding
+    the JSON dictionaries of its tasks one at a time.
+
+    :param file_path: the path to the thread file
+    :param block_size: the number of characters read at a time
+    """
+    return iter_json_array(file_path, 'tasks', block_size)
+
+
+def in_time_range(d: dict,
+                  start_time: Datetime=None,
+                  end_time: Datetime=None):
+    """
+    Return if the task with a JSON representation overlaps the time
+    range between start_time and end_time, decoding only its start and
+    end times.  A missing bound leaves the range open on that side.
+
+    >>> from threads.task import Task
+    >>> from timemap.util import Timedelta
+    >>> start = Datetime(2015, 1, 12)
+    >>> d = Task('write', start, start + Timedelta.DAY).to_json()
+    >>> [in_time_range(d, start + hours * Timedelta.HOUR)
+    ...  for hours in (1, 24)]
+    [True, False]
+
+    :param d: JSON dictionary for the task
+    :param start_time: the start of the time range
+    :param end_time: the end of the time range
+    """
+    if start_time is not None:
+        task_end_time = Datetime.from_json(d.get('end_time', None))
+        if task_end_time is not None and task_end_time <= start_time:
+            return False
+    if end_time is not None:
+        task_start_time = Datetime.from_json(d.get('start_time', None))
+        if task_start_time is not None and task_start_time >= end_time:
+            return False
+    return True
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the detection of conflicts between events, the
+times at which two events, usually in different threads, take place at
+once.
+
+Module structure:
+- Conflict
+- iter_occurrences
+- find_conflicts
+- ConflictIndex
+"""
+
+import bisect
+import heapq
+
+from threads.thread import Thread
+from threads.task import Task, Event
+from timemap.util import Datetime, Timedelta
+from timemap.time import TimeChunk
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'Conflict',
+    'iter_occurrences',
+    'find_conflicts',
+    'ConflictIndex'
+]
+
+
+class Conflict(object):
+    """
+    A conflict between an occurrence of one event and an occurrence of
+    another, lasting from start_time to end_time.
+    """
+    __slots__ = ('first', 'first_thread', 'second', 'second_thread',
+                 'start_time', 'end_time')
+
+    def __init__(self,
+                 first: Event,
+                 first_thread: str,
+                 second: Event,
+                 second_thread: str,
+                 start_time: Datetime,
+                 end_time: Datetime):
+        """
+        :param first: the event which starts first
+        :param first_thread: the name of the thread of the first event
+        :param second: the other event
+        :param second_thread: the name of the thread of the other event
+        :param start_time: the start of the time both take place
+        :param end_time: the end of the time both take place
+        """
+        self.first = first
+        self.first_thread = first_thread
+        self.second = second
+        self.second_thread = second_thread
+        self.start_time = start_time
+        self.end_time = end_time
+
+    def __repr__(self):
+        return "Conflict('{0.first.name}' in {0.first_thread}, " \
+               "'{0.second.name}' in {0.second_thread}, " \
+               "{0.start_time}-{0.end_time})".format(self)
+
+
+def _expand(event: Event,
+            thread_name: str,
+            start_time: Datetime,
+            end_time: Datetime):
+    """
+    Lazily generate the (start_time, end_time, event, thread_name)
+    occurrences of an event within a window, in order.
+    """
+    for chunk in event.occurrences(start_time, end_time):
+        yield chunk.start_time, chunk.end_time, event, thread_name
+
+
+def iter_occurrences(threads: list,
+                     start_time: Datetime,
+                     end_time: Datetime):
+    """
+    Lazily generate the occurrences of the events in threads within a
+    window, in order of start time.  The occurrences of each event are
+    expanded as they are needed, and the periods of repeating events
+    before the window are never expanded, so only the current occurrence
+    of each event is held in memory.
+
+    :param threads: the threads
+    :param start_time: the start of the window
+    :param end_time: the end of the window
+    :return : (start_time, end_time, event, thread_name) tuples
+    """
+    return heapq.merge(*(_expand(task, thread.name, start_time, end_time)
+                         for thread in threads
+                         for task in thread.tasks
+                         if isinstance(task, Event)),
+                       key=lambda occurrence: occurrence[0])
+
+
+def find_conflicts(threads: list,
+                   start_time: Datetime,
+                   end_time: Datetime,
+                   across_threads: bool=False):
+    """
+    Find every pair of occurrences of different events in threads which
+    overlap within a window.  The occurrences are swept in order of
+    start time, with those still taking place kept in a min-heap by end
+    time, so each occurrence is only compared with those it overlaps:
+    this takes O(n log n + k) time for n occurrences and k conflicts.
+
+    >>> start = Datetime(2015, 1, 12)
+    >>> work, home = Thread('work', 5), Thread('home', 5)
+    >>> standup = Event('standup', start, start + 30 * Timedelta.DAY,
+    ...                 repeat=Event.EventRepeat(True, Timedelta.DAY))
+    >>> standup.add_appointment(TimeChunk(start + 9 * Timedelta.HOUR))
+    >>> work.add_task(standup)
+    >>> dentist = start + Timedelta(days=20, hours=9, minutes=10)
+    >>> home.add_task(Event('dentist', dentist, dentist + Timedelta.HOUR))
+    >>> conflicts = find_conflicts([work, home], start,
+    ...                            start + 30 * Timedelta.DAY)
+    >>> [(c.first.name, c.second.name, c.start_time.strftime('%m-%d %H:%M'),
+    ...   c.end_time.strftime('%H:%M')) for c in conflicts]
+    [('standup', 'dentist', '02-01 09:10', '09:15')]
+
+    :param threads: the threads
+    :param start_time: the start of the window
+    :param end_time: the end of the window
+    :param across_threads: whether only conflicts between events in
+        different threads are found
+    :return : the conflicts, in order of start time
+    :rtype: list
+    """
+    conflicts = []
+    # (end_time, counter, occurrence)
+    active = []
+    counter = 0
+
+    for occurrence in iter_occurrences(threads, start_time, end_time):
+        start, end, event, thread_name = occurrence
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+
+        for other_end, _, other in active:
+            if other[2] is event or \
+                    (across_threads and other[3] == thread_name):
+                continue
+            conflicts.append(Conflict(other[2], other[3], event,
+                                      thread_name, start,
+                                      min(end, other_end)))
+
+        heapq.heappush(active, (end, counter, occurrence))
+        counter += 1
+
+    return conflicts
+
+
+class ConflictIndex(object):
+    """
+    An index over the occurrences of events within a window, used to
+    check a new or moved event for conflicts with the events already
+    indexed without sweeping them all again.  Occurrences are kept
+    sorted by start time, and since none lasts longer than the longest
+    indexed, those overlapping a time range are found with binary
+    searches in O(log n + m) time, where m is the number of occurrences
+    starting within the longest duration before the range.
+
+    The index can listen to a threads.index.TaskIndex, so that events
+    are indexed again when they are added or changed, and the conflicts
+    found are collected in found until they are popped.
+
+    >>> start = Datetime(2015, 1, 12)
+    >>> index = ConflictIndex(start, start + Timedelta.WEEK)
+    >>> lunch = Event('lunch', start + 12 * Timedelta.HOUR,
+    ...               start + 13 * Timedelta.HOUR)
+    >>> index.add(lunch, 'home')
+    []
+    >>> call = Event('call', start + 9 * Timedelta.HOUR,
+    ...              start + 10 * Timedelta.HOUR)
+    >>> index.add(call, 'work')
+    []
+    >>> call.change_time(start + Timedelta(hours=12, minutes=30),
+    ...                  start + Timedelta(hours=13, minutes=30))
+    >>> [(c.first.name, c.second.name, c.start_time.strftime('%H:%M'),
+    ...   c.end_time.strftime('%H:%M')) for c in index.add(call, 'work')]
+    [('lunch', 'call', '12:30', '13:00')]
+    """
+    def __init__(self,
+                 start_time: Datetime,
+                 end_time: Datetime,
+                 across_threads: bool=False):
+        """
+        :param start_time: the start of the window
+        :param end_time: the end of the window
+        :param across_threads: whether only conflicts between events in
+            different threads are found
+        """
+        self.start_time = start_time
+        self.end_time = end_time
+        self.across_threads = across_threads
+
+        self._starts = []
+        # (start_time, end_time, event, thread_name)
+        self._occurrences = []
+        self._events = {}
+        self._max_duration = Timedelta(0)
+        self.found = []
+
+    def __len__(self):
+        return len(self._occurrences)
+
+    def __contains__(self, event: Event):
+        return event in self._events
+
+    def _overlapping(self,
+                     start_time: Datetime,
+                     end_time: Datetime):
+        """
+        Get the indexed occurrences which overlap a time range.
+        """
+        lo = bisect.bisect_left(self._starts, start_time - self._max_duration)
+        hi = bisect.bisect_left(self._starts, end_time)
+        return [occurrence for occurrence in self._occurrences[lo:hi]
+                if occurrence[1] > start_time]
+
+    def check(self,
+              event: Event,
+              thread_name: str=None):
+        """
+        Find the conflicts of an event with the indexed events, other
+        than itself, without indexing it.
+
+        :param event: the event
+        :param thread_name: the name of the thread of the event
+        :return : the conflicts, in order of the occurrences of the
+            event
+        :rtype: list
+        """
+        conflicts = []
+        for start, end, _, _ in _expand(event, thread_name,
+                                        self.start_time, self.end_time):
+            for other in self._overlapping(start, end):
+                if other[2] is event or \
+                        (self.across_threads and other[3] == thread_name):
+                    continue
+                if other[0] <= start:
+                    conflicts.append(Conflict(other[2], other[3],
+                                              event, thread_name,
+                                              start, min(end, other[1])))
+                else:
+                    conflicts.append(Conflict(event, thread_name,
+                                              other[2], other[3],
+                                              other[0], min(end, other[1])))
+        return conflicts
+
+    def add(self,
+            event: Event,
+            thread_name: str=None):
+        """
+        Index an event, or index it again once it has been moved, and
+        find its conflicts with the other indexed events.
+
+        :param event: the event
+        :param thread_name: the name of the thread of the event
+        :return : the conflicts, in order of the occurrences of the
+            event
+        :rtype: list
+        """
+        self.remove(event)
+        conflicts = self.check(event, thread_name)
+
+        occurrences = list(_expand(event, thread_name,
+                                   self.start_time, self.end_time))
+        for occurrence in occurrences:
+            i = bisect.bisect_right(self._starts, occurrence[0])
+            self._starts.insert(i, occurrence[0])
+            self._occurrences.insert(i, occurrence)
+            self._max_duration = max(self._max_duration,
+                                     occurrence[1] - occurrence[0])
+        self._events[event] = occurrences
+        return conflicts
+
+    def remove(self, event: Event):
+        """
+        Remove an event from the index.  Does nothing if it is not
+        indexed.
+
+        :param event: the event
+        """
+        for occurrence in self._events.pop(event, ()):
+            i = bisect.bisect_left(self._starts, occurrence[0])
+            while self._occurrences[i] is not occurrence:
+                i += 1
+            del self._starts[i]
+            del self._occurrences[i]
+
+    def pop_found(self):
+        """
+        Get and forget the conflicts found since the last call.
+
+        :rtype: list
+        """
+        found, self.found = self.found, []
+        return found
+
+    def task_indexed(self,
+                     task: Task,
+                     thread_name: str):
+        """
+        Index an event once it has been added to a TaskIndex or changed,
+        and collect its conflicts in found.
+
+        :param task: the task
+        :param thread_name: the name of the thread of the task
+        """
+        if isinstance(task, Event):
+            self.found.extend(self.add(task, thread_name))
+
+    def task_unindexed(self, task: Task):
+        """
+        Remove an event once it has been removed from a TaskIndex.
+
+        :param task: the task
+        """
+        self.remove(task)
+
+    def index_cleared(self):
+        """
+        Remove all events once a TaskIndex has been cleared.
+        """
+        self._starts = []
+        self._occurrences = []
+        self._events = {}
+        self._max_duration = Timedelta(0)
@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the indexes over the tasks of a TaskManager used
+to answer queries about them without scanning every task in every
+thread.
+
+Module structure:
+- SortedIndex
+- TaskIndex
+- TaskQuery
+"""
+
+import bisect
+import uuid
+
+from threads.thread import Thread, LazyThread
+from threads.task import Task, Assignment
+from timemap.util import Datetime, Timedelta
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'SortedIndex',
+    'TaskIndex',
+    'TaskQuery'
+]
+
+
+class SortedIndex(object):
+    """
+    An index of tasks sorted by a time, such as their end times, as a
+    sorted list of timestamps and a parallel list of tasks.  A task may
+    appear once for each of several times.
+    """
+    def __init__(self):
+        self._times = []
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._times)
+
+    def add(self,
+            time: float,
+            task: Task):
+        """
+        Add a task at a time.
+
+        :param time: the timestamp
+        :param task: the task
+        """
+        i = bisect.bisect_right(self._times, time)
+        self._times.insert(i, time)
+        self._tasks.insert(i, task)
+
+    def remove(self,
+               time: float,
+               task: Task):
+        """
+        Remove a task at a time.  Does nothing if it is not there.
+
+        :param time: the timestamp
+        :param task: the task
+        """
+        i = bisect.bisect_left(self._times, time)
+        while i < len(self._times) and self._times[i] == time:
+            if self._tasks[i] is task:
+                del self._times[i]
+                del self._tasks[i]
+                return
+            i += 1
+
+    def _range(self,
+               start_time: Datetime=None,
+               end_time: Datetime=None):
+        lo = 0 if start_time is None else \
+            bisect.bisect_left(self._times, start_time.timestamp())
+        hi = len(self._times) if end_time is None else \
+            bisect.bisect_left(self._times, end_time.timestamp())
+        return lo, hi
+
+    def count(self,
+              start_time: Datetime=None,
+              end_time: Datetime=None):
+        """
+        Count the tasks at times between start_time and end_time.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        lo, hi = self._range(start_time, end_time)
+        return max(hi - lo, 0)
+
+    def between(self,
+                start_time: Datetime=None,
+                end_time: Datetime=None):
+        """
+        Get the tasks at times between start_time and end_time, in order
+        of time and without repeats.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        lo, hi = self._range(start_time, end_time)
+        return list(dict.fromkeys(self._tasks[lo:hi]))
+
+
+class TaskIndex(object):
+    """
+    Indexes over tasks: the map from uid to task, the sets of tasks of
+    each thread, of each type and by completion, and the tasks sorted
+    by end time and by deadline.  Indexed tasks and threads are
+    observed, so that the indexes are updated whenever a task is added
+    to a thread or changes its times, importance, completion or
+    deadlines (see Task.set_observer).  The tasks of each thread are
+    also kept by thread, rather than by name, so that threads with the
+    same name do not replace each other's tasks when they change.
+
+    The deadlines of repeating assignments recur without end, so rather
+    than being sorted, they are found when queried from the next
+    occurrence of each (see Assignment.next_occurrence_after).
+
+    Lazy threads (see threads.thread.LazyThread) are not decoded when
+    they are added: their tasks are indexed once they are decoded, by
+    whoever first accesses them or, at the latest, by the first lookup
+    or query (see materialize).
+
+    Listeners, such as a threads.ranking.Ranking, are told of every
+    change to the indexed tasks: task_indexed is called with a task and
+    the name of its thread when it is added or indexed again after a
+    change, task_unindexed with a task when it is removed and
+    index_cleared when all tasks are removed.
+
+    >>> index = TaskIndex()
+    >>> thread = Thread('work', 5)
+    >>> index.add_thread(thread)
+    >>> start = Datetime(2015, 1, 12)
+    >>> thread.add_task(Task('write', start, start + Timedelta.HOUR))
+    >>> thread.add_task(Task('read', start, start + Timedelta.DAY))
+    >>> [task.name for task in index.query().ends_between(
+    ...     start, start + Timedelta.DAY)]
+    ['write']
+    >>> thread.tasks[1].change_time(start, start + Timedelta(minutes=30))
+    >>> [task.name for task in index.query().ends_between(
+    ...     start, start + Timedelta.DAY).order_by_end_time()]
+    ['read', 'write']
+    >>> other = Thread('work', 5)
+    >>> index.add_thread(other)
+    >>> other.tasks = [Task('plan', start, start + Timedelta.HOUR)]
+    >>> index.thread_changed(other)
+    >>> sorted(task.name for task in index.query().thread('work'))
+    ['plan', 'read', 'write']
+    >>> weekly = Assignment('report', Timedelta.HOUR,
+    ...                     repeat=Assignment.AssignmentRepeat(
+    ...                         True, Timedelta.WEEK))
+    >>> weekly.change_time(start, start + 52 * Timedelta.WEEK)
+    >>> weekly.add_deadline(start + Timedelta.DAY)
+    >>> thread.add_task(weekly)
+    >>> [task.name for task in index.query().due_between(
+    ...     start + 10 * Timedelta.WEEK, start + 11 * Timedelta.WEEK)]
+    ['report']
+    """
+    def __init__(self):
+        # uid: task
+        self.tasks = {}
+        self.threads = {}
+        self.threads_by_name = {}
+        self.by_thread = {}
+        self.by_type = {}
+        self.by_completed = {False: set(), True: set()}
+        self.end_times = SortedIndex()
+        self.deadlines = SortedIndex()
+        self.repeating = set()
+
+        # task: (thread_name, end_timestamp, deadline_timestamps,
+        #        id(thread))
+        self._entries = {}
+        # id(thread): the indexed tasks of the thread
+        self._thread_tasks = {}
+        # id(thread): lazy thread whose tasks have not been decoded
+        self._unloaded = {}
+        self.listeners = []
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __contains__(self, task: Task):
+        return task in self._entries
+
+    def clear(self):
+        """
+        Remove all tasks and threads from the indexes.  The map from uid
+        to task is cleared in place.
+        """
+        for thread in self.threads.values():
+            self._unobserve(thread)
+        self.tasks.clear()
+        self.threads = {}
+        self.threads_by_name = {}
+        self.by_thread = {}
+        self.by_type = {}
+        self.by_completed = {False: set(), True: set()}
+        self.end_times = SortedIndex()
+        self.deadlines = SortedIndex()
+        self.repeating = set()
+        self._entries = {}
+        self._thread_tasks = {}
+        self._unloaded = {}
+        for listener in self.listeners:
+            listener.index_cleared()
+
+    @staticmethod
+    def _unobserve(thread: Thread):
+        thread.observer = None
+        if isinstance(thread, LazyThread) and not thread.is_loaded():
+            return
+        for task in thread.tasks:
+            task.set_observer(None)
+
+    def add_thread(self, thread: Thread):
+        """
+        Add a thread and all its tasks to the indexes.  The tasks of a
+        lazy thread which have not been decoded are added once they are.
+
+        :param thread: the thread
+        """
+        self.threads[id(thread)] = thread
+        self.threads_by_name[thread.name] = thread
+        self.by_thread.setdefault(thread.name, set())
+        self._thread_tasks.setdefault(id(thread), set())
+        thread.observer = self
+        if isinstance(thread, LazyThread) and not thread.is_loaded():
+            self._unloaded[id(thread)] = thread
+            return
+        for task in thread.tasks:
+            self.add(task, thread.name, thread)
+
+    def materialize(self):
+        """
+        Decode the tasks of the lazy threads which have not been
+        decoded yet, which adds them to the indexes.
+        """
+        for thread in list(self._unloaded.values()):
+            # Decoding the tasks calls thread_changed
+            thread.tasks
+
+    def remove_thread(self, thread: Thread):
+        """
+        Remove a thread and all its tasks from the indexes.
+
+        :param thread: the thread
+        """
+        if self.threads.pop(id(thread), None) is None:
+            return
+        self._unloaded.pop(id(thread), None)
+        if self.threads_by_name.get(thread.name) is thread:
+            del self.threads_by_name[thread.name]
+        for task in list(self._thread_tasks.pop(id(thread), ())):
+            self.remove(task)
+        self._unobserve(thread)
+
+    def add(self,
+            task: Task,
+            thread_name: str,
+            thread: Thread=None):
+        """
+        Add a task of a thread to the indexes.
+
+        :param task: the task
+        :param thread_name: the name of the thread of the task
+        :param thread: the thread of the task, if it is indexed
+        """
+        self._add(task, thread_name, None if thread is None else id(thread))
+
+    def _add(self,
+             task: Task,
+             thread_name: str,
+             thread_key: int or None):
+        """
+        Add a task of the thread with a key, its id, to the indexes.
+        """
+        if task in self._entries:
+            self.remove(task)
+
+        end_time = task.end_timestamp
+        deadlines = ()
+        if isinstance(task, Assignment):
+            if task.repeat:
+                self.repeating.add(task)
+            else:
+                deadlines = tuple(sorted(task.deadline_timestamps))
+
+        self._entries[task] = (thread_name, end_time, deadlines, thread_key)
+        if thread_key is not None:
+            self._thread_tasks.setdefault(thread_key, set()).add(task)
+        self.tasks[task.uid] = task
+        self.by_thread.setdefault(thread_name, set()).add(task)
+        self.by_type.setdefault(type(task), set()).add(task)
+        self.by_completed[bool(task.completed)].add(task)
+        if end_time is not None:
+            self.end_times.add(end_time, task)
+        for deadline in deadlines:
+            self.deadlines.add(deadline, task)
+        task.set_observer(self)
+        for listener in self.listeners:
+            listener.task_indexed(task, thread_name)
+
+    def remove(self, task: Task):
+        """
+        Remove a task from the indexes.  Does nothing if it is not
+        indexed.
+
+        :param task: the task
+        """
+        entry = self._entries.pop(task, None)
+        if entry is None:
+            return
+        thread_name, end_time, deadlines, thread_key = entry
+
+        if thread_key in self._thread_tasks:
+            self._thread_tasks[thread_key].discard(task)
+        self.repeating.discard(task)
+        self.tasks.pop(task.uid, None)
+        self.by_thread[thread_name].discard(task)
+        self.by_type[type(task)].discard(task)
+        self.by_completed[False].discard(task)
+        self.by_completed[True].discard(task)
+        if end_time is not None:
+            self.end_times.remove(end_time, task)
+        for deadline in deadlines:
+            self.deadlines.remove(deadline, task)
+        task.set_observer(None)
+        for listener in self.listeners:
+            listener.task_unindexed(task)
+
+    def task_added(self,
+                   thread: Thread,
+                   task: Task):
+        """
+        Index a task once it has been added to an indexed thread.
+
+        :param thread: the thread
+        :param task: the task
+        """
+        self.add(task, thread.name, thread)
+
+    def task_changed(self, task: Task):
+        """
+        Index a task again once its times, importance, completion or
+        deadlines have changed.
+
+        :param task: the task
+        """
+        entry = self._entries.get(task)
+        if entry is not None:
+            self._add(task, entry[0], entry[3])
+
+    def thread_changed(self, thread: Thread):
+        """
+        Index the tasks of a thread again once they have been replaced,
+        or decoded.
+
+        :param thread: the thread
+        """
+        self._unloaded.pop(id(thread), None)
+        for task in list(self._thread_tasks.get(id(thread), ())):
+            self.remove(task)
+        for task in thread.tasks:
+            self.add(task, thread.name, thread)
+
+    def get(self, uid: uuid.UUID or str):
+        """
+        Get the task with a uid, or None if there is none.
+
+        :param uid: the uid of the task
+        """
+        if isinstance(uid, str):
+            uid = uuid.UUID(uid)
+        self.materialize()
+        return self.tasks.get(uid)
+
+    def thread_of(self, uid: str):
+        """
+        Get the name of the thread of the task with a uid, or None if
+        there is none.
+
+        :param uid: the uid of the task
+        """
+        task = self.get(uid)
+        if task is None:
+            return None
+        return self._entries[task][0]
+
+    def query(self):
+        """
+        Start a query over the indexed tasks.
+
+        :rtype: TaskQuery
+        """
+        self.materialize()
+        return TaskQuery(self)
+
+
+class TaskQuery(object):
+    """
+    A query over the tasks in a TaskIndex, built by chaining filters.
+    When run, the candidate tasks are taken from the most selective of
+    the indexes the filters can use, the smallest set of tasks, and the
+    other filters are checked on each candidate.
+
+    For example, the incomplete assignments in a thread with importance
+    of at least 7 which are due in a week:
+
+        index.query().thread('work').of_type(Assignment) \\
+            .completed(False).importance(minimum=7) \\
+            .due_between(start, start + Timedelta.WEEK).all()
+    """
+    def __init__(self, index: TaskIndex):
+        """
+        :param index: the indexes queried
+        """
+        self.index = index
+        self._sources = []
+        self._predicates = []
+        self._order = None
+
+    def _filter(self, source, predicate):
+        """
+        Add a filter with a candidate source, a (size, get_candidates)
+        pair or None if no index can be used, and a predicate.
+        """
+        if source is not None:
+            self._sources.append(source)
+        self._predicates.append(predicate)
+        return self
+
+    def thread(self, thread_name: str):
+        """
+        Keep the tasks of a thread.
+
+        :param thread_name: the name of the thread
+        """
+        tasks = self.index.by_thread.get(thread_name, set())
+        return self._filter((len(tasks), lambda: tasks),
+                            lambda task: task in tasks)
+
+    def of_type(self, cls: type):
+        """
+        Keep the tasks of a type, including its subclasses.
+
+        :param cls: the type, such as Event or Assignment
+        """
+        sets = [tasks for typ, tasks in self.index.by_type.items()
+                if issubclass(typ, cls)]
+        return self._filter(
+            (sum(len(tasks) for tasks in sets),
+             lambda: [task for tasks in sets for task in tasks]),
+            lambda task: isinstance(task, cls))
+
+    def completed(self, completed: bool=True):
+        """
+        Keep the tasks which have, or have not, been completed.
+
+        :param completed: whether the tasks have been completed
+        """
+        tasks = self.index.by_completed[bool(completed)]
+        return self._filter((len(tasks), lambda: tasks),
+                            lambda task: task in tasks)
+
+    def ends_between(self,
+                     start_time: Datetime=None,
+                     end_time: Datetime=None):
+        """
+        Keep the tasks which end between start_time and end_time.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        def predicate(task):
+            time = task.end_time
+            return time is not None and \
+                (start_time is None or time >= start_time) and \
+                (end_time is None or time < end_time)
+
+        end_times = self.index.end_times
+        return self._filter(
+            (end_times.count(start_time, end_time),
+             lambda: end_times.between(start_time, end_time)),
+            predicate)
+
+    def due_between(self,
+                    start_time: Datetime=None,
+                    end_time: Datetime=None):
+        """
+        Keep the assignments with a deadline between start_time and
+        end_time.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        def due_repeating():
+            due = []
+            for task in self.index.repeating:
+                if start_time is None:
+                    deadline = min(task.deadlines, default=None)
+                else:
+                    deadline = task.next_occurrence_after(
+                        start_time - Timedelta.resolution)
+                if deadline is not None and \
+                        (end_time is None or deadline < end_time):
+                    due.append(task)
+            return due
+
+        def candidates():
+            return list(dict.fromkeys(
+                deadlines.between(start_time, end_time) +
+                due_repeating()))
+
+        due = None
+
+        def predicate(task):
+            nonlocal due
+            if due is None:
+                due = set(candidates())
+            return task in due
+
+        deadlines = self.index.deadlines
+        return self._filter(
+            (deadlines.count(start_time, end_time) +
+             len(self.index.repeating), candidates),
+            predicate)
+
+    def importance(self,
+                   minimum: float=None,
+                   maximum: float=None):
+        """
+        Keep the tasks with importance between minimum and maximum,
+        inclusive.
+
+        :param minimum: the minimum importance
+        :param maximum: the maximum importance
+        """
+        return self._filter(None, lambda task:
+                            (minimum is None or task.importance >= minimum)
+                            and (maximum is None or
+                                 task.importance <= maximum))
+
+    def where(self, predicate):
+        """
+        Keep the tasks for which a function returns true.
+
+        :param predicate: function taking a task
+        """
+        return self._filter(None, predicate)
+
+    def order_by_end_time(self):
+        """
+        Return the tasks in order of end time, those without one last.
+        """
+        def key(task):
+            end_time = task.end_time
+            if end_time is None:
+                return True, 0
+            return False, end_time.timestamp()
+
+        self._order = key
+        return self
+
+    def __iter__(self):
+        if self._sources:
+            _, candidates = min(self._sources, key=lambda source: source[0])
+            candidates = candidates()
+        else:
+            candidates = self.index.tasks.values()
+
+        tasks = (task for task in candidates
+                 if all(predicate(task) for predicate in self._predicates))
+        if self._order is not None:
+            return iter(sorted(tasks, key=self._order))
+        return tasks
+
+    def all(self):
+        """
+        Run the query.
+
+        :return : the matching tasks
+        :rtype: list
+        """
+        return list(self)
+
+    def count(self):
+        """
+        Run the query and count the matching tasks.
+        """
+        return sum(1 for _ in self)
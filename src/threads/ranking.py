@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the ranking of the pending tasks of a TaskManager
+by urgency, used to answer what should be done next without scoring
+and sorting every task.
+
+Module structure:
+- urgency
+- IndexedHeap
+- Ranking
+"""
+
+import datetime
+import heapq
+import math
+
+from threads.thread import Thread
+from threads.task import Task, Assignment
+from threads.index import TaskIndex
+from timemap.util import Datetime, Timedelta
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'MAX_LEVEL',
+    'urgency',
+    'IndexedHeap',
+    'Ranking'
+]
+
+# The number of levels of slack, in powers of two of hours, above which
+# a deadline does not add to the urgency of a task
+MAX_LEVEL = 12
+
+
+def urgency(task: Task,
+            thread: Thread or None,
+            now: Datetime):
+    """
+    The default scoring function of a Ranking.  The urgency of a task
+    is the mean of its importance and the default importance of its
+    thread, halved for every power of two of hours of slack it has:
+    the time left, after its remaining expected duration, before its
+    nearest deadline.  Tasks with no deadline ahead, or with more than
+    2 ** MAX_LEVEL hours of slack, are halved MAX_LEVEL times.
+
+    Since the slack is only counted in powers of two, the urgency of a
+    task changes a few times as its deadline approaches rather than
+    continuously, and the time of the next change is returned with it.
+
+    >>> start = Datetime(2015, 1, 12)
+    >>> assignment = Assignment('essay', 2 * Timedelta.HOUR, importance=8)
+    >>> assignment.change_time(start, start + Timedelta.WEEK)
+    >>> assignment.add_deadline(start + 6 * Timedelta.HOUR)
+    >>> score, expiry = urgency(assignment, Thread('school', 6), start)
+    >>> score, expiry == start + 2 * Timedelta.HOUR
+    (1.75, True)
+
+    :param task: the task
+    :param thread: the thread of the task, if known
+    :param now: the current time
+    :return : the urgency and the time at which it must next be
+        computed, or None if it does not change with time
+    :rtype: tuple
+    """
+    importance = task.importance
+    if thread is not None:
+        importance = (importance + thread.default_importance) / 2
+
+    deadline = None
+    if isinstance(task, Assignment):
+        deadline = task.next_occurrence_after(now)
+    if deadline is None:
+        return importance / 2 ** MAX_LEVEL, None
+
+    latest_start = deadline
+    if task.expected_duration:
+        latest_start -= task.expected_duration
+    slack = (latest_start - now).total_seconds() / 3600
+
+    if slack <= 1:
+        return importance, deadline
+    level = min(math.ceil(math.log2(slack)), MAX_LEVEL)
+    return importance / 2 ** level, \
+        latest_start - Timedelta(hours=2 ** (level - 1))
+
+
+class IndexedHeap(object):
+    """
+    A binary max-heap of keys by priority which also keeps the position
+    of each key in it, so that the priority of any key can be changed,
+    or the key removed, in O(log n) time.  The k keys of highest
+    priority are found in O(k log k) time, without popping them, by
+    walking down the heap with a second, small heap of candidates.
+
+    >>> heap = IndexedHeap()
+    >>> for key, priority in zip('abcde', (3, 9, 4, 7, 1)):
+    ...     heap.update(key, priority)
+    >>> heap.update('e', 8)
+    >>> heap.remove('b')
+    >>> heap.top(3)
+    [('e', 8), ('d', 7), ('c', 4)]
+    """
+    def __init__(self):
+        # [priority, key]
+        self._entries = []
+        # key: position
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def priority(self, key):
+        """
+        Get the priority of a key, or None if it is not in the heap.
+
+        :param key: the key
+        """
+        i = self._positions.get(key)
+        return None if i is None else self._entries[i][0]
+
+    def _swap(self,
+              i: int,
+              j: int):
+        entries = self._entries
+        entries[i], entries[j] = entries[j], entries[i]
+        self._positions[entries[i][1]] = i
+        self._positions[entries[j][1]] = j
+
+    def _sift_up(self, i: int):
+        entries = self._entries
+        while i > 0:
+            parent = (i - 1) // 2
+            if entries[parent][0] >= entries[i][0]:
+                break
+            self._swap(i, parent)
+            i = parent
+
+    def _sift_down(self, i: int):
+        entries = self._entries
+        size = len(entries)
+        while True:
+            largest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and entries[child][0] > entries[largest][0]:
+                    largest = child
+            if largest == i:
+                break
+            self._swap(i, largest)
+            i = largest
+
+    def update(self,
+               key,
+               priority: float):
+        """
+        Add a key with a priority, or change the priority of a key
+        already in the heap.
+
+        :param key: the key
+        :param priority: the priority
+        """
+        i = self._positions.get(key)
+        if i is None:
+            i = len(self._entries)
+            self._entries.append([priority, key])
+            self._positions[key] = i
+            self._sift_up(i)
+            return
+
+        old_priority = self._entries[i][0]
+        self._entries[i][0] = priority
+        if priority > old_priority:
+            self._sift_up(i)
+        elif priority < old_priority:
+            self._sift_down(i)
+
+    def remove(self, key):
+        """
+        Remove a key.  Does nothing if it is not in the heap.
+
+        :param key: the key
+        """
+        i = self._positions.pop(key, None)
+        if i is None:
+            return
+
+        last = self._entries.pop()
+        if i == len(self._entries):
+            return
+        self._entries[i] = last
+        self._positions[last[1]] = i
+        self._sift_up(i)
+        self._sift_down(self._positions[last[1]])
+
+    def clear(self):
+        """
+        Remove all keys.
+        """
+        self._entries = []
+        self._positions = {}
+
+    def top(self, k: int):
+        """
+        Get the k keys of highest priority, in order.
+
+        :param k: the number of keys
+        :return : (key, priority) pairs
+        :rtype: list
+        """
+        entries = self._entries
+        top = []
+        candidates = [(-entries[0][0], 0)] if entries else []
+        while candidates and len(top) < k:
+            _, i = heapq.heappop(candidates)
+            top.append((entries[i][1], entries[i][0]))
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < len(entries):
+                    heapq.heappush(candidates, (-entries[child][0], child))
+        return top
+
+
+class Ranking(object):
+    """
+    A ranking of the pending tasks in a TaskIndex by a scoring function,
+    urgency by default, kept in an IndexedHeap.  The ranking listens to
+    the index, so that only a task which is added, removed or changed
+    is scored again.  A scoring function also returns the time at which
+    the score of a task must next be computed, if it changes with time;
+    these times are kept in a min-heap, like the expiry index of
+    TaskManager, so that advancing the time only scores again the tasks
+    whose scores have changed.  Tasks are also dropped from the ranking
+    once their end times are reached.
+
+    A scoring function takes a task, its thread and the current time
+    and returns a (score, expiry) pair, where expiry is the first time
+    after the current time at which the score may differ, or None if
+    it does not change with time.  Changes to the default importance
+    of a thread are not observed; rescore_thread must be called after
+    one.
+
+    >>> index = TaskIndex()
+    >>> thread = Thread('work', 5)
+    >>> index.add_thread(thread)
+    >>> start = Datetime(2015, 1, 12)
+    >>> ranking = Ranking(index, now=start)
+    >>> for name, hours in (('report', 30), ('review', 3)):
+    ...     assignment = Assignment(name, Timedelta.HOUR)
+    ...     assignment.change_time(start, start + Timedelta.WEEK)
+    ...     assignment.add_deadline(start + Timedelta(hours=hours))
+    ...     thread.add_task(assignment)
+    >>> [task.name for task, _ in ranking.top(2)]
+    ['review', 'report']
+    >>> thread.tasks[0].add_deadline(start + 2 * Timedelta.HOUR)
+    >>> [task.name for task, _ in ranking.top(2)]
+    ['report', 'review']
+    """
+    def __init__(self,
+                 index: TaskIndex,
+                 score=urgency,
+                 now: Datetime=None):
+        """
+        :param index: the indexed tasks ranked
+        :param score: function taking a task, its thread and the current
+            time and returning its score and the time at which it must
+            next be computed, or None
+        :param now: the current time (defaults to now)
+        """
+        self.index = index
+        self.score = score
+        self.now = now or Datetime.now(datetime.timezone.utc)
+
+        self.heap = IndexedHeap()
+        self._thread_names = {}
+        self._expiry = []
+        self._expiry_times = {}
+        self._counter = 0
+
+        index.materialize()
+        index.listeners.append(self)
+        for thread_name, tasks in index.by_thread.items():
+            for task in tasks:
+                self.task_indexed(task, thread_name)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def _rescore(self, task: Task):
+        """
+        Score a task again at the current time, or drop it from the
+        ranking if it is no longer pending.
+        """
+        thread_name = self._thread_names[task]
+        end_time = task.end_time
+        if task.completed or \
+                (end_time is not None and end_time <= self.now):
+            self.heap.remove(task)
+            self._expiry_times.pop(task, None)
+            return
+
+        score, expiry = self.score(task,
+                                   self.index.threads_by_name.get(thread_name),
+                                   self.now)
+        self.heap.update(task, score)
+
+        if end_time is not None and \
+                (expiry is None or end_time < expiry):
+            expiry = end_time
+        if expiry is None or expiry <= self.now:
+            self._expiry_times.pop(task, None)
+            return
+        expiry_time = expiry.timestamp()
+        if self._expiry_times.get(task) != expiry_time:
+            self._expiry_times[task] = expiry_time
+            heapq.heappush(self._expiry, (expiry_time, self._counter, task))
+            self._counter += 1
+
+    def task_indexed(self,
+                     task: Task,
+                     thread_name: str):
+        """
+        Score a task once it has been added to the index or changed.
+
+        :param task: the task
+        :param thread_name: the name of the thread of the task
+        """
+        self._thread_names[task] = thread_name
+        self._rescore(task)
+
+    def task_unindexed(self, task: Task):
+        """
+        Drop a task once it has been removed from the index.
+
+        :param task: the task
+        """
+        self._thread_names.pop(task, None)
+        self._expiry_times.pop(task, None)
+        self.heap.remove(task)
+
+    def index_cleared(self):
+        """
+        Drop all tasks once the index has been cleared.
+        """
+        self.heap.clear()
+        self._thread_names = {}
+        self._expiry = []
+        self._expiry_times = {}
+
+    def rescore_thread(self, thread_name: str):
+        """
+        Score the tasks of a thread again, such as after a change to its
+        default importance.
+
+        :param thread_name: the name of the thread
+        """
+        for task in self.index.by_thread.get(thread_name, ()):
+            self._rescore(task)
+
+    def advance(self, now: Datetime=None):
+        """
+        Move the ranking on to a later time, scoring again only the
+        tasks whose scores have changed since the last time.  Entries
+        left behind by tasks which have since been scored again, or
+        dropped, are discarded.
+
+        :param now: the current time (defaults to now)
+        :return : the number of tasks scored again
+        :rtype: int
+        """
+        if now is None:
+            now = Datetime.now(datetime.timezone.utc)
+        if now < self.now:
+            raise Exception("Invalid time: ranking cannot move back")
+        self.now = now
+
+        rescored = 0
+        now = now.timestamp()
+        while self._expiry and self._expiry[0][0] <= now:
+            expiry_time, _, task = heapq.heappop(self._expiry)
+            if self._expiry_times.get(task) == expiry_time:
+                del self._expiry_times[task]
+                self._rescore(task)
+                rescored += 1
+        return rescored
+
+    def top(self,
+            k: int,
+            now: Datetime=None):
+        """
+        Get the k most urgent pending tasks.
+
+        :param k: the number of tasks
+        :param now: the current time, if the ranking is to be moved on
+            to it first
+        :return : (task, score) pairs, in order of score
+        :rtype: list
+        """
+        if now is not None:
+            self.advance(now)
+        return self.heap.top(k)
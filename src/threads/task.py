@@ -10,8 +10,10 @@ Module structure:
 
 """
 
+import datetime
+import heapq
 import uuid
-from timemap.util import Datetime, Timedelta
+from timemap.util import Datetime, Timedelta, timestamp_to_json
 from timemap.time import TimeChunk
 
 
@@ -30,8 +32,23 @@ class Task(object):
     ...               tzinfo=datetime.timezone.utc)
     >>> t = Task("try out this cool thing", dt)
     >>> print(t)
-    Task: try out this cool thing in 2015-01-12 11:23:46+00:00-None
+    Task: 'try out this cool thing' in 2015-01-12 11:23:46+00:00-None
+
+    Tasks are kept compact, as there may be a great many of them: they
+    have no instance dictionary, the uid is stored as a 128-bit integer
+    which is also used directly as the hash of the task, times are
+    stored as timestamps, a Datetime only being created when they are
+    read, and the completed, dirty and partial_completion flags and
+    max_divisions are packed into one integer.
     """
+    __slots__ = ('_uid', 'name', '_start', '_end', '_importance',
+                 'thread_name', '_flags', '_observer')
+
+    # The low bits of _flags, above which max_divisions + 1 is stored
+    _COMPLETED = 1
+    _DIRTY = 2
+    _PARTIAL_COMPLETION = 4
+    _FLAG_BITS = 3
 
     def __init__(self,
                  name: str,
@@ -52,14 +69,15 @@ class Task(object):
         :param thread_name: the name of the thread to which this task
             belongs
         """
-        self.uid = uuid.uuid4()
+        self._uid = uuid.uuid4().int
+        self._observer = None
         self.name = name
-        self.start_time = self.end_time = None
+        self._start = self._end = None
         self._importance = importance
-        self.partial_completion = partial_completion
-        self.max_divisions = max_divisions
         self.thread_name = thread_name
-        self.completed = False
+        self._flags = self._DIRTY | \
+            (self._PARTIAL_COMPLETION if partial_completion else 0) | \
+            ((max_divisions + 1) << self._FLAG_BITS)
 
         if start_time:
             self.change_time(start_time, end_time)
@@ -77,7 +95,7 @@ class Task(object):
 
         :param other: the other task to be compared
         """
-        return self.uid == other.uid
+        return self._uid == other._uid
 
     def __ne__(self, other: "Task"):
         """
@@ -86,13 +104,127 @@ class Task(object):
 
         :param other: the other task to be compared
         """
-        return self.uid != other.uid
+        return self._uid != other._uid
 
     def __hash__(self):
         """
         Return hash of the task.  The uid of the task is taken as its hash.
         """
-        return int(self.uid)
+        return self._uid
+
+    def _set_flag(self,
+                  flag: int,
+                  value: bool):
+        """
+        Set or clear a bit of the flags of the task.
+        """
+        if value:
+            self._flags |= flag
+        else:
+            self._flags &= ~flag
+
+    @property
+    def completed(self):
+        """
+        Get or set whether the task has been completed.
+        """
+        return bool(self._flags & self._COMPLETED)
+
+    @completed.setter
+    def completed(self, completed: bool):
+        self._set_flag(self._COMPLETED, completed)
+
+    @property
+    def dirty(self):
+        """
+        Get or set whether the task has changed since it was last saved.
+        """
+        return bool(self._flags & self._DIRTY)
+
+    @dirty.setter
+    def dirty(self, dirty: bool):
+        self._set_flag(self._DIRTY, dirty)
+
+    @property
+    def partial_completion(self):
+        """
+        Get or set whether partial completion of the task is useful.
+        """
+        return bool(self._flags & self._PARTIAL_COMPLETION)
+
+    @partial_completion.setter
+    def partial_completion(self, partial_completion: bool):
+        self._set_flag(self._PARTIAL_COMPLETION, partial_completion)
+
+    @property
+    def max_divisions(self):
+        """
+        Get or set the maximum number of non-consecutive time chunks
+        that the task can be divided into, -1 meaning no maximum.
+        """
+        return (self._flags >> self._FLAG_BITS) - 1
+
+    @max_divisions.setter
+    def max_divisions(self, max_divisions: int):
+        flag_mask = (1 << self._FLAG_BITS) - 1
+        self._flags = (self._flags & flag_mask) | \
+            ((max_divisions + 1) << self._FLAG_BITS)
+
+    @property
+    def start_time(self):
+        """
+        Get or set the start time of the task.
+        """
+        return Datetime.from_timestamp(self._start)
+
+    @start_time.setter
+    def start_time(self, start_time: Datetime or None):
+        self._start = None if start_time is None else start_time.timestamp()
+
+    @property
+    def end_time(self):
+        """
+        Get or set the end time of the task.
+        """
+        return Datetime.from_timestamp(self._end)
+
+    @end_time.setter
+    def end_time(self, end_time: Datetime or None):
+        self._end = None if end_time is None else end_time.timestamp()
+
+    @property
+    def start_timestamp(self):
+        """
+        Get the start time of the task as seconds since the epoch, or
+        None, without creating a Datetime.
+        """
+        return self._start
+
+    @property
+    def end_timestamp(self):
+        """
+        Get the end time of the task as seconds since the epoch, or
+        None, without creating a Datetime.
+        """
+        return self._end
+
+    @property
+    def uid(self):
+        """
+        Get or set the uid of the task.  The uid is stored as a 128-bit
+        integer and a uuid.UUID is only created when it is read.  It can
+        be set to a uuid.UUID, its string representation or an integer.
+        """
+        return uuid.UUID(int=self._uid)
+
+    @uid.setter
+    def uid(self, uid: uuid.UUID or str or int):
+        if isinstance(uid, uuid.UUID):
+            self._uid = uid.int
+        elif isinstance(uid, str):
+            self._uid = uuid.UUID(uid).int
+        else:
+            self._uid = int(uid)
 
     def to_json(self):
         """
@@ -112,12 +244,13 @@ class Task(object):
         return {
             'uid': str(self.uid),
             'name': self.name,
-            'start_time': self.start_time.to_json(),
-            'end_time': self.end_time.to_json(),
+            'start_time': timestamp_to_json(self.start_timestamp),
+            'end_time': timestamp_to_json(self.end_timestamp),
             'importance': self.importance,
             'partial_completion': self.partial_completion,
             'max_divisions': self.max_divisions,
-            'thread_name': self.thread_name
+            'thread_name': self.thread_name,
+            'completed': self.completed
         }
 
     @staticmethod
@@ -144,9 +277,13 @@ class Task(object):
         kwargs = cls.json_to_dict(d)
 
         uid_str = kwargs.pop('uid', None)
+        kwargs.pop('type', None)
+        completed = kwargs.pop('completed', False)
 
         task = cls(**kwargs)
-        task.uid = uuid.UUID(uid_str) if uid_str is not None else uuid.uuid4()
+        if uid_str is not None:
+            task.uid = uid_str
+        task.completed = completed
 
         return task
 
@@ -167,6 +304,25 @@ class Task(object):
 
         self.start_time = new_start_time
         self.end_time = new_end_time
+        self._changed()
+
+    def _changed(self):
+        """
+        Mark the task as changed and notify its observer, if any.
+        """
+        self.dirty = True
+        if self._observer is not None:
+            self._observer.task_changed(self)
+
+    def set_observer(self, observer):
+        """
+        Set the observer, such as a threads.index.TaskIndex, whose
+        task_changed method is called with this task whenever its
+        times, importance, completion, deadlines or appointments change.
+
+        :param observer: the observer, or None to remove it
+        """
+        self._observer = observer
 
     @property
     def importance(self):
@@ -180,6 +336,7 @@ class Task(object):
     def importance(self, new_importance: float):
         if 0 <= new_importance <= 10:
             self._importance = new_importance
+            self._changed()
         else:
             raise Exception("Invalid importance for task. ")
 
@@ -192,26 +349,34 @@ class Task(object):
         Complete the task.
         """
         self.completed = True
+        self._changed()
 
-    def is_done(self):
+    def is_done(self, now: Datetime=None):
         """
         Return if the task is done.  A task is done if it has been
         completed or if its end time is in the past.
+
+        :param now: the current time, if already known
         """
-        if self.end_time:
-            if self.end_time < Datetime.now(self.end_time.tzinfo):
+        end_time = self.end_timestamp
+        if end_time is not None:
+            if now is None:
+                now = Datetime.now(datetime.timezone.utc)
+            if end_time < now.timestamp():
                 return True
 
         return self.completed
 
 
 class RepeatableTask(Task):
+    __slots__ = ('repeat',)
+
     def __init__(self,
                  name: str,
                  start_time: Datetime=None,
                  end_time: Datetime=None,
                  importance: float=5,
-                 repeat: RepeatableTask.TaskRepeat=False,
+                 repeat: "RepeatableTask.TaskRepeat"=False,
                  partial_completion: bool=False,
                  max_divisions: int=-1,
                  thread_name: str=None):
@@ -230,7 +395,7 @@ class RepeatableTask(Task):
         # Handle repeat object and the variables start_time and end_time
         self.repeat = repeat
 
-        self._start_time = self._end_time = None
+        self._start = self._end = None
 
         if self.start_time is not None and self.end_time is not None:
             start_time = self.start_time
@@ -250,6 +415,8 @@ class RepeatableTask(Task):
         repetition.  It also stores and provides information about
         the start and stop of all the periods of the task.
         """
+        __slots__ = ('repeat', 'period', 'start_time', 'end_time')
+
         def __init__(self,
                      repeat: bool=False,
                      period: Timedelta=None):
@@ -298,7 +465,7 @@ class RepeatableTask(Task):
             if isinstance(d, bool):
                 return d
 
-            d['period'] = Datetime.from_json(d.get('period', None))
+            d['period'] = Timedelta.from_json(d.get('period', None))
             d['start_time'] = Datetime.from_json(d.get('start_time', None))
             d['end_time'] = Datetime.from_json(d.get('end_time', None))
 
@@ -319,9 +486,12 @@ class RepeatableTask(Task):
             start_time = kwargs.pop('start_time', None)
             end_time = kwargs.pop('end_time', None)
 
-            task_repeat = cls(**kwargs)
+            task_repeat = cls(kwargs.pop('repeat', False),
+                              kwargs.pop('period', None))
             task_repeat.start_time = start_time
             task_repeat.end_time = end_time
+            for name, value in kwargs.items():
+                setattr(task_repeat, name, value)
 
             return task_repeat
 
@@ -331,7 +501,7 @@ class RepeatableTask(Task):
         """
         encoded = super().to_json()
 
-        encoded['repeat'] = self.repeat.to_json()
+        encoded['repeat'] = self.repeat.to_json() if self.repeat else False
         return encoded
 
     @staticmethod
@@ -346,8 +516,10 @@ class RepeatableTask(Task):
         """
         d = Task.json_to_dict(d)
 
-        d['repeat'] = RepeatableTask.TaskRepeat.from_json(d.get('repeat',
-                                                                False))
+        # Non-repeating tasks share False rather than each having a
+        # TaskRepeat
+        repeat = d.get('repeat', False)
+        d['repeat'] = repeat and RepeatableTask.TaskRepeat.from_json(repeat)
 
         return d
 
@@ -363,22 +535,22 @@ class RepeatableTask(Task):
         """
         if self.repeat:
             return self.repeat.start_time
-        return self._start_time
+        return Datetime.from_timestamp(self._start)
 
     @start_time.setter
     def start_time(self, start_time):
         if self.repeat:
             self.repeat.start_time = start_time
-            self._start_time = None
+            self._start = None
         else:
-            self._start_time = start_time
+            Task.start_time.fset(self, start_time)
 
     @start_time.deleter
     def start_time(self):
         if self.repeat:
             del self.repeat.start_time
         else:
-            del self._start_time
+            del self._start
 
     @property
     def end_time(self):
@@ -392,29 +564,136 @@ class RepeatableTask(Task):
         """
         if self.repeat:
             return self.repeat.end_time
-        return self._end_time
+        return Datetime.from_timestamp(self._end)
 
     @end_time.setter
     def end_time(self, end_time):
         if self.repeat:
             self.repeat.end_time = end_time
-            self._end_time = None
+            self._end = None
         else:
-            self._end_time = end_time
+            Task.end_time.fset(self, end_time)
 
     @end_time.deleter
     def end_time(self):
         if self.repeat:
             del self.repeat.end_time
         else:
-            del self._end_time
+            del self._end
 
-    def complete(self):
+    @property
+    def start_timestamp(self):
         """
-        Complete the task.
+        Get the start time of the task as seconds since the epoch, or
+        None, without creating a Datetime for non-repeating tasks.
         """
-        # self.completed = True
-        pass
+        if self.repeat:
+            start_time = self.repeat.start_time
+            return None if start_time is None else start_time.timestamp()
+        return self._start
+
+    @property
+    def end_timestamp(self):
+        """
+        Get the end time of the task as seconds since the epoch, or
+        None, without creating a Datetime for non-repeating tasks.
+        """
+        if self.repeat:
+            end_time = self.repeat.end_time
+            return None if end_time is None else end_time.timestamp()
+        return self._end
+
+    def _replicate(self,
+                   start_time: Datetime,
+                   duration: Timedelta,
+                   window_start: Datetime=None,
+                   window_end: Datetime=None):
+        """
+        Lazily generate the (start_time, duration) pairs of an item
+        replicated once every period, starting from the period in which
+        it first overlaps the window.
+
+        :param start_time: the start time of the item in the first period
+        :param duration: the duration of the item
+        :param window_start: the start of the window
+        :param window_end: the end of the window
+        """
+        period = self.repeat.period
+        offset = start_time - self.start_time
+
+        k = 0
+        if window_start is not None:
+            k = max((window_start - start_time - duration) // period, 0)
+        last = None
+        if self.end_time is not None:
+            last = (self.end_time - self.start_time) // period
+
+        time = start_time + k * period
+        while last is None or k <= last:
+            if window_end is not None and time >= window_end:
+                return
+            if window_start is None or time >= window_start or \
+                    time + duration > window_start:
+                yield time, duration
+            k += 1
+            time = self.start_time + k * period + offset
+
+    def _occurrences(self,
+                     items: list,
+                     window_start: Datetime=None,
+                     window_end: Datetime=None):
+        """
+        Lazily generate, in order, the (start_time, duration) pairs of
+        items which overlap a window.  For repeating tasks, the items
+        are replicated once every period using period arithmetic, so
+        the occurrences before the window are never generated.
+
+        :param items: (start_time, duration) pairs of the items in the
+            first period
+        :param window_start: the start of the window
+        :param window_end: the end of the window
+        """
+        if self.repeat:
+            yield from heapq.merge(*(self._replicate(start_time, duration,
+                                                     window_start, window_end)
+                                     for start_time, duration in items))
+            return
+
+        for start_time, duration in sorted(items):
+            if window_end is not None and start_time >= window_end:
+                return
+            if window_start is None or start_time >= window_start or \
+                    start_time + duration > window_start:
+                yield start_time, duration
+
+    def _next_occurrence_after(self,
+                               items: list,
+                               time: Datetime):
+        """
+        Get the first (start_time, duration) pair of an item starting
+        after a time, or None if there is none.  For repeating tasks,
+        the period of each item is computed directly, so this takes
+        time proportional to the number of items in one period.
+
+        :param items: (start_time, duration) pairs of the items in the
+            first period
+        :param time: the time after which the occurrence starts
+        """
+        if not self.repeat:
+            following = [item for item in items if item[0] > time]
+            return min(following) if following else None
+
+        period = self.repeat.period
+        last = None
+        if self.end_time is not None:
+            last = (self.end_time - self.start_time) // period
+
+        following = []
+        for start_time, duration in items:
+            k = max((time - start_time) // period + 1, 0)
+            if last is None or k <= last:
+                following.append((start_time + k * period, duration))
+        return min(following) if following else None
 
 
 class Event(RepeatableTask):
@@ -423,13 +702,14 @@ class Event(RepeatableTask):
     task represents a static task ie..one which can not be moved around
     in time.
     """
+    __slots__ = ('_appointments',)
 
     def __init__(self,
                  name: str,
                  start_time: Datetime,
                  end_time: Datetime,
                  importance: float=5,
-                 repeat: Event.EventRepeat=False,
+                 repeat: "Event.EventRepeat"=False,
                  partial_completion: bool=False,
                  max_divisions: int=-1,
                  thread_name: str=None):
@@ -448,7 +728,8 @@ class Event(RepeatableTask):
         super().__init__(name, start_time, end_time, importance, repeat,
                          partial_completion, max_divisions, thread_name)
 
-        self._appointments = None
+        # Shared until the first appointment is added
+        self._appointments = ()
 
     def __str__(self):
         """
@@ -457,6 +738,8 @@ class Event(RepeatableTask):
         return "Event: '{0.name}' in {0.start_time}-{0.end_time}".format(self)
 
     class EventRepeat(RepeatableTask.TaskRepeat):
+        __slots__ = ('appointments',)
+
         def __init__(self,
                      repeat: bool=False,
                      period: Timedelta=None):
@@ -491,13 +774,13 @@ class Event(RepeatableTask):
             :param d: JSON dictionary representing the EventRepeat
                 object
             """
-            d = super().json_to_dict(d)
+            d = RepeatableTask.TaskRepeat.json_to_dict(d)
 
             if isinstance(d, bool):
                 return d
 
-            d['assignments'] = [TimeChunk.from_json(assignment_json) for
-                                assignment_json in d.get('assignments', [])]
+            d['appointments'] = [TimeChunk.from_json(appointment_json) for
+                                 appointment_json in d.get('appointments', [])]
             return d
 
     def to_json(self):
@@ -506,6 +789,9 @@ class Event(RepeatableTask):
         """
         encoded = super().to_json()
 
+        if not self.repeat:
+            encoded['appointments'] = [appointment.to_json() for
+                                       appointment in self.appointments]
         encoded['type'] = 'event'
         return encoded
 
@@ -521,10 +807,27 @@ class Event(RepeatableTask):
         """
         d = Task.json_to_dict(d)
 
-        d['repeat'] = Event.EventRepeat.from_json(d.get('repeat', False))
+        repeat = d.get('repeat', False)
+        d['repeat'] = repeat and Event.EventRepeat.from_json(repeat)
 
         return d
 
+    @classmethod
+    def from_json(cls, d: dict):
+        """
+        Create an Event instance from its JSON representation
+
+        :param d: JSON dictionary for the event
+        """
+        appointments = d.pop('appointments', [])
+
+        event = super().from_json(d)
+        if not event.repeat and appointments:
+            event._appointments = [TimeChunk.from_json(appointment_json) for
+                                   appointment_json in appointments]
+
+        return event
+
     @property
     def appointments(self):
         """
@@ -551,8 +854,11 @@ class Event(RepeatableTask):
         if self.repeat:
             if appointment.start_time > self.start_time + self.repeat.period:
                 raise Exception("Invalid appointment: time not within period")
+        elif not self._appointments:
+            self._appointments = []
 
         self.appointments.append(appointment)
+        self._changed()
 
     def remove_appointment(self, appointment: TimeChunk):
         """
@@ -561,6 +867,56 @@ class Event(RepeatableTask):
         """
         if appointment in self.appointments:
             self.appointments.remove(appointment)
+            self._changed()
+
+    def _appointment_items(self):
+        """
+        Get the (start_time, duration) pairs of the appointments of the
+        event.  A non-repeating event without appointments takes place
+        between its start and end times.
+        """
+        if not self.appointments and not self.repeat:
+            return [(self.start_time, self.end_time - self.start_time)]
+        return [(appointment.start_time, appointment.duration)
+                for appointment in self.appointments]
+
+    def occurrences(self,
+                    window_start: Datetime=None,
+                    window_end: Datetime=None):
+        """
+        Lazily generate, in order, the time chunks during which the
+        event takes place that overlap a window.  Appointments of a
+        repeating event are replicated once every period without
+        expanding the periods before the window.
+
+        >>> import datetime
+        >>> start = Datetime(2015, 1, 12, tzinfo=datetime.timezone.utc)
+        >>> e = Event("standup", start, start + 3650 * Timedelta.DAY,
+        ...           repeat=Event.EventRepeat(True, Timedelta.DAY))
+        >>> e.add_appointment(TimeChunk(start + 9 * Timedelta.HOUR))
+        >>> window_start = start + 3000 * Timedelta.DAY
+        >>> [str(c.start_time) for c in e.occurrences(
+        ...     window_start, window_start + 2 * Timedelta.DAY)]
+        ['2023-03-31 09:00:00+00:00', '2023-04-01 09:00:00+00:00']
+
+        :param window_start: the start of the window
+        :param window_end: the end of the window
+        """
+        for start_time, duration in self._occurrences(
+                self._appointment_items(), window_start, window_end):
+            yield TimeChunk(start_time, duration)
+
+    def next_occurrence_after(self, time: Datetime):
+        """
+        Get the first time chunk during which the event takes place
+        that starts after a time, or None if there is none.
+
+        :param time: the time after which the time chunk starts
+        """
+        item = self._next_occurrence_after(self._appointment_items(), time)
+        if item is None:
+            return None
+        return TimeChunk(*item)
 
 
 class Assignment(RepeatableTask):
@@ -569,12 +925,13 @@ class Assignment(RepeatableTask):
     represents a dynamic task ie. one which can be moved around within
     well-defined ranges, usually now and the deadline.
     """
+    __slots__ = ('_deadlines', '_expected_duration')
 
     def __init__(self,
                  name: str,
                  expected_duration: Timedelta=None,
                  importance: float=5,
-                 repeat: Assignment.AssignmentRepeat=False,
+                 repeat: "Assignment.AssignmentRepeat"=False,
                  partial_completion: bool=False,
                  max_divisions: int=-1,
                  thread_name: str=None):
@@ -597,7 +954,9 @@ class Assignment(RepeatableTask):
                          max_divisions=max_divisions,
                          thread_name=thread_name)
 
-        self._deadlines = []
+        # The timestamps of the deadlines of a non-repeating assignment,
+        # a single deadline being stored without a tuple
+        self._deadlines = ()
         self.expected_duration = expected_duration
 
     def __str__(self):
@@ -607,6 +966,8 @@ class Assignment(RepeatableTask):
         return "Assignment: '{0.name}' by {0.deadline}".format(self)
 
     class AssignmentRepeat(RepeatableTask.TaskRepeat):
+        __slots__ = ('deadlines',)
+
         def __init__(self,
                      repeat: bool=False,
                      period: Timedelta=None):
@@ -637,7 +998,7 @@ class Assignment(RepeatableTask):
             :param d: JSON dictionary representing the AssignmentRepeat
                 object
             """
-            d = super().json_to_dict(d)
+            d = RepeatableTask.TaskRepeat.json_to_dict(d)
 
             if isinstance(d, bool):
                 return d
@@ -652,7 +1013,10 @@ class Assignment(RepeatableTask):
         """
         encoded = super().to_json()
 
-        encoded['expected_duration'] = self.expected_duration.to_json()
+        encoded['expected_duration'] = self._expected_duration
+        if not self.repeat:
+            encoded['deadlines'] = [timestamp_to_json(deadline) for
+                                    deadline in self.deadline_timestamps]
         encoded['type'] = 'assignment'
 
         return encoded
@@ -669,13 +1033,59 @@ class Assignment(RepeatableTask):
         """
         d = Task.json_to_dict(d)
 
-        d['repeat'] = Assignment.AssignmentRepeat.from_json(d.get('repeat',
-                                                                  False))
+        repeat = d.get('repeat', False)
+        d['repeat'] = repeat and Assignment.AssignmentRepeat.from_json(repeat)
         d['expected_duration'] = Timedelta.from_json(d.get('expected_duration',
                                                            None))
+        d['deadlines'] = [Datetime.from_json(deadline_json) for
+                          deadline_json in d.get('deadlines', [])]
 
         return d
 
+    @classmethod
+    def from_json(cls, d: dict):
+        """
+        Create an Assignment instance from its JSON representation
+
+        :param d: JSON dictionary for the assignment
+        """
+        kwargs = cls.json_to_dict(d)
+
+        uid_str = kwargs.pop('uid', None)
+        kwargs.pop('type', None)
+        completed = kwargs.pop('completed', False)
+        start_time = kwargs.pop('start_time', None)
+        end_time = kwargs.pop('end_time', None)
+        deadlines = kwargs.pop('deadlines')
+
+        assignment = cls(**kwargs)
+        if uid_str is not None:
+            assignment.uid = uid_str
+        assignment.completed = completed
+        if start_time:
+            assignment.change_time(start_time, end_time)
+        if not assignment.repeat:
+            assignment._set_deadline_timestamps(
+                tuple([deadline.timestamp() for deadline in deadlines]))
+
+        return assignment
+
+    @property
+    def expected_duration(self):
+        """
+        Get or set the expected time required to complete the
+        assignment.  It is stored in seconds, as the times are.
+        """
+        expected_duration = self._expected_duration
+        if expected_duration is None:
+            return None
+        return Timedelta(seconds=expected_duration)
+
+    @expected_duration.setter
+    def expected_duration(self, expected_duration: Timedelta or None):
+        self._expected_duration = None if expected_duration is None \
+            else expected_duration.total_seconds()
+
     @property
     def deadlines(self):
         """
@@ -685,7 +1095,27 @@ class Assignment(RepeatableTask):
         """
         if self.repeat:
             return self.repeat.deadlines
-        return self._deadlines
+        return [Datetime.from_timestamp(deadline)
+                for deadline in self.deadline_timestamps]
+
+    @property
+    def deadline_timestamps(self):
+        """
+        Get the deadlines of the assignment as seconds since the epoch,
+        without creating Datetimes for non-repeating assignments.
+        """
+        if self.repeat:
+            return tuple(deadline.timestamp()
+                         for deadline in self.repeat.deadlines)
+        deadlines = self._deadlines
+        return (deadlines,) if isinstance(deadlines, float) else deadlines
+
+    def _set_deadline_timestamps(self, deadlines: tuple):
+        """
+        Set the timestamps of the deadlines of a non-repeating
+        assignment.
+        """
+        self._deadlines = deadlines[0] if len(deadlines) == 1 else deadlines
 
     def add_deadline(self, deadline: Datetime):
         """
@@ -702,24 +1132,79 @@ class Assignment(RepeatableTask):
         if self.repeat:
             if deadline > self.start_time + self.repeat.period:
                 raise Exception("Invalid deadline: time not within period")
-
-        self.deadlines.append(deadline)
+            self.repeat.deadlines.append(deadline)
+        else:
+            self._set_deadline_timestamps(self.deadline_timestamps +
+                                          (deadline.timestamp(),))
+        self._changed()
 
     def remove_deadline(self, deadline: Datetime):
         """
         Remove a deadline from this assignment.  Does nothing if the
         deadline had not been previously added to the assignment.
         """
-        if deadline in self.deadlines:
-            self.deadlines.remove(deadline)
+        if self.repeat:
+            if deadline in self.repeat.deadlines:
+                self.repeat.deadlines.remove(deadline)
+                self._changed()
+            return
+
+        deadline = deadline.timestamp()
+        deadlines = self.deadline_timestamps
+        if deadline in deadlines:
+            i = deadlines.index(deadline)
+            self._set_deadline_timestamps(deadlines[:i] + deadlines[i + 1:])
+            self._changed()
+
+    def occurrences(self,
+                    window_start: Datetime=None,
+                    window_end: Datetime=None):
+        """
+        Lazily generate, in order, the deadlines of the assignment that
+        fall within a window.  Deadlines of a repeating assignment are
+        replicated once every period without expanding the periods
+        before the window.
 
-    def is_done(self):
+        :param window_start: the start of the window
+        :param window_end: the end of the window
+        """
+        items = [(deadline, Timedelta(0)) for deadline in self.deadlines]
+        for deadline, _ in self._occurrences(items, window_start,
+                                             window_end):
+            yield deadline
+
+    def next_occurrence_after(self, time: Datetime):
+        """
+        Get the first deadline of the assignment after a time, or None
+        if there is none.
+
+        :param time: the time after which the deadline falls
+        """
+        if not self.repeat:
+            time = time.timestamp()
+            deadlines = [deadline for deadline in self.deadline_timestamps
+                         if deadline > time]
+            return Datetime.from_timestamp(min(deadlines)) \
+                if deadlines else None
+
+        items = [(deadline, Timedelta(0)) for deadline in self.deadlines]
+        item = self._next_occurrence_after(items, time)
+        if item is None:
+            return None
+        return item[0]
+
+    def is_done(self, now: Datetime=None):
         """
         Return if the assignment is done.  A task is done if it has
         been completed or if its deadline is in the past.
+
+        :param now: the current time, if already known
         """
-        if self.end_time:
-            if self.end_time < Datetime.now(self.end_time.tzinfo):
+        end_time = self.end_timestamp
+        if end_time is not None:
+            if now is None:
+                now = Datetime.now(datetime.timezone.utc)
+            if end_time < now.timestamp():
                 return True
 
         return self.completed
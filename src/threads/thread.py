@@ -6,7 +6,7 @@ from threads.task import *
 __author__ = "Dibyo Majumdar"
 __email__ = "dibyo.majumdar@gmail.com"
 
-__all__ = ["Thread"]
+__all__ = ["Thread", "LazyThread"]
 
 
 class ThreadException(Exception):
@@ -30,8 +30,16 @@ class Thread(object):
         self.name = name
         self.default_importance = default_importance
         self.tasks = []
+        self.dirty = True
+        self.observer = None
 
-    def __or__(self, other: Thread):
+    def __len__(self):
+        """
+        Return the number of tasks in the thread.
+        """
+        return len(self.tasks)
+
+    def __or__(self, other: "Thread"):
         """
         Return the union of this thread and other
 
@@ -48,7 +56,7 @@ class Thread(object):
         new_thread |= other
         return new_thread
 
-    def __ior__(self, other: Thread):
+    def __ior__(self, other: "Thread"):
         """
         Execute the in-place union operation of this thread with other
 
@@ -65,6 +73,10 @@ class Thread(object):
         tasks |= set(other.tasks)
 
         self.tasks = list(tasks)
+        self.dirty = True
+        if self.observer is not None:
+            self.observer.thread_changed(self)
+        return self
 
     def to_json(self):
         """
@@ -90,19 +102,151 @@ class Thread(object):
         thread = Thread(d['name'], d['default_importance'])
 
         for task_json in d.get('tasks', []):
-            typ = task_json.get('type', None)
-            if typ == 'event':
-                thread.add_task(Event.from_json(task_json))
-            elif typ == 'assignment':
-                thread.add_task(Assignment.from_json(task_json))
-            else:
-                thread.add_task(Task.from_json(task_json))
+            thread.add_task(cls.task_from_json(task_json))
 
+        thread.mark_clean()
         return thread
 
+    @staticmethod
+    def task_from_json(d: dict):
+        """
+        Create a task of the right type from its JSON representation
+
+        :param d: JSON dictionary for the task
+        """
+        typ = d.get('type', None)
+        if typ == 'event':
+            return Event.from_json(d)
+        elif typ == 'assignment':
+            return Assignment.from_json(d)
+        return Task.from_json(d)
+
     def add_task(self,
                  task: Task):
         self.tasks.append(task)
+        self.dirty = True
+        if self.observer is not None:
+            self.observer.task_added(self, task)
+
+    def is_dirty(self):
+        """
+        Return if the thread or any of its tasks has changed since it
+        was last marked clean.
+        """
+        if self.dirty:
+            return True
+        return any(task.dirty for task in self.tasks)
+
+    def mark_clean(self):
+        """
+        Mark the thread and all its tasks as unchanged, usually once
+        they have been loaded from or saved to file.
+        """
+        self.dirty = False
+        for task in self.tasks:
+            task.dirty = False
 
     def create_task(self):
-        pass
\ No newline at end of file
+        pass
+
+
+class LazyThread(Thread):
+    """
+    A thread whose tasks are only decoded from their JSON
+    representation when they are first accessed.  Until then, only the
+    name, the default importance and the number of tasks of the thread
+    are available without decoding them.
+    """
+    def __init__(self,
+                 name: str,
+                 default_importance: int,
+                 tasks_json: list):
+        """
+        :param name: the name of the thread
+        :param default_importance: the importance given by default to
+            its tasks
+        :param tasks_json: the JSON representations of its tasks
+        """
+        super().__init__(name, default_importance)
+        self._tasks_json = tasks_json
+        self.dirty = False
+
+    def __len__(self):
+        """
+        Return the number of tasks in the thread.
+        """
+        if self._tasks_json is not None:
+            return len(self._tasks_json)
+        return len(self._tasks)
+
+    @property
+    def tasks(self):
+        """
+        Get or set the tasks of the thread, decoding them on first
+        access.  The observer of the thread, if any, is told once they
+        have been decoded.
+        """
+        if self._tasks_json is not None:
+            tasks = [self.task_from_json(task_json)
+                     for task_json in self._tasks_json]
+            for task in tasks:
+                task.dirty = False
+            self._tasks = tasks
+            self._tasks_json = None
+            if self.observer is not None:
+                self.observer.thread_changed(self)
+        return self._tasks
+
+    @tasks.setter
+    def tasks(self, tasks: list):
+        self._tasks = tasks
+        self._tasks_json = None
+
+    def is_loaded(self):
+        """
+        Return if the tasks of the thread have been decoded.
+        """
+        return self._tasks_json is None
+
+    def iter_end_times(self):
+        """
+        Lazily get the end time and completion of each task of the
+        thread, decoding only its end time if the tasks have not been
+        decoded.
+        """
+        if self._tasks_json is None:
+            for task in self._tasks:
+                yield task.end_time, task.completed
+            return
+        for task_json in self._tasks_json:
+            yield Datetime.from_json(task_json.get('end_time')), \
+                task_json.get('completed', False)
+
+    def is_dirty(self):
+        """
+        Return if the thread or any of its tasks has changed since it
+        was last marked clean.  Tasks which have not been decoded have
+        not changed.
+        """
+        if not self.is_loaded():
+            return self.dirty
+        return super().is_dirty()
+
+    def mark_clean(self):
+        """
+        Mark the thread and all its decoded tasks as unchanged.
+        """
+        if not self.is_loaded():
+            self.dirty = False
+            return
+        super().mark_clean()
+
+    @classmethod
+    def from_json(cls, d: dict):
+        """
+        Create a LazyThread instance from its JSON representation
+        without decoding its tasks
+
+        :param d: JSON dictionary for the thread
+        """
+        return cls(d['name'], d['default_importance'], d.get('tasks', []))
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the adherence engine, which compares the past
+planned time map with the past actual time map to find how closely the
+plan was followed by each task, each thread and on each day.
+
+Module structure:
+- merge_join
+- split_days
+- Adherence
+"""
+
+import datetime
+
+from timemap.util import Datetime, Timedelta
+from timemap.time import AllocatedTimeChunk
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'merge_join',
+    'split_days',
+    'Adherence'
+]
+
+# The measures of adherence, in seconds:
+# - planned: the time planned for a task
+# - worked: the time actually spent on a task
+# - on_plan: the time planned for a task and spent on it
+# - displaced: the time planned for a task but spent otherwise
+# - unplanned: the time spent on a task but planned otherwise
+MEASURES = ('planned', 'worked', 'on_plan', 'displaced', 'unplanned')
+
+
+def merge_join(planned, actual):
+    """
+    Lazily merge-join two sequences of non-overlapping time chunks, each
+    ordered by start time, into the pieces of time during which neither
+    allocation changes.  Each piece is a (start_time, end_time,
+    planned_task, actual_task) tuple, where either task is None if no
+    chunk allocated to a task covers it.  Pieces where neither is
+    allocated are skipped.  Only the current chunk of each sequence is
+    held in memory.
+
+    >>> start = Datetime(2015, 1, 12, 9)
+    >>> planned = [AllocatedTimeChunk(start, Timedelta.HOUR)]
+    >>> planned[0].set_task_allocated('a', 0)
+    >>> actual = [AllocatedTimeChunk(start + Timedelta(minutes=30),
+    ...                              Timedelta.HOUR)]
+    >>> actual[0].set_task_allocated('b', 0)
+    >>> [(piece[0].minute, piece[2], piece[3])
+    ...  for piece in merge_join(planned, actual)]
+    [(0, 'a', None), (30, 'a', 'b'), (0, None, 'b')]
+
+    :param planned: the planned time chunks
+    :param actual: the actual time chunks
+    """
+    planned = iter(planned)
+    actual = iter(actual)
+    p = next(planned, None)
+    a = next(actual, None)
+    time = None
+
+    while p is not None or a is not None:
+        if time is not None:
+            while p is not None and p.end_time <= time:
+                p = next(planned, None)
+            while a is not None and a.end_time <= time:
+                a = next(actual, None)
+            if p is None and a is None:
+                return
+
+        starts = [chunk.start_time for chunk in (p, a) if chunk is not None]
+        start_time = min(starts) if time is None else max(time, min(starts))
+
+        ends = []
+        planned_task = actual_task = None
+        for chunk in (p, a):
+            if chunk is None:
+                continue
+            if chunk.start_time > start_time:
+                ends.append(chunk.start_time)
+            else:
+                ends.append(chunk.end_time)
+        end_time = min(ends)
+
+        if p is not None and p.start_time <= start_time:
+            planned_task = p.get_task_allocated()
+        if a is not None and a.start_time <= start_time:
+            actual_task = a.get_task_allocated()
+
+        if planned_task is not None or actual_task is not None:
+            yield start_time, end_time, planned_task, actual_task
+        time = end_time
+
+
+def split_days(pieces):
+    """
+    Lazily split pieces of time, such as those from merge_join, at the
+    midnights they span.
+
+    :param pieces: (start_time, end_time, ...) tuples
+    """
+    for piece in pieces:
+        start_time, end_time = piece[0], piece[1]
+        while True:
+            midnight = start_time.replace(hour=0, minute=0, second=0,
+                                          microsecond=0) + Timedelta.DAY
+            if end_time <= midnight:
+                yield (start_time, end_time) + piece[2:]
+                break
+            yield (start_time, midnight) + piece[2:]
+            start_time = midnight
+
+
+class Adherence(object):
+    """
+    Rollups of the adherence to the plan of each task, each thread and
+    each day: the seconds planned, worked, on plan, displaced and
+    unplanned (see MEASURES).
+
+    The past time maps are read in one pass, merge-joined by time, with
+    only the current time chunk of each in memory.  The rollups keep
+    the time up to which they have been computed, so that once they are
+    stored (see TimeManager.update_adherence), the next update only
+    reads the time since then.  Time chunks changed before then are not
+    read again.
+
+    Threads are found from the uids of the tasks by thread_of, when
+    given.
+
+    >>> start = Datetime(2015, 1, 12, 9)
+    >>> planned = [AllocatedTimeChunk(start, Timedelta.HOUR)]
+    >>> planned[0].set_task_allocated('a', 0)
+    >>> adherence = Adherence()
+    >>> adherence.update(planned, [], until=start + Timedelta.DAY)
+    1
+    >>> adherence.never_worked()
+    ['a']
+    """
+    def __init__(self, thread_of=None):
+        """
+        :param thread_of: function getting the name of the thread of a
+            task from its uid, or None if it is not known
+        """
+        self.thread_of = thread_of
+        self._thread_names = {}
+
+        self.through = None
+        self.days = {}
+        self.tasks = {}
+        self.threads = {}
+
+    @staticmethod
+    def _add(rollups: dict,
+             key: str,
+             measure: str,
+             seconds: float):
+        """
+        Add seconds to a measure of a rollup.
+        """
+        totals = rollups.get(key)
+        if totals is None:
+            totals = rollups[key] = dict.fromkeys(MEASURES, 0.0)
+        totals[measure] += seconds
+
+    def _add_piece(self,
+                   start_time: Datetime,
+                   end_time: Datetime,
+                   planned_task: str or None,
+                   actual_task: str or None):
+        """
+        Add a piece of time within a day to the rollups.
+        """
+        seconds = (end_time - start_time).total_seconds()
+        day = start_time.strftime('%Y-%m-%d')
+
+        measures = []
+        if planned_task is not None:
+            measures.append((planned_task, 'planned'))
+            measures.append((planned_task, 'on_plan'
+                             if actual_task == planned_task
+                             else 'displaced'))
+        if actual_task is not None:
+            measures.append((actual_task, 'worked'))
+            if actual_task != planned_task:
+                measures.append((actual_task, 'unplanned'))
+
+        for task, measure in measures:
+            self._add(self.days, day, measure, seconds)
+            self._add(self.tasks, task, measure, seconds)
+            if self.thread_of is not None:
+                thread_name = self._thread_names.get(task)
+                if thread_name is None and task not in self._thread_names:
+                    thread_name = self._thread_names[task] = \
+                        self.thread_of(task)
+                if thread_name is not None:
+                    self._add(self.threads, thread_name, measure, seconds)
+
+    def update(self,
+               planned,
+               actual,
+               until: Datetime=None):
+        """
+        Add the time after the time already computed and before until
+        to the rollups.
+
+        :param planned: the past planned time chunks, ordered by start
+            time
+        :param actual: the past actual time chunks, ordered by start
+            time
+        :param until: the end of the time added (defaults to the start
+            of the current day)
+        :return : the number of pieces of time added
+        :rtype: int
+        """
+        if until is None:
+            until = Datetime.now(datetime.timezone.utc).replace(
+                hour=0, minute=0, second=0, microsecond=0)
+
+        if self.through is not None:
+            planned = (chunk for chunk in planned
+                       if chunk.end_time > self.through)
+            actual = (chunk for chunk in actual
+                      if chunk.end_time > self.through)
+
+        count = 0
+        for start_time, end_time, planned_task, actual_task in \
+                split_days(merge_join(planned, actual)):
+            if self.through is not None:
+                if end_time <= self.through:
+                    continue
+                start_time = max(start_time, self.through)
+            if start_time >= until:
+                break
+            self._add_piece(start_time, min(end_time, until),
+                            planned_task, actual_task)
+            count += 1
+
+        if self.through is None or until > self.through:
+            self.through = until
+        return count
+
+    def never_worked(self):
+        """
+        Get the uids of the tasks which had time planned for them but
+        were never worked on.
+        """
+        return [task for task, totals in self.tasks.items()
+                if totals['planned'] and not totals['worked']]
+
+    def ratio(self,
+              rollups: dict,
+              key: str):
+        """
+        Get the fraction of the time planned for a task, thread or day
+        which was spent as planned, or None if none was planned.
+
+        :param rollups: one of days, tasks or threads
+        :param key: the day, uid of the task or name of the thread
+        """
+        totals = rollups.get(key)
+        if not totals or not totals['planned']:
+            return None
+        return totals['on_plan'] / totals['planned']
+
+    def to_json(self):
+        """
+        Convert to JSON representation.
+        """
+        return {
+            'through': self.through and self.through.to_json(),
+            'days': self.days,
+            'tasks': self.tasks,
+            'threads': self.threads
+        }
+
+    @classmethod
+    def from_json(cls,
+                  d: dict,
+                  thread_of=None):
+        """
+        Create an Adherence instance from its JSON representation.
+
+        :param d: JSON dictionary for the rollups
+        :param thread_of: function getting the name of the thread of a
+            task from its uid
+        """
+        adherence = cls(thread_of)
+        adherence.through = Datetime.from_json(d.get('through'))
+        adherence.days = d.get('days', {})
+        adherence.tasks = d.get('tasks', {})
+        adherence.threads = d.get('threads', {})
+        return adherence
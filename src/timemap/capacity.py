@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the capacity tree of a time map, used to answer
+how much free and allocated time there is in a time range, such as
+each day, week or month of a planning view, without summing every
+chunk in it.
+
+Module structure:
+- FenwickTree
+- CapacityTree
+"""
+
+from timemap.util import Datetime, Timedelta
+from timemap.time import AllocatedTimeChunk
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'FenwickTree',
+    'CapacityTree',
+    'LEVELS'
+]
+
+# The levels at which time is rolled up
+LEVELS = ('day', 'week', 'month')
+
+
+class FenwickTree(object):
+    """
+    A Fenwick tree (binary indexed tree) over a sequence of numbers
+    supporting adding to every number in a range and summing a range,
+    both in O(log n) time.  It keeps two trees over the differences d
+    between consecutive numbers, d[i] and i * d[i], from which the sum
+    of the first i numbers is i * sum(d[:i]) - sum(i * d[:i]).
+
+    >>> tree = FenwickTree(8)
+    >>> tree.add(2, 6, 15)
+    >>> tree.add(5, 8, 1)
+    >>> tree.sum(0, 8), tree.sum(4, 6)
+    (63, 31)
+    """
+    def __init__(self, size: int):
+        """
+        :param size: the number of numbers, all initially 0
+        """
+        self.size = size
+        self._differences = [0] * (size + 1)
+        self._weighted = [0] * (size + 1)
+
+    def _add(self,
+             tree: list,
+             i: int,
+             value):
+        i += 1
+        while i <= self.size:
+            tree[i] += value
+            i += i & -i
+
+    def _prefix(self,
+                tree: list,
+                i: int):
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def add(self,
+            lo: int,
+            hi: int,
+            value):
+        """
+        Add value to every number between positions lo and hi.
+
+        :param lo: the first position
+        :param hi: the position after the last
+        :param value: the value added to each number
+        """
+        lo = max(lo, 0)
+        hi = min(hi, self.size)
+        if lo >= hi:
+            return
+        self._add(self._differences, lo, value)
+        self._add(self._weighted, lo, value * lo)
+        if hi < self.size:
+            self._add(self._differences, hi, -value)
+            self._add(self._weighted, hi, -value * hi)
+
+    def prefix_sum(self, i: int):
+        """
+        Get the sum of the numbers before position i.
+
+        :param i: the position
+        """
+        i = min(max(i, 0), self.size)
+        return i * self._prefix(self._differences, i) - \
+            self._prefix(self._weighted, i)
+
+    def sum(self,
+            lo: int,
+            hi: int):
+        """
+        Get the sum of the numbers between positions lo and hi.
+
+        :param lo: the first position
+        :param hi: the position after the last
+        """
+        if lo >= hi:
+            return 0
+        return self.prefix_sum(hi) - self.prefix_sum(lo)
+
+
+class CapacityTree(object):
+    """
+    Aggregates of the free and allocated time in a time map over a grid
+    of equally sized slots, one Fenwick tree of seconds per slot for
+    free time, allocated time and the time allocated to the tasks of
+    each thread.  The time in any range, and so in any day, week or
+    month, is summed in O(log n) time, and is updated in O(log n) time
+    when a time chunk is added, removed, allocated or released, however
+    many slots it covers.  Time chunks need not be aligned to the slots.
+
+    Threads are found from the uids of the tasks allocated by thread_of,
+    when given.  A task moving to another thread is not noticed until
+    the tree is rebuilt.
+
+    >>> start = Datetime(2015, 1, 12)
+    >>> tree = CapacityTree(start, Timedelta.WEEK)
+    >>> chunk = AllocatedTimeChunk(start + Timedelta(hours=9),
+    ...                            Timedelta(hours=8))
+    >>> tree.track(chunk)
+    >>> chunk.set_task_allocated('task', 0)
+    >>> tree.free_minutes(start, start + Timedelta.DAY)
+    0.0
+    >>> [day['allocated'] for day in tree.rollup(start, start + 2 *
+    ...                                          Timedelta.DAY)]
+    [480.0, 0.0]
+    """
+    def __init__(self,
+                 start_time: Datetime,
+                 span: Timedelta,
+                 slot_duration: Timedelta=Timedelta(minutes=15),
+                 thread_of=None):
+        """
+        :param start_time: the start time of the first slot
+        :param span: the total length of time covered by the tree
+        :param slot_duration: the duration of each slot
+        :param thread_of: function getting the name of the thread of a
+            task from its uid, or None if it is not known
+        """
+        self.start_time = start_time
+        self.slot_duration = slot_duration
+        self.num_slots = -(-span // slot_duration)
+        self.thread_of = thread_of
+
+        self.free = FenwickTree(self.num_slots)
+        self.allocated = FenwickTree(self.num_slots)
+        self.threads = {}
+
+    @property
+    def end_time(self):
+        """
+        Get the time at which the last slot ends.
+        """
+        return self.start_time + self.num_slots * self.slot_duration
+
+    def _add(self,
+             tree: FenwickTree,
+             start_time: Datetime,
+             end_time: Datetime,
+             sign: int):
+        """
+        Add, or subtract if sign is negative, the seconds in a time
+        range to the slots of a tree.
+        """
+        start_time = max(start_time, self.start_time)
+        end_time = min(end_time, self.end_time)
+        if start_time >= end_time:
+            return
+
+        slot_seconds = int(self.slot_duration.total_seconds())
+        lo, hi = self._slot_range(start_time, end_time)
+        if lo > hi:
+            # The time range lies within a single slot
+            tree.add(hi, hi + 1,
+                     sign * int((end_time - start_time).total_seconds()))
+            return
+
+        tree.add(lo, hi, sign * slot_seconds)
+        head = self.start_time + lo * self.slot_duration - start_time
+        if head:
+            tree.add(lo - 1, lo, sign * int(head.total_seconds()))
+        tail = end_time - (self.start_time + hi * self.slot_duration)
+        if tail:
+            tree.add(hi, hi + 1, sign * int(tail.total_seconds()))
+
+    def _add_chunk(self,
+                   chunk: AllocatedTimeChunk,
+                   task_allocated: str or None,
+                   sign: int):
+        """
+        Add, or subtract if sign is negative, a time chunk allocated to
+        a task to the trees.
+        """
+        if task_allocated is None:
+            self._add(self.free, chunk.start_time, chunk.end_time, sign)
+            return
+
+        self._add(self.allocated, chunk.start_time, chunk.end_time, sign)
+        if self.thread_of is None:
+            return
+        thread_name = self.thread_of(task_allocated)
+        if thread_name is None:
+            return
+        tree = self.threads.get(thread_name)
+        if tree is None:
+            tree = self.threads[thread_name] = FenwickTree(self.num_slots)
+        self._add(tree, chunk.start_time, chunk.end_time, sign)
+
+    def track(self,
+              chunk: AllocatedTimeChunk,
+              observer=None):
+        """
+        Start tracking a time chunk added to the time map.
+
+        :param chunk: the time chunk
+        :param observer: the observer of the chunk, which must pass on
+            its changes to this tree (defaults to this tree)
+        """
+        chunk.set_observer(observer or self)
+        self._add_chunk(chunk, chunk.get_task_allocated(), 1)
+
+    def untrack(self, chunk: AllocatedTimeChunk):
+        """
+        Stop tracking a time chunk removed from the time map.
+
+        :param chunk: the time chunk
+        """
+        chunk.set_observer(None)
+        self._add_chunk(chunk, chunk.get_task_allocated(), -1)
+
+    def chunk_changed(self,
+                      chunk: AllocatedTimeChunk,
+                      previous: str or None):
+        """
+        Update the trees once a tracked time chunk has been allocated,
+        reallocated or released.
+
+        :param chunk: the time chunk
+        :param previous: the task it was allocated to before
+        """
+        self._add_chunk(chunk, previous, -1)
+        self._add_chunk(chunk, chunk.get_task_allocated(), 1)
+
+    def _slot_range(self,
+                    start_time: Datetime,
+                    end_time: Datetime):
+        """
+        Get the range of slots lying within a time range.
+        """
+        lo = -(-(start_time - self.start_time) // self.slot_duration)
+        hi = (end_time - self.start_time) // self.slot_duration
+        return lo, hi
+
+    def free_minutes(self,
+                     start_time: Datetime,
+                     end_time: Datetime):
+        """
+        Get the minutes of free time in the slots within a time range.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        return self.free.sum(*self._slot_range(start_time, end_time)) / 60
+
+    def allocated_minutes(self,
+                          start_time: Datetime,
+                          end_time: Datetime):
+        """
+        Get the minutes of allocated time in the slots within a time
+        range.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        return self.allocated.sum(
+            *self._slot_range(start_time, end_time)) / 60
+
+    def thread_minutes(self,
+                       start_time: Datetime,
+                       end_time: Datetime):
+        """
+        Get the minutes of time allocated to the tasks of each thread
+        in the slots within a time range.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :rtype: dict
+        """
+        lo, hi = self._slot_range(start_time, end_time)
+        minutes = {}
+        for thread_name, tree in self.threads.items():
+            seconds = tree.sum(lo, hi)
+            if seconds:
+                minutes[thread_name] = seconds / 60
+        return minutes
+
+    @staticmethod
+    def _period_start(time: Datetime,
+                      level: str):
+        """
+        Get the start of the day, week (starting on Monday) or month
+        containing a point in time.
+        """
+        start = time.replace(hour=0, minute=0, second=0, microsecond=0)
+        if level == 'week':
+            start -= Timedelta(days=start.weekday())
+        elif level == 'month':
+            start = start.replace(day=1)
+        return start
+
+    @staticmethod
+    def _next_period(time: Datetime,
+                     level: str):
+        """
+        Get the start of the day, week or month after the one starting
+        at a point in time.
+        """
+        if level == 'day':
+            return time + Timedelta.DAY
+        if level == 'week':
+            return time + Timedelta.WEEK
+        if time.month == 12:
+            return time.replace(year=time.year + 1, month=1)
+        return time.replace(month=time.month + 1)
+
+    def rollup(self,
+               start_time: Datetime,
+               end_time: Datetime,
+               level: str='day'):
+        """
+        Get the free, allocated and per-thread minutes of each day,
+        week or month overlapping a time range, each clipped to it.
+        Each period takes O(t log n) time for t threads.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param level: one of LEVELS
+        :return : dictionaries of the start_time, end_time, free,
+            allocated and threads minutes of each period
+        :rtype: list
+        """
+        if level not in LEVELS:
+            raise ValueError("Invalid level: {0}. ".format(level))
+
+        periods = []
+        period_start = self._period_start(start_time, level)
+        while period_start < end_time:
+            period_end = self._next_period(period_start, level)
+            lo = max(period_start, start_time)
+            hi = min(period_end, end_time)
+            periods.append({
+                'start_time': period_start,
+                'end_time': period_end,
+                'free': self.free_minutes(lo, hi),
+                'allocated': self.allocated_minutes(lo, hi),
+                'threads': self.thread_minutes(lo, hi)
+            })
+            period_start = period_end
+        return periods
+
+    @classmethod
+    def from_chunks(cls,
+                    chunks,
+                    start_time: Datetime,
+                    span: Timedelta,
+                    slot_duration: Timedelta=Timedelta(minutes=15),
+                    thread_of=None,
+                    observer=None):
+        """
+        Create a CapacityTree instance tracking a sequence of time
+        chunks.
+
+        :param chunks: the allocated time chunks
+        :param start_time: the start time of the first slot
+        :param span: the total length of time covered by the tree
+        :param slot_duration: the duration of each slot
+        :param thread_of: function getting the name of the thread of a
+            task from its uid
+        :param observer: the observer of the chunks, which must pass on
+            their changes to the tree (defaults to the tree)
+        """
+        tree = cls(start_time, span, slot_duration, thread_of)
+        for chunk in chunks:
+            tree.track(chunk, observer)
+        return tree
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the index of the free time in a time map, used to
+find free time without scanning every chunk in the time map.
+
+Module structure:
+- GapIndex
+"""
+
+import bisect
+
+from timemap.util import Datetime, Timedelta
+from timemap.time import AllocatedTimeChunk
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'GapIndex'
+]
+
+
+class GapIndex(object):
+    """
+    An index over the gaps of a time map: the maximal time ranges
+    covered by consecutive time chunks which are not allocated to any
+    task.  Gaps never overlap or touch, so they are kept as sorted
+    lists of start and end times, and the gap containing or following
+    a point in time is found with a binary search.  Finding free time
+    of a duration takes O(log n + g) time, where g is the number of
+    gaps too short to hold it which are passed over.
+
+    Tracked chunks notify the index whenever they are allocated or
+    released (see AllocatedTimeChunk.set_observer), so that the gaps
+    are split and merged incrementally.
+
+    >>> start = Datetime(2015, 1, 12, 9)
+    >>> chunks = [AllocatedTimeChunk(start + i * Timedelta(minutes=15))
+    ...           for i in range(8)]
+    >>> index = GapIndex.from_chunks(chunks)
+    >>> chunks[2].set_task_allocated('task', None)
+    >>> [(gap_start.minute, gap_end.hour) for gap_start, gap_end
+    ...  in index.gaps()]
+    [(0, 9), (45, 11)]
+    >>> [(time.hour, time.minute) for time in index.find_free(
+    ...     Timedelta(minutes=30), after=start + Timedelta(minutes=10),
+    ...     count=2)]
+    [(9, 45), (10, 15)]
+    """
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+    def add(self,
+            start_time: Datetime,
+            end_time: Datetime):
+        """
+        Mark a time range as free, merging it with the gaps it overlaps
+        or touches.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        if start_time >= end_time:
+            return
+
+        lo = bisect.bisect_left(self._ends, start_time)
+        hi = bisect.bisect_right(self._starts, end_time)
+        if lo < hi:
+            start_time = min(start_time, self._starts[lo])
+            end_time = max(end_time, self._ends[hi - 1])
+
+        self._starts[lo:hi] = [start_time]
+        self._ends[lo:hi] = [end_time]
+
+    def remove(self,
+               start_time: Datetime,
+               end_time: Datetime):
+        """
+        Mark a time range as not free, splitting the gaps it overlaps.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        if start_time >= end_time:
+            return
+
+        lo = bisect.bisect_right(self._ends, start_time)
+        hi = bisect.bisect_left(self._starts, end_time)
+        if lo >= hi:
+            return
+
+        starts = []
+        ends = []
+        if self._starts[lo] < start_time:
+            starts.append(self._starts[lo])
+            ends.append(start_time)
+        if self._ends[hi - 1] > end_time:
+            starts.append(end_time)
+            ends.append(self._ends[hi - 1])
+
+        self._starts[lo:hi] = starts
+        self._ends[lo:hi] = ends
+
+    def track(self,
+              chunk: AllocatedTimeChunk,
+              observer=None):
+        """
+        Start tracking a time chunk added to the time map.
+
+        :param chunk: the time chunk
+        :param observer: the observer of the chunk, which must pass on
+            its changes to this index (defaults to this index)
+        """
+        chunk.set_observer(observer or self)
+        if chunk.get_task_allocated() is None:
+            self.add(chunk.start_time, chunk.end_time)
+
+    def untrack(self, chunk: AllocatedTimeChunk):
+        """
+        Stop tracking a time chunk removed from the time map.
+
+        :param chunk: the time chunk
+        """
+        chunk.set_observer(None)
+        if chunk.get_task_allocated() is None:
+            self.remove(chunk.start_time, chunk.end_time)
+
+    def chunk_changed(self,
+                      chunk: AllocatedTimeChunk,
+                      previous: str or None):
+        """
+        Update the gaps once a tracked time chunk has been allocated,
+        reallocated or released.
+
+        :param chunk: the time chunk
+        :param previous: the task it was allocated to before
+        """
+        if (previous is None) == (chunk.get_task_allocated() is None):
+            return
+        if chunk.get_task_allocated() is None:
+            self.add(chunk.start_time, chunk.end_time)
+        else:
+            self.remove(chunk.start_time, chunk.end_time)
+
+    def gaps(self,
+             after: Datetime=None,
+             before: Datetime=None):
+        """
+        Lazily get the gaps, in order, clipped to the time range between
+        after and before, as (start_time, end_time) pairs.
+
+        :param after: the start of the time range
+        :param before: the end of the time range
+        """
+        i = 0 if after is None else bisect.bisect_right(self._ends, after)
+        while i < len(self._starts):
+            start_time = self._starts[i]
+            end_time = self._ends[i]
+            if before is not None:
+                if start_time >= before:
+                    return
+                end_time = min(end_time, before)
+            if after is not None:
+                start_time = max(start_time, after)
+            yield start_time, end_time
+            i += 1
+
+    def find_free(self,
+                  duration: Timedelta,
+                  after: Datetime=None,
+                  before: Datetime=None,
+                  count: int=1):
+        """
+        Find the start times of the first count non-overlapping free
+        time ranges of a duration lying completely within the time
+        range between after and before.  Several may be found in one
+        gap.
+
+        :param duration: the duration of free time required
+        :param after: the start of the time range
+        :param before: the end of the time range
+        :param count: the number of free time ranges to find
+        :return : the start times, earliest first
+        :rtype: list
+        """
+        found = []
+        for start_time, end_time in self.gaps(after, before):
+            while len(found) < count and start_time + duration <= end_time:
+                found.append(start_time)
+                start_time += duration
+            if len(found) >= count:
+                break
+        return found
+
+    @classmethod
+    def from_chunks(cls,
+                    chunks,
+                    observer=None):
+        """
+        Create a GapIndex instance tracking a sequence of time chunks
+        ordered by their start times, such as an IntervalIndex.
+
+        :param chunks: the allocated time chunks
+        :param observer: the observer of the chunks, which must pass on
+            their changes to the index (defaults to the index)
+        """
+        index = cls()
+        for chunk in chunks:
+            chunk.set_observer(observer or index)
+            if chunk.get_task_allocated() is not None:
+                continue
+            if index._ends and index._ends[-1] == chunk.start_time:
+                index._ends[-1] = chunk.end_time
+            else:
+                index._starts.append(chunk.start_time)
+                index._ends.append(chunk.end_time)
+        return index
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+"""
+This module contains indexes over time chunks used to answer time-based
+queries without scanning every chunk in a time map.
+
+Module structure:
+- TimeMapException(Exception)
+- IntervalIndex
+"""
+
+import bisect
+
+from timemap.util import Datetime
+from timemap.time import TimeChunk, AllocatedTimeChunk
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+class TimeMapException(Exception):
+    pass
+
+
+class IntervalIndex(object):
+    """
+    An index over non-overlapping time chunks ordered by their start
+    times.  Since no two chunks in a time map may overlap, the end times
+    of the chunks are ordered in the same way as their start times, so
+    point, overlap and range queries can all be answered with binary
+    searches in O(log n + k) time, where k is the number of chunks
+    returned.
+
+    Chunks must not have their start time or duration changed while
+    they are in the index; remove and re-add them instead.  The index
+    is marked dirty when chunks are added or removed, until it is
+    marked clean; changes to the allocations of the chunks it holds
+    are not seen by the index and must be marked by whoever observes
+    them, by setting dirty.
+
+    >>> from timemap.util import Timedelta
+    >>> index = IntervalIndex()
+    >>> start = Datetime(2015, 1, 12, 9)
+    >>> for i in range(4):
+    ...     index.add(AllocatedTimeChunk(start + i * Timedelta(minutes=15)))
+    >>> len(index.overlapping(start + Timedelta(minutes=20),
+    ...                       start + Timedelta(minutes=40)))
+    2
+    >>> index.at(start + Timedelta(minutes=50)).start_time.minute
+    45
+    """
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._chunks = []
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+    def add(self, chunk: TimeChunk):
+        """
+        Add a time chunk to the index.
+
+        :param chunk: the time chunk to be added
+        """
+        start_time = chunk.start_time
+        end_time = chunk.end_time
+
+        i = bisect.bisect_right(self._starts, start_time)
+        if i > 0 and self._ends[i - 1] > start_time:
+            raise TimeMapException("Invalid time chunk: overlaps existing "
+                                   "chunk. ")
+        if i < len(self._starts) and self._starts[i] < end_time:
+            raise TimeMapException("Invalid time chunk: overlaps existing "
+                                   "chunk. ")
+
+        self._starts.insert(i, start_time)
+        self._ends.insert(i, end_time)
+        self._chunks.insert(i, chunk)
+        self.dirty = True
+
+    def remove(self, chunk: TimeChunk):
+        """
+        Remove a time chunk from the index.  Does nothing if the chunk
+        is not in the index.
+
+        :param chunk: the time chunk to be removed
+        """
+        i = bisect.bisect_left(self._starts, chunk.start_time)
+        if i < len(self._chunks) and self._chunks[i] is chunk:
+            del self._starts[i]
+            del self._ends[i]
+            del self._chunks[i]
+            self.dirty = True
+
+    def mark_clean(self):
+        """
+        Mark the index as unchanged, usually once it has been loaded
+        from or saved to storage.
+        """
+        self.dirty = False
+
+    def at(self, time: Datetime):
+        """
+        Get the time chunk containing a point in time, or None if no
+        chunk contains it.
+
+        :param time: the point in time
+        """
+        i = bisect.bisect_right(self._starts, time) - 1
+        if i >= 0 and self._ends[i] > time:
+            return self._chunks[i]
+        return None
+
+    def overlapping(self,
+                    start_time: Datetime,
+                    end_time: Datetime):
+        """
+        Get the time chunks, in order, which overlap the time range
+        between start_time and end_time.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        lo = bisect.bisect_right(self._ends, start_time)
+        hi = bisect.bisect_left(self._starts, end_time)
+        return self._chunks[lo:hi]
+
+    def within(self,
+               start_time: Datetime,
+               end_time: Datetime):
+        """
+        Get the time chunks, in order, which lie completely within the
+        time range between start_time and end_time.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        lo = bisect.bisect_left(self._starts, start_time)
+        hi = bisect.bisect_right(self._ends, end_time)
+        return self._chunks[lo:hi]
+
+    def to_json(self):
+        """
+        Convert to JSON representation.
+        """
+        return [chunk.to_json() for chunk in self._chunks]
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """
+        Create an IntervalIndex instance from a sequence of time chunks.
+        The chunks are sorted once rather than inserted one at a time.
+
+        :param chunks: the time chunks
+        """
+        chunks = sorted(chunks, key=lambda chunk: chunk.start_time)
+
+        index = cls()
+        for chunk in chunks:
+            if index._ends and index._ends[-1] > chunk.start_time:
+                raise TimeMapException("Invalid time map: chunks overlap. ")
+            index._starts.append(chunk.start_time)
+            index._ends.append(chunk.end_time)
+            index._chunks.append(chunk)
+
+        return index
+
+    @classmethod
+    def from_json(cls, l: list):
+        """
+        Create an IntervalIndex instance from its JSON representation.
+
+        :param l: JSON list of allocated time chunks
+        """
+        return cls.from_chunks(AllocatedTimeChunk.from_json(chunk_json)
+                               for chunk_json in l)
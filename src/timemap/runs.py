@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+"""
+This module contains the run-length representation of time maps, in
+which consecutive time chunks with the same allocation and key are
+stored as a single time chunk spanning all of them.
+
+Module structure:
+- coalesce
+- chunk_from_json
+- range_from_json
+- RunIndex(IntervalIndex)
+"""
+
+import bisect
+
+from timemap.util import Datetime, Timedelta
+from timemap.time import AllocatedTimeChunk
+from timemap.index import IntervalIndex
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+__all__ = [
+    'coalesce',
+    'chunk_from_json',
+    'range_from_json',
+    'RunIndex'
+]
+
+
+def _same_run(chunk: AllocatedTimeChunk,
+              other: AllocatedTimeChunk):
+    """
+    Return if a time chunk continues the run of the one before it.
+    """
+    return chunk.end_time == other.start_time and \
+        chunk.get_task_allocated() == other.get_task_allocated() and \
+        chunk.get_key() == other.get_key()
+
+
+def coalesce(chunks):
+    """
+    Lazily merge consecutive time chunks with the same allocation and
+    key, in a sequence ordered by their start times, into runs.  Chunks
+    which are not merged are returned as they are.
+
+    >>> start = Datetime(2015, 1, 12, 9)
+    >>> chunks = [AllocatedTimeChunk(start + i * Timedelta(minutes=15))
+    ...           for i in range(8)]
+    >>> for chunk in chunks[2:6]:
+    ...     chunk.set_task_allocated('task', 0)
+    >>> [str(run.duration) for run in coalesce(chunks)]
+    ['0:30:00', '1:00:00', '0:30:00']
+
+    :param chunks: the allocated time chunks
+    """
+    run = []
+    for chunk in chunks:
+        if run and not _same_run(run[-1], chunk):
+            yield _merge(run)
+            run = []
+        run.append(chunk)
+    if run:
+        yield _merge(run)
+
+
+def _merge(run: list):
+    """
+    Merge a run of time chunks into one.
+    """
+    if len(run) == 1:
+        return run[0]
+    merged = run[-1].with_range(run[0].start_time, run[-1].end_time)
+    for chunk in run:
+        chunk.set_observer(None)
+    return merged
+
+
+def chunk_from_json(item: list or dict):
+    """
+    Create an AllocatedTimeChunk instance from the JSON representation
+    of a run, or of a time chunk.
+
+    :param item: JSON list for the run, or dictionary for the time chunk
+    """
+    if isinstance(item, dict):
+        return AllocatedTimeChunk.from_json(item)
+
+    start_time, duration, task_allocated, key = item
+    chunk = AllocatedTimeChunk(Datetime.from_json(start_time),
+                               Timedelta.from_json(duration))
+    if task_allocated:
+        chunk.set_task_allocated(task_allocated, key)
+    return chunk
+
+
+def range_from_json(item: list or dict):
+    """
+    Get the start and end times of a run, or of a time chunk, from its
+    JSON representation without creating the time chunk.
+
+    >>> chunk = AllocatedTimeChunk(Datetime(2015, 1, 12, 9))
+    >>> range_from_json(chunk.to_json()) == (chunk.start_time,
+    ...                                      chunk.end_time)
+    True
+
+    :param item: JSON list for the run, or dictionary for the time chunk
+    """
+    if isinstance(item, dict):
+        start_time, duration = item['start_time'], item['duration']
+    else:
+        start_time, duration = item[0], item[1]
+    start_time = Datetime.from_json(start_time)
+    return start_time, start_time + Timedelta.from_json(duration)
+
+
+class RunIndex(IntervalIndex):
+    """
+    An IntervalIndex whose time chunks are runs: consecutive time
+    chunks with the same allocation and key are merged into one, so
+    that a two hour allocation is one time chunk rather than eight of
+    fifteen minutes.  Runs are split and merged again as time ranges
+    are allocated and released.
+
+    Runs are stored as JSON lists of [start_time, duration,
+    task_allocated, key] rather than objects with one key per field.
+    Time maps stored one time chunk per object are read as well, and
+    coalesced into runs.
+
+    >>> start = Datetime(2015, 1, 12, 9)
+    >>> index = RunIndex.from_chunks(
+    ...     AllocatedTimeChunk(start + i * Timedelta(minutes=15))
+    ...     for i in range(8))
+    >>> len(index)
+    1
+    >>> index.allocate(start + Timedelta(minutes=30),
+    ...                start + Timedelta(hours=1), 'task', 0)
+    >>> [str(run.duration) for run in index]
+    ['0:30:00', '0:30:00', '1:00:00']
+    >>> index.allocate(start + Timedelta(hours=1),
+    ...                start + Timedelta(hours=2), 'task', 0)
+    >>> [str(run.duration) for run in index]
+    ['0:30:00', '1:30:00']
+    """
+    def _replace(self,
+                 lo: int,
+                 hi: int,
+                 chunks: list):
+        """
+        Replace the time chunks between positions lo and hi.
+        """
+        self._starts[lo:hi] = [chunk.start_time for chunk in chunks]
+        self._ends[lo:hi] = [chunk.end_time for chunk in chunks]
+        self._chunks[lo:hi] = chunks
+        self.dirty = True
+
+    def split(self, time: Datetime):
+        """
+        Split the run containing a point in time, if any, into runs
+        ending and starting at it.
+
+        :param time: the point in time
+        """
+        i = bisect.bisect_right(self._starts, time) - 1
+        if i < 0 or self._ends[i] <= time or self._starts[i] == time:
+            return
+
+        chunk = self._chunks[i]
+        self._replace(i, i + 1, [chunk.with_range(chunk.start_time, time),
+                                 chunk.with_range(time, chunk.end_time)])
+        chunk.set_observer(None)
+
+    def split_chunks(self,
+                     start_time: Datetime,
+                     end_time: Datetime,
+                     duration: Timedelta=Timedelta(minutes=15)):
+        """
+        Split the runs overlapping a time range into time chunks of a
+        duration, counted from the start of each run, for code which
+        allocates time one chunk at a time.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param duration: the duration of each time chunk
+        """
+        lo = bisect.bisect_right(self._ends, start_time)
+        hi = bisect.bisect_left(self._starts, end_time)
+
+        chunks = []
+        for chunk in self._chunks[lo:hi]:
+            if chunk.duration <= duration:
+                chunks.append(chunk)
+                continue
+            time = chunk.start_time
+            while time < chunk.end_time:
+                chunks.append(chunk.with_range(
+                    time, min(time + duration, chunk.end_time)))
+                time += duration
+            chunk.set_observer(None)
+        self._replace(lo, hi, chunks)
+
+    def coalesce(self,
+                 start_time: Datetime=None,
+                 end_time: Datetime=None):
+        """
+        Merge the runs overlapping or touching a time range which
+        continue each other.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        lo = 0 if start_time is None else \
+            bisect.bisect_left(self._ends, start_time)
+        hi = len(self._chunks) if end_time is None else \
+            bisect.bisect_right(self._starts, end_time)
+        if hi - lo > 1:
+            self._replace(lo, hi, list(coalesce(self._chunks[lo:hi])))
+
+    def allocate(self,
+                 start_time: Datetime,
+                 end_time: Datetime,
+                 task_allocated: str or None,
+                 key: int or None):
+        """
+        Allocate the time between start_time and end_time to a task,
+        splitting the runs at either end and merging the result with
+        the runs around it.  As with AllocatedTimeChunk.set_task_allocated,
+        time already allocated can only be reallocated with the same
+        key; nothing is allocated if any of it has another key.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param task_allocated: the uid of the task to allocate to, or
+            None to release the time
+        :param key: the key to the time
+        """
+        for chunk in self.overlapping(start_time, end_time):
+            if chunk.get_key() is not None and chunk.get_key() != key:
+                raise KeyError("Task key does not match. ")
+
+        self.split(start_time)
+        self.split(end_time)
+        for chunk in self.within(start_time, end_time):
+            chunk.set_task_allocated(task_allocated, key)
+        self.coalesce(start_time, end_time)
+
+    def allocate_many(self,
+                      ranges: list,
+                      key: int or None):
+        """
+        Allocate many time ranges at once, as allocate does for each of
+        them, splitting the runs they overlap and merging the result in
+        a single pass rather than once per range.
+
+        >>> start = Datetime(2015, 1, 12, 9)
+        >>> index = RunIndex.from_chunks([AllocatedTimeChunk(
+        ...     start, Timedelta(hours=2))])
+        >>> index.allocate_many([
+        ...     (start, start + Timedelta(minutes=30), 'a'),
+        ...     (start + Timedelta(minutes=30), start + Timedelta(hours=1),
+        ...      'b'),
+        ...     (start + Timedelta(hours=1, minutes=30),
+        ...      start + Timedelta(hours=2), 'b')], 0)
+        >>> [(run.get_task_allocated(), run.duration.seconds // 60)
+        ...  for run in index]
+        [('a', 30), ('b', 30), (None, 30), ('b', 30)]
+
+        :param ranges: (start_time, end_time, task_allocated) triples,
+            in order and not overlapping, task_allocated being None to
+            release the time
+        :param key: the key to the time
+        """
+        if not ranges:
+            return
+        for start_time, end_time, _ in ranges:
+            for chunk in self.overlapping(start_time, end_time):
+                if chunk.get_key() is not None and chunk.get_key() != key:
+                    raise KeyError("Task key does not match. ")
+
+        lo = bisect.bisect_right(self._ends, ranges[0][0])
+        hi = bisect.bisect_left(self._starts, ranges[-1][1])
+        chunks = []
+        r = 0
+        for chunk in self._chunks[lo:hi]:
+            end = chunk.end_time
+            if r == len(ranges) or ranges[r][0] >= end:
+                chunks.append(chunk)
+                continue
+
+            # Cut the chunk at the ends of the ranges within it
+            time = chunk.start_time
+            while r < len(ranges) and ranges[r][0] < end:
+                start_time, end_time, task_allocated = ranges[r]
+                if end_time <= time:
+                    r += 1
+                    continue
+                if start_time > time:
+                    chunks.append(chunk.with_range(time, start_time))
+                    time = start_time
+                piece = chunk.with_range(time, min(end_time, end))
+                piece.set_task_allocated(task_allocated, key)
+                chunks.append(piece)
+                time = piece.end_time
+                if end_time > end:
+                    break
+                r += 1
+            if time < end:
+                chunks.append(chunk.with_range(time, end))
+            chunk.set_observer(None)
+
+        self._replace(lo, hi, chunks)
+        self.coalesce(ranges[0][0], ranges[-1][1])
+
+    def release(self,
+                start_time: Datetime,
+                end_time: Datetime,
+                key: int or None):
+        """
+        Release the time between start_time and end_time.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param key: the key to the time
+        """
+        self.allocate(start_time, end_time, None, key)
+
+    def to_json(self):
+        """
+        Convert to JSON representation, one list per run.  The keys of
+        unallocated time are not stored, as with AllocatedTimeChunk, so
+        runs of unallocated time are merged regardless of their keys.
+        """
+        runs = []
+        for chunk in self._chunks:
+            task_allocated = chunk.get_task_allocated()
+            key = chunk.get_key() if task_allocated else None
+            if runs and runs[-1][2] == task_allocated and \
+                    runs[-1][3] == key and runs[-1][1] == chunk.start_time:
+                runs[-1][1] = chunk.end_time
+            else:
+                runs.append([chunk.start_time, chunk.end_time,
+                             task_allocated, key])
+
+        return [[start_time.to_json(),
+                 (end_time - start_time).total_seconds(),
+                 task_allocated, key]
+                for start_time, end_time, task_allocated, key in runs]
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """
+        Create a RunIndex instance from a sequence of time chunks,
+        coalescing them into runs.
+
+        :param chunks: the allocated time chunks
+        """
+        index = super().from_chunks(chunks)
+        index.coalesce()
+        return index
+
+    @classmethod
+    def from_json(cls, l: list):
+        """
+        Create a RunIndex instance from its JSON representation, or from
+        the JSON representation of an IntervalIndex.
+
+        :param l: JSON list of runs or allocated time chunks
+        """
+        return cls.from_chunks(chunk_from_json(item) for item in l)
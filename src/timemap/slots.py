@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+This module contains a compact representation of a time map as a grid
+of equally sized slots, used in place of one AllocatedTimeChunk object
+per slot for long calendars.
+
+Module structure:
+- SlotCalendar
+"""
+
+from array import array
+
+from timemap.util import Datetime, Timedelta
+from timemap.time import AllocatedTimeChunk
+from timemap.index import TimeMapException
+
+
+__author__ = "Dibyo Majumdar"
+__email__ = "dibyo.majumdar@gmail.com"
+
+
+class SlotCalendar(object):
+    """
+    A calendar of consecutive, equally sized time slots starting at a
+    fixed time.  Occupancy is stored as a bitmap packed into a single
+    integer, so that free time queries are performed on whole machine
+    words at a time, and allocations are stored as an array of small
+    integer ids, one per slot, each referring to a (task_allocated, key)
+    pair.  Id 0 denotes a free slot.
+
+    >>> start = Datetime(2015, 1, 12)
+    >>> calendar = SlotCalendar(start, Timedelta.DAY)
+    >>> calendar.mark(start + Timedelta(hours=9),
+    ...               start + Timedelta(hours=12), 'task')
+    >>> calendar.count_free(start, start + Timedelta(hours=10))
+    36
+    >>> calendar.find_free(8, after=start + Timedelta(hours=8))
+    Datetime(2015, 1, 12, 12, 0, tzinfo=datetime.timezone.utc)
+    """
+    def __init__(self,
+                 start_time: Datetime,
+                 span: Timedelta,
+                 slot_duration: Timedelta=Timedelta(minutes=15)):
+        """
+        :param start_time: the start time of the first slot
+        :param span: the total length of time covered by the calendar
+        :param slot_duration: the duration of each slot
+        """
+        self.start_time = start_time
+        self.slot_duration = slot_duration
+        self.num_slots = -(-span // slot_duration)
+
+        self._occupied = 0
+        self._slots = array('I', bytes(4 * self.num_slots))
+        self._allocations = [None]
+        self._allocation_ids = {}
+
+    def __len__(self):
+        return self.num_slots
+
+    @property
+    def end_time(self):
+        """
+        Get the time at which the last slot of the calendar ends.
+        """
+        return self.start_time + self.num_slots * self.slot_duration
+
+    def slot_of(self, time: Datetime):
+        """
+        Get the index of the slot containing a point in time, clamped
+        to the range of the calendar.
+
+        :param time: the point in time
+        """
+        return min(max((time - self.start_time) // self.slot_duration, 0),
+                   self.num_slots)
+
+    def time_of(self, slot: int):
+        """
+        Get the start time of a slot.
+
+        :param slot: the index of the slot
+        """
+        return self.start_time + slot * self.slot_duration
+
+    def _slot_range(self,
+                    start_time: Datetime,
+                    end_time: Datetime):
+        """
+        Get the range of slots touched by a time range, clamped to the
+        range of the calendar.
+        """
+        lo = self.slot_of(start_time)
+        hi = self.slot_of(end_time - Timedelta.resolution) + 1
+        return lo, min(hi, self.num_slots)
+
+    def _allocation_id(self,
+                       task_allocated: str,
+                       key: int or None):
+        allocation = (task_allocated, key)
+        allocation_id = self._allocation_ids.get(allocation)
+        if allocation_id is None:
+            allocation_id = len(self._allocations)
+            self._allocations.append(allocation)
+            self._allocation_ids[allocation] = allocation_id
+        return allocation_id
+
+    def mark(self,
+             start_time: Datetime,
+             end_time: Datetime,
+             task_allocated: str,
+             key: int or None=None):
+        """
+        Allocate all slots touched by a time range to a task.  As with
+        AllocatedTimeChunk.set_task_allocated, slots which are already
+        allocated can only be reallocated with the same key.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        :param task_allocated: the uid of the task to allocate to
+        :param key: the key to the allocated slots
+        """
+        lo, hi = self._slot_range(start_time, end_time)
+        if lo >= hi:
+            return
+        mask = ((1 << (hi - lo)) - 1) << lo
+
+        if self._occupied & mask:
+            for slot in range(lo, hi):
+                allocation_id = self._slots[slot]
+                if allocation_id and \
+                        self._allocations[allocation_id][1] != key:
+                    raise KeyError("Task key does not match. ")
+
+        allocation_id = self._allocation_id(task_allocated, key)
+        self._slots[lo:hi] = array('I', [allocation_id]) * (hi - lo)
+        self._occupied |= mask
+
+    def clear(self,
+              start_time: Datetime,
+              end_time: Datetime):
+        """
+        Free all slots touched by a time range.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        lo, hi = self._slot_range(start_time, end_time)
+        if lo >= hi:
+            return
+
+        self._slots[lo:hi] = array('I', bytes(4 * (hi - lo)))
+        self._occupied &= ~(((1 << (hi - lo)) - 1) << lo)
+
+    def get_task_allocated(self, time: Datetime):
+        """
+        Get the uid of the task to which the slot containing a point in
+        time has been allocated.
+
+        :param time: the point in time
+        """
+        slot = self.slot_of(time)
+        if slot >= self.num_slots or not self._slots[slot]:
+            return None
+        return self._allocations[self._slots[slot]][0]
+
+    def _free_bits(self, lo: int, hi: int):
+        """
+        Get the bitmap of free slots between slots lo and hi.
+        """
+        return ~self._occupied & (((1 << (hi - lo)) - 1) << lo)
+
+    def count_free(self,
+                   start_time: Datetime=None,
+                   end_time: Datetime=None):
+        """
+        Count the number of free slots touched by a time range.
+
+        :param start_time: the start of the time range
+        :param end_time: the end of the time range
+        """
+        lo, hi = self._slot_range(start_time or self.start_time,
+                                  end_time or self.end_time)
+        if lo >= hi:
+            return 0
+        return self._free_bits(lo, hi).bit_count()
+
+    def find_free(self,
+                  num_slots: int,
+                  after: Datetime=None,
+                  before: Datetime=None):
+        """
+        Find the start time of the first run of num_slots consecutive
+        free slots lying completely within a time range, or None if
+        there is no such run.
+
+        :param num_slots: the number of consecutive free slots required
+        :param after: the start of the time range
+        :param before: the end of the time range
+        """
+        lo = 0 if after is None else \
+            -(-(after - self.start_time) // self.slot_duration)
+        hi = self.num_slots if before is None else self.slot_of(before)
+        lo = max(lo, 0)
+        if num_slots <= 0 or hi - lo < num_slots:
+            return None
+
+        # Bit i of runs is set when slots i..i+length-1 are all free.
+        runs = self._free_bits(lo, hi)
+        length = 1
+        while length < num_slots and runs:
+            shift = min(length, num_slots - length)
+            runs &= runs >> shift
+            length += shift
+
+        if not runs:
+            return None
+        return self.time_of((runs & -runs).bit_length() - 1)
+
+    def to_chunks(self):
+        """
+        Generate the AllocatedTimeChunk equivalent to each slot.
+        """
+        for slot in range(self.num_slots):
+            chunk = AllocatedTimeChunk(self.time_of(slot), self.slot_duration)
+            allocation_id = self._slots[slot]
+            if allocation_id:
+                task_allocated, key = self._allocations[allocation_id]
+                chunk.set_task_allocated(task_allocated, key)
+            yield chunk
+
+    @classmethod
+    def from_chunks(cls,
+                    chunks: list,
+                    slot_duration: Timedelta=Timedelta(minutes=15)):
+        """
+        Create a SlotCalendar instance from a sequence of time chunks.
+        The chunks must be aligned to a grid of slot_duration starting
+        at the earliest chunk.
+
+        :param chunks: the allocated time chunks
+        :param slot_duration: the duration of each slot
+        """
+        chunks = list(chunks)
+        if not chunks:
+            raise TimeMapException("Invalid calendar: no time chunks. ")
+
+        start_time = min(chunk.start_time for chunk in chunks)
+        end_time = max(chunk.end_time for chunk in chunks)
+        calendar = cls(start_time, end_time - start_time, slot_duration)
+
+        for chunk in chunks:
+            if (chunk.start_time - start_time) % slot_duration or \
+                    chunk.duration % slot_duration:
+                raise TimeMapException("Invalid calendar: time chunk not "
+                                       "aligned to slots. ")
+            task_allocated = chunk.get_task_allocated()
+            if task_allocated:
+                calendar.mark(chunk.start_time, chunk.end_time,
+                              task_allocated, chunk.get_key())
+
+        return calendar
+
+    def to_json(self):
+        """
+        Convert to JSON representation.  This is the same as the list of
+        JSON representations of the equivalent allocated time chunks.
+        """
+        return [chunk.to_json() for chunk in self.to_chunks()]
+
+    @classmethod
+    def from_json(cls, l: list):
+        """
+        Create a SlotCalendar instance from its JSON representation
+
+        :param l: JSON list of allocated time chunks
+        """
+        return cls.from_chunks(AllocatedTimeChunk.from_json(chunk_json)
+                               for chunk_json in l)
@@ -21,6 +21,8 @@ class TimeChunk(object):
     """
     A TimeChunk is a chunk of time between two times.
     """
+    __slots__ = ('start_time', '_duration')
+
     def __init__(self,
                  start_time: Datetime,
                  duration: Timedelta=Timedelta(minutes=15)):
@@ -34,6 +36,13 @@ class TimeChunk(object):
         """
         return self._duration
 
+    @property
+    def end_time(self):
+        """
+        Get the time at which this time chunk ends.
+        """
+        return self.start_time + self._duration
+
     def to_json(self):
         """
         Convert to JSON representation.  It relies on JSON converters
@@ -74,8 +83,12 @@ class TimeChunk(object):
 class AllocatedTimeChunk(TimeChunk):
     """
     An AllocatedTimeChunk is a TimeChunk that can be allocated to a
-    particular task.
+    particular task.  An observer, such as a timemap.gaps.GapIndex, can
+    be notified whenever the chunk is allocated, reallocated or
+    released.
     """
+    __slots__ = ('_task_allocated', '_key', '_observer')
+
     def __init__(self,
                  start_time: Datetime,
                  duration: Timedelta=Timedelta(minutes=15)):
@@ -87,6 +100,7 @@ class AllocatedTimeChunk(TimeChunk):
         super(AllocatedTimeChunk, self).__init__(start_time, duration)
         self._task_allocated = None
         self._key = None
+        self._observer = None
 
     def to_json(self):
         """
@@ -123,9 +137,20 @@ class AllocatedTimeChunk(TimeChunk):
         """
         Set the uid of the task to which this time chunk has been
         allocated provided the correct key is provided.  The key is
-        determined when this time chunk is first allocated to a task
-        and ensures that only the initial allocator can reallocate the
-        chunk.
+        determined when this time chunk is allocated to a task and
+        ensures that only that allocator can reallocate or release the
+        chunk.  Once released, the chunk can be allocated with any key.
+
+        >>> chunk = AllocatedTimeChunk(Datetime(2015, 1, 12, 9))
+        >>> chunk.set_task_allocated('meeting', 7)
+        >>> chunk.set_task_allocated('lunch', 0)
+        Traceback (most recent call last):
+        ...
+        KeyError: 'Task key does not match. '
+        >>> chunk.set_task_allocated(None, 7)
+        >>> chunk.set_task_allocated('lunch', 0)
+        >>> chunk.get_key()
+        0
 
         :param task_allocated: the task to which this time chunk is
         allocated
@@ -135,8 +160,12 @@ class AllocatedTimeChunk(TimeChunk):
         if self._key is not None:
             if self._key != key:
                 raise KeyError("Task key does not match. ")
+        self._key = None if task_allocated is None else key
 
+        previous = self._task_allocated
         self._task_allocated = task_allocated
+        if self._observer is not None and previous != task_allocated:
+            self._observer.chunk_changed(self, previous)
 
     def get_task_allocated(self):
         """
@@ -144,3 +173,38 @@ class AllocatedTimeChunk(TimeChunk):
         allocated.
         """
         return self._task_allocated
+
+    def with_range(self,
+                   start_time: Datetime,
+                   end_time: Datetime):
+        """
+        Create a time chunk over another time range with the same
+        allocation, key and observer as this one, used to split and
+        merge runs of time chunks.
+
+        :param start_time: the start time of the new time chunk
+        :param end_time: the end time of the new time chunk
+        """
+        duration = end_time - start_time
+        chunk = AllocatedTimeChunk(start_time, Timedelta(
+            duration.days, duration.seconds, duration.microseconds))
+        chunk._task_allocated = self._task_allocated
+        chunk._key = self._key
+        chunk._observer = self._observer
+        return chunk
+
+    def set_observer(self, observer):
+        """
+        Set the observer whose chunk_changed method is called with this
+        time chunk and the task it was allocated to before whenever
+        that changes.
+
+        :param observer: the observer, or None to remove it
+        """
+        self._observer = observer
+
+    def get_key(self):
+        """
+        Get the key to this time chunk.
+        """
+        return self._key
@@ -6,12 +6,19 @@ utilized in other modules.
 
 Module structure:
 - UTC(datetime.tzinfo)
+- DatetimeCodec
+  - LegacyCodec
+  - ISOCodec
+  - EpochCodec
 - Datetime(datetime.datetime)
 - Timedelta(datetime.timedelta)
 """
 
+import contextlib
+import contextvars
 import datetime
 import json
+import os
 
 
 __author__ = "Dibyo Majumdar"
@@ -31,6 +38,163 @@ class UTC(datetime.tzinfo):
         return "UTC"
 
 
+class DatetimeCodec(object):
+    """
+    Encodes Datetime objects into their JSON representation.  Decoding
+    does not depend on the codec: Datetime.from_json recognizes the
+    representations of all codecs, so data written with any codec can
+    always be read back.
+    """
+    name = None
+
+    def encode(self, dt: datetime.datetime):
+        """
+        Encode a datetime into its JSON representation.
+
+        :param dt: the datetime to be encoded
+        """
+        raise NotImplementedError
+
+    def encode_timestamp(self, timestamp: float):
+        """
+        Encode the UTC datetime at a number of seconds since the epoch
+        into its JSON representation.
+
+        :param timestamp: the seconds since the epoch
+        """
+        return self.encode(datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc))
+
+
+class LegacyCodec(DatetimeCodec):
+    """
+    Encodes datetimes as strings in the format Datetime.JSON_FORMAT.
+    """
+    name = 'legacy'
+
+    def encode(self, dt: datetime.datetime):
+        return dt.strftime(Datetime.JSON_FORMAT)
+
+
+class ISOCodec(DatetimeCodec):
+    """
+    Encodes datetimes as ISO 8601 strings.
+    """
+    name = 'iso'
+
+    def encode(self, dt: datetime.datetime):
+        return dt.isoformat()
+
+
+class EpochCodec(DatetimeCodec):
+    """
+    Encodes datetimes as the number of seconds since the epoch, as an
+    integer whenever there are no microseconds.
+    """
+    name = 'epoch'
+
+    def encode(self, dt: datetime.datetime):
+        return self.encode_timestamp(dt.timestamp())
+
+    def encode_timestamp(self, timestamp: float):
+        if timestamp % 1:
+            return timestamp
+        return int(timestamp)
+
+
+CODECS = {codec.name: codec for codec in (LegacyCodec(), ISOCodec(),
+                                          EpochCodec())}
+CODEC_FILE = 'codec.json'
+
+# The codec used by Datetime.to_json in the current context.  Each
+# thread, such as the executor threads of an AsyncTaskManager, has its
+# own context, so managers writing with different codecs at once never
+# see each other's.
+_codec = contextvars.ContextVar('codec', default=CODECS['legacy'])
+
+
+def read_codec(directory: str or None):
+    """
+    Get the codec selected for a data directory.  Directories without a
+    selected codec, and storage without a data directory, use the
+    legacy codec.
+
+    :param directory: the data directory, if any
+    """
+    if directory is None:
+        return CODECS['legacy']
+    try:
+        with open(os.path.join(directory, CODEC_FILE), 'r') as f:
+            return CODECS[json.load(f)['datetime']]
+    except (OSError, ValueError, KeyError):
+        return CODECS['legacy']
+
+
+def write_codec(directory: str,
+                codec: DatetimeCodec):
+    """
+    Select the codec used to write a data directory.
+
+    :param directory: the data directory
+    :param codec: the codec to be used
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, CODEC_FILE), 'w') as f:
+        json.dump({'datetime': codec.name}, f)
+
+
+@contextlib.contextmanager
+def use_codec(codec: DatetimeCodec or str):
+    """
+    Encode Datetime objects with a codec within a context.  The codec
+    is only used by the current thread.
+
+    >>> import threading
+    >>> dt = Datetime(2015, 1, 12, 11, 23, 46)
+    >>> with use_codec('epoch'):
+    ...     dt.to_json()
+    1421061826
+    >>> Datetime.from_json(1421061826) == dt
+    True
+    >>> encoded = []
+    >>> with use_codec('iso'):
+    ...     thread = threading.Thread(
+    ...         target=lambda: encoded.append(dt.to_json()))
+    ...     thread.start()
+    ...     thread.join()
+    ...     encoded.append(dt.to_json())
+    >>> encoded
+    ['2015-01-12 11:23:46+0000', '2015-01-12T11:23:46+00:00']
+
+    :param codec: the codec or the name of the codec
+    """
+    if isinstance(codec, str):
+        codec = CODECS[codec]
+
+    token = _codec.set(codec)
+    try:
+        yield codec
+    finally:
+        _codec.reset(token)
+
+
+def timestamp_to_json(timestamp: float or None):
+    """
+    Convert a number of seconds since the epoch to the JSON
+    representation of the Datetime at it, using the codec of the
+    current context (see use_codec), without creating the Datetime.
+
+    >>> with use_codec('iso'):
+    ...     timestamp_to_json(Datetime(2015, 1, 12, 9).timestamp())
+    '2015-01-12T09:00:00+00:00'
+
+    :param timestamp: the seconds since the epoch
+    """
+    if timestamp is None:
+        return None
+    return _codec.get().encode_timestamp(timestamp)
+
+
 class Datetime(datetime.datetime):
     """
     Subclass of datetime.datetime defined in order to add
@@ -43,6 +207,8 @@ class Datetime(datetime.datetime):
     >>> dt == date
     True
     """
+    __slots__ = ()
+
     JSON_FORMAT = "%Y-%m-%d %H:%M:%S%z"
 
     def __new__(cls, *args, **kwargs):
@@ -50,26 +216,65 @@ class Datetime(datetime.datetime):
         All datetime instances are always initiated with timezone UTC
         whenever possible
         """
+        if len(args) < 8 and 'tzinfo' not in kwargs:
+            try:
+                return super().__new__(cls, *args,
+                                       tzinfo=datetime.timezone.utc, **kwargs)
+            except TypeError:
+                pass
+        return super().__new__(cls, *args, **kwargs)
+
+    @classmethod
+    def from_json(cls, s: str or int or float or None):
+        """
+        Create a Datetime object from its JSON representation.  Any of
+        the representations written by the codecs is accepted: numbers
+        are taken as seconds since the epoch, strings in the legacy
+        format are sliced directly and other strings are parsed as ISO
+        8601.
+
+        :param s: JSON-encoded string or number for the Datetime object
+        """
+        if s is None:
+            return None
+        if isinstance(s, (int, float)):
+            return cls.fromtimestamp(s, datetime.timezone.utc)
+
+        if len(s) == 24 and s[10] == ' ' and s.endswith('+0000'):
+            return datetime.datetime.__new__(
+                cls, int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]),
+                int(s[14:16]), int(s[17:19]), 0, datetime.timezone.utc)
         try:
-            return super().__new__(cls, *args, tzinfo=datetime.timezone.utc,
-                                   **kwargs)
-        except TypeError:
-            return super().__new__(cls, *args, **kwargs)
+            return cls.fromisoformat(s)
+        except ValueError:
+            return cls.strptime(s, cls.JSON_FORMAT)
 
     @classmethod
-    def from_json(cls, s: str or None):
+    def from_timestamp(cls, timestamp: float or None):
         """
-        Create a Datetime object from its JSON representation.
+        Create a Datetime object in UTC from the number of seconds
+        since the epoch.  This is used by objects which store times as
+        timestamps to save memory, and is faster than fromtimestamp,
+        which goes through __new__.
+
+        >>> Datetime.from_timestamp(Datetime(2015, 1, 12, 9).timestamp())
+        Datetime(2015, 1, 12, 9, 0, tzinfo=datetime.timezone.utc)
 
-        :param s: JSON-encoded string for the Datetime object
+        :param timestamp: the seconds since the epoch
         """
-        return cls.strptime(s, cls.JSON_FORMAT)
+        if timestamp is None:
+            return None
+        dt = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+        return datetime.datetime.__new__(
+            cls, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second,
+            dt.microsecond, datetime.timezone.utc)
 
     def to_json(self):
         """
-        Convert object to a JSON-string representation.
+        Convert object to a JSON representation using the codec of the
+        current context (see use_codec).
         """
-        return self.strftime(self.JSON_FORMAT)
+        return _codec.get().encode(self)
 
 
 class Timedelta(datetime.timedelta):
@@ -78,6 +283,8 @@ class Timedelta(datetime.timedelta):
     implementations for a JSON encoder and decoder.  Also, defined
     constants for common timedeltas like day, week and year.
     """
+    __slots__ = ()
+
     @classmethod
     def from_json(cls, f: float or None):
         """
@@ -85,6 +292,8 @@ class Timedelta(datetime.timedelta):
 
         :param f: JSON-encoded float for the Timedelta object
         """
+        if f is None:
+            return None
         return cls(seconds=float(f))
 
     def to_json(self):